@@ -0,0 +1,43 @@
+"""measure the import time of buildbot_pipelines modules, in fresh interpreters
+
+usage: python benchmarks/import_time.py [-n RUNS] [module ...]
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import subprocess
+import sys
+
+DEFAULT_MODULES = ["buildbot_pipelines.yaml_loader", "buildbot_pipelines"]
+
+MEASURE = """
+import sys, time
+start = time.time()
+import {module}
+print(time.time() - start, len([m for m in sys.modules if m.startswith('buildbot.steps.')]))
+"""
+
+
+def measure(module, runs):
+    timings = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", MEASURE.format(module=module)])
+        elapsed, step_modules = out.split()
+        timings.append(float(elapsed))
+    timings.sort()
+    return timings[len(timings) // 2], timings[0], int(step_modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    args = parser.parse_args()
+    for module in args.modules:
+        median, best, step_modules = measure(module, args.runs)
+        print("{}: median {:.3f}s, best {:.3f}s, {} buildbot step modules imported".format(
+            module, median, best, step_modules))
+
+
+if __name__ == "__main__":
+    main()
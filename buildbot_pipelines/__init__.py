@@ -1,7 +1,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from .configurator import PipelineConfigurator
-
+import sys
 
 __all__ = ['PipelineConfigurator']
+
+# the configurator pulls in buildbot.config and the steps: only import it when it is
+# used, so that e.g. the yaml loader and the bbpipeline script stay fast to import
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == 'PipelineConfigurator':
+            from .configurator import PipelineConfigurator
+            return PipelineConfigurator
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    from .configurator import PipelineConfigurator  # noqa: F401
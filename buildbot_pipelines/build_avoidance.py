@@ -0,0 +1,135 @@
+"""Build avoidance: reuse the results of identical runner builds
+
+A stage with 'build_avoidance: true' gets a key per matrix cell, computed from the hash of
+the source tree, the definition of the stage and the yml_matrix properties of the cell. When
+a previous build with the same key succeeded, the buildrequest is not created, and the
+result of the previous build is reused.
+
+Each key is a row of the state table of the master, read on every lookup, so that the
+masters of a cluster share them. Entries expire after BuildAvoidance.ttl seconds, and every
+evict_every recorded results, the expired ones, and the oldest ones above max_entries, are
+deleted.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import time
+import weakref
+
+import sqlalchemy as sa
+from twisted.internet import defer
+
+from buildbot.process.properties import Interpolate
+from buildbot.process.results import SUCCESS, WARNINGS
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_EVICT_EVERY = 100
+# number of rows deleted per query
+DELETE_CHUNK = 100
+
+
+class NotCanonical(Exception):
+    pass
+
+
+def canonical(obj):
+    """json compatible, deterministic representation of a parsed yaml value"""
+    if obj is None or isinstance(obj, (bool, int, float, str, type(u''))):
+        return obj
+    if isinstance(obj, dict):
+        return sorted([str(k), canonical(v)] for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [canonical(v) for v in obj]
+    if isinstance(obj, Interpolate):
+        return ['!Interpolate', obj.fmtstring, canonical(obj.args), canonical(obj.kwargs)]
+    factory = getattr(obj, '_factory', None)
+    if factory is not None:
+        # build steps remember the arguments they were created with
+        cls = factory.factory
+        return ['!' + cls.__module__ + '.' + cls.__name__,
+                canonical(factory.args), canonical(factory.kwargs)]
+    raise NotCanonical(type(obj).__name__)
+
+
+def avoidance_key(tree_hash, stage_definition, matrix_props):
+    """
+    @param stage_definition: canonical definition of the stage, or the pipeline digest if
+                             it has none
+    """
+    key = json.dumps([tree_hash, stage_definition, canonical(matrix_props)], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class BuildAvoidance(object):
+
+    ttl = DEFAULT_TTL
+    max_entries = DEFAULT_MAX_ENTRIES
+    evict_every = DEFAULT_EVICT_EVERY
+
+    def __init__(self, master):
+        self.master = master
+        self._objectid = None
+        self._records = 0
+
+    @defer.inlineCallbacks
+    def getObjectId(self):
+        if self._objectid is None:
+            self._objectid = yield self.master.db.state.getObjectId(
+                'buildbot_pipelines', 'BuildAvoidance')
+        defer.returnValue(self._objectid)
+
+    @defer.inlineCallbacks
+    def lookup(self, key, now=None):
+        """return (results, brid) of a previous build with this key, or None"""
+        objectid = yield self.getObjectId()
+        # [results, brid, timestamp]
+        entry = yield self.master.db.state.getState(objectid, key, None)
+        if entry is None or entry[2] + self.ttl < (now or time.time()):
+            defer.returnValue(None)
+        defer.returnValue((entry[0], entry[1]))
+
+    @defer.inlineCallbacks
+    def record(self, key, results, brid, now=None):
+        """remember the results of the build of a key, if it can be reused"""
+        if results not in (SUCCESS, WARNINGS):
+            return
+        now = now or time.time()
+        objectid = yield self.getObjectId()
+        yield self.master.db.state.setState(objectid, key, [results, brid, now])
+        self._records += 1
+        if self._records >= self.evict_every:
+            self._records = 0
+            yield self.evict(now)
+
+    @defer.inlineCallbacks
+    def evict(self, now):
+        """delete the expired entries, and the oldest ones above max_entries"""
+        objectid = yield self.getObjectId()
+        object_state = self.master.db.model.object_state
+
+        def thd(conn):
+            q = sa.select([object_state.c.name, object_state.c.value_json],
+                          whereclause=object_state.c.objectid == objectid)
+            timestamps = dict((row.name, json.loads(row.value_json)[2])
+                              for row in conn.execute(q))
+            evicted = [name for name, ts in timestamps.items() if ts + self.ttl < now]
+            kept = sorted((ts, name) for name, ts in timestamps.items() if ts + self.ttl >= now)
+            evicted.extend(name for _, name in kept[:max(0, len(kept) - self.max_entries)])
+            for i in range(0, len(evicted), DELETE_CHUNK):
+                conn.execute(object_state.delete().where(
+                    (object_state.c.objectid == objectid) &
+                    object_state.c.name.in_(evicted[i:i + DELETE_CHUNK])))
+            return len(evicted)
+        evicted = yield self.master.db.pool.do(thd)
+        defer.returnValue(evicted)
+
+
+_avoidances = weakref.WeakKeyDictionary()
+
+
+def getBuildAvoidance(master):
+    if master not in _avoidances:
+        _avoidances[master] = BuildAvoidance(master)
+    return _avoidances[master]
@@ -0,0 +1,64 @@
+"""Step conditions
+
+Conditions are python expressions restricted to comparisons, boolean operators, 'in', literals
+and property lookups. They are validated when the pipeline is loaded, compiled once, and
+evaluated against a read only view of the build properties.
+"""
+from __future__ import absolute_import, division, print_function
+
+import ast
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+MAX_CACHED_CONDITIONS = 1024
+
+ALLOWED_NODES = tuple(getattr(ast, name) for name in [
+    'Expression', 'BoolOp', 'And', 'Or', 'UnaryOp', 'Not', 'Compare',
+    'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Is', 'IsNot',
+    'Name', 'Load', 'Tuple', 'List',
+    # literals, depending on the python version
+    'Constant', 'Num', 'Str', 'NameConstant'] if hasattr(ast, name))
+
+_compiled = {}
+
+
+class ConditionInvalid(PipelineYmlInvalid):
+    pass
+
+
+class PropertiesView(object):
+    """mapping of property names to values, without copying the properties"""
+
+    def __init__(self, properties):
+        self.properties = properties.properties
+
+    def __getitem__(self, name):
+        return self.properties[name][0]
+
+
+def compile_condition(condition):
+    code = _compiled.get(condition)
+    if code is not None:
+        return code
+    if not isinstance(condition, str):
+        raise ConditionInvalid("condition must be a string: {!r}".format(condition))
+    try:
+        tree = ast.parse(condition.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ConditionInvalid("invalid condition {!r}: {}".format(condition, e))
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ConditionInvalid("{} is not allowed in condition {!r}".format(
+                node.__class__.__name__, condition))
+    code = compile(tree, '<condition>', 'eval')
+    if len(_compiled) >= MAX_CACHED_CONDITIONS:
+        _compiled.clear()
+    _compiled[condition] = code
+    return code
+
+
+def evaluate_condition(condition, properties):
+    """evaluate the condition against a L{Properties} object
+
+    unknown properties raise NameError"""
+    return eval(compile_condition(condition), {'__builtins__': {}}, PropertiesView(properties))
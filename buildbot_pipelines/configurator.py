@@ -7,19 +7,84 @@ from buildbot.process import factory
 from buildbot.process.properties import Property
 from buildbot.schedulers.triggerable import Triggerable
 from buildbot.steps.source.git import Git
+from buildbot.worker.local import LocalWorker
+from buildbot_pipelines import package_loader, threads
+from buildbot_pipelines.build_avoidance import BuildAvoidance
+from buildbot_pipelines.gitmirror import GitMirror
+from buildbot_pipelines.pipeline_cache import pipeline_cache
+from buildbot_pipelines.pipeline_tracker import PipelineTracker
 from buildbot_pipelines.schedulers.anycodebasescheduler import \
     AnyCodeBaseScheduler
+from buildbot_pipelines.schedulers.pipelinecron import PipelineCronService
+from buildbot_pipelines.steps.checkout import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
 from buildbot_pipelines.steps.runner import RunnerStep
 from buildbot_pipelines.steps.spawner import SpawnerStep
+from buildbot_pipelines.worker_selection import ImageAffinityWorkerPicker, getWorkerPools
+from buildbot_pipelines.yaml_loader import PipelineYml
 
 RESERVED_UNDERSCORE_NAMES.extend(["__spawner", "__runner"])
 
+# in process worker running the spawner builds, when the pipeline files are read from mirrors
+SPAWNER_LOCAL_WORKER = "__spawner_local"
+
 
 class PipelineConfigurator(ConfiguratorBase):
 
+    def __init__(self, pipeline_cache_size=None, pipeline_threads=None, max_matrix_cells=None,
+                 change_debounce=None, pipeline_source="worker", mirror_dir="pipeline_mirrors",
+                 checkout_cache_dir=DEFAULT_CACHE_DIR, checkout_cache_size=DEFAULT_CACHE_SIZE,
+                 env_filter=None, worker_pools=None, detach_stages=False,
+                 package_index=None, package_cache_dir=None, build_avoidance_ttl=None,
+                 crons=True, max_steps=None):
+        """
+        @param pipeline_source: "worker" to read the pipeline file from a checkout on a
+                                worker, "mirror" to read it from bare mirrors on the master.
+        @param mirror_dir: where the mirrors are kept, relative to the master basedir.
+        @param checkout_cache_dir: where the workers keep their reference repositories.
+        @param checkout_cache_size: maximum size of the reference repositories, per worker.
+        @param env_filter: an L{EnvironmentFilter} selecting the properties exported to the
+                           environment of the runner shell steps.
+        @param worker_pools: dict worker_type -> runner worker names. By default, workers are
+                             pooled by their 'worker_type' property.
+        @param detach_stages: let the spawner builds finish once the first stages are
+                              triggered, the master then runs the next stages. The
+                              spawner builds then always succeed: the result of the
+                              pipeline is set afterwards in their 'pipeline_results'
+                              property and state string, and sent on the ('pipelines',
+                              buildid, 'finished') mq topic.
+        @param package_index: directory of wheels, or url of the PEP 503 index, where the
+                              packages of '!Imports' are found. The imported packages run
+                              in the master, so it must only hold trusted packages. By
+                              default, there is none, and '!Imports' of packages fail.
+        @param package_cache_dir: where the imported packages are unpacked.
+        @param build_avoidance_ttl: how long, in seconds, the results of the stages with
+                                    'build_avoidance: true' can be reused.
+        @param crons: run the 'crons:' entries of the pipelines.
+        @param max_steps: maximum number of steps of a stage.
+        """
+        ConfiguratorBase.__init__(self)
+        self.pipeline_cache_size = pipeline_cache_size
+        self.pipeline_threads = pipeline_threads
+        self.max_matrix_cells = max_matrix_cells
+        self.change_debounce = change_debounce
+        if pipeline_source not in ("worker", "mirror"):
+            raise ValueError("pipeline_source must be 'worker' or 'mirror'")
+        self.pipeline_source = pipeline_source
+        self.mirror_dir = mirror_dir
+        self.checkout_cache_dir = checkout_cache_dir
+        self.checkout_cache_size = checkout_cache_size
+        self.env_filter = env_filter
+        self.worker_pools = worker_pools
+        self.detach_stages = detach_stages
+        self.package_index = package_index
+        self.package_cache_dir = package_cache_dir
+        self.build_avoidance_ttl = build_avoidance_ttl
+        self.crons = crons
+        self.max_steps = max_steps
+
     def get_all_workers(self):
         workers = [s.workername for s in self.config[
-            'workers']]
+            'workers'] if s.workername != SPAWNER_LOCAL_WORKER]
         return workers
 
     def get_spawner_workers(self):
@@ -56,30 +121,69 @@ class PipelineConfigurator(ConfiguratorBase):
         c.setdefault('builders', [])
         c.setdefault('schedulers', [])
 
+        if self.pipeline_cache_size is not None:
+            pipeline_cache.resize(self.pipeline_cache_size)
+        if self.pipeline_threads is not None:
+            threads.setPoolSize(self.pipeline_threads)
+        if self.max_matrix_cells is not None:
+            PipelineYml.max_matrix_cells = self.max_matrix_cells
+        if self.max_steps is not None:
+            PipelineYml.max_steps = self.max_steps
+        if self.build_avoidance_ttl is not None:
+            BuildAvoidance.ttl = self.build_avoidance_ttl
+        package_loader.configure(self.package_index,
+                                 self.package_cache_dir or package_loader.DEFAULT_CACHE_DIR)
+
         # Define the builder for the main job
         f = factory.BuildFactory()
-        f.addStep(Git(repourl=Property("repository"), codebase=Property("codebase"), name='git', shallow=1))
-        f.addStep(SpawnerStep())
+        if self.pipeline_source == "mirror":
+            # no checkout at all, the pipeline file is read on the master
+            c.setdefault('workers', []).append(LocalWorker(SPAWNER_LOCAL_WORKER))
+            spawner_workers = [SPAWNER_LOCAL_WORKER]
+            f.addStep(SpawnerStep(mirror=GitMirror(self.mirror_dir),
+                                  detach_stages=self.detach_stages))
+        else:
+            spawner_workers = self.get_spawner_workers()
+            f.addStep(Git(repourl=Property("repository"), codebase=Property("codebase"), name='git', shallow=1))
+            f.addStep(SpawnerStep(detach_stages=self.detach_stages))
 
+        if self.detach_stages:
+            c.setdefault('services', []).append(PipelineTracker())
+        if self.crons:
+            c.setdefault('services', []).append(PipelineCronService())
         self.config['builders'].append(BuilderConfig(
             name='__spawner',
-            workernames=self.get_spawner_workers(),
+            workernames=spawner_workers,
             collapseRequests=False,
             factory=f
         ))
         self.config['schedulers'].append(AnyCodeBaseScheduler(
             name='__spawner',
-            builderNames=['__spawner']
+            builderNames=['__spawner'],
+            debounce=self.change_debounce
         ))
 
+        runner_workers = self.get_runner_workers()
+        pools = self.worker_pools
+        if pools is None:
+            pools = getWorkerPools(s for s in c['workers'] if s.workername in runner_workers)
+        picker = ImageAffinityWorkerPicker(pools)
+
         # Define the builder for the main job
         f = factory.BuildFactory()
-        f.addStep(RunnerStep())
+        f.addStep(RunnerStep(checkout_cache_dir=self.checkout_cache_dir,
+                             checkout_cache_size=self.checkout_cache_size,
+                             env_filter=self.env_filter, worker_picker=picker))
 
+        # not passing the bound method, as buildbot would take it for the old 2 arguments API
+        def nextWorker(builder, workers, buildrequest):
+            return picker.nextWorker(builder, workers, buildrequest)
         self.config['builders'].append(BuilderConfig(
             name='__runner',
-            workernames=self.get_runner_workers(),
+            workernames=runner_workers,
             collapseRequests=False,
+            nextWorker=nextWorker,
+            canStartBuild=picker.canStartBuild,
             factory=f
         ))
         self.config['schedulers'].append(Triggerable(
@@ -0,0 +1,125 @@
+"""Cron entries of the pipelines
+
+'crons:' maps a cron name to its 'timespec' (a list of cron expressions), the 'branches' it
+builds and the 'stages' it runs. Cron expressions have the usual 5 fields, minute hour
+day-of-month month day-of-week, plus an optional 6th year field, and are evaluated in the
+local time of the master. As with cron, when both day fields are restricted, a day matching
+either of them fires.
+"""
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import time
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+# name, min, max
+FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12),
+          ('day of week', 0, 7), ('year', 1970, 2199)]
+
+# how far in the future next fire times are searched, e.g. for a 30th of february
+MAX_YEARS_AHEAD = 8
+
+
+def parse_field(field, name, lo, hi):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        has_step = '/' in part
+        if has_step:
+            part, step = part.split('/', 1)
+            if not step.isdigit() or int(step) < 1:
+                raise ValueError("invalid step in {} field: {!r}".format(name, field))
+            step = int(step)
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            start, end = part.split('-', 1)
+            if not (start.isdigit() and end.isdigit()):
+                raise ValueError("invalid range in {} field: {!r}".format(name, field))
+            start, end = int(start), int(end)
+        elif part.isdigit():
+            start = int(part)
+            end = hi if has_step else start
+        else:
+            raise ValueError("invalid {} field: {!r}".format(name, field))
+        if start < lo or end > hi or start > end:
+            raise ValueError("{} field out of range: {!r}".format(name, field))
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSpec(object):
+
+    def __init__(self, spec):
+        fields = str(spec).split()
+        if len(fields) not in (5, 6):
+            raise PipelineYmlInvalid(
+                "cron expression {!r} must have 5 fields, plus an optional year".format(spec))
+        try:
+            parsed = [parse_field(f, *FIELDS[i]) for i, f in enumerate(fields)]
+        except ValueError as e:
+            raise PipelineYmlInvalid("invalid cron expression {!r}: {}".format(spec, e))
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed[:5]
+        # sunday is both 0 and 7
+        self.weekdays = frozenset(d % 7 for d in weekdays)
+        self.years = parsed[5] if len(parsed) == 6 else None
+        self.days_restricted = fields[2] != '*'
+        self.weekdays_restricted = fields[4] != '*'
+
+    def day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.isoweekday() % 7) in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day or weekday
+        return day and weekday
+
+    def next_fire(self, after):
+        """return the first fire time strictly after the timestamp after, or None"""
+        dt = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+        dt += datetime.timedelta(minutes=1)
+        last_year = dt.year + MAX_YEARS_AHEAD
+        while dt.year <= last_year:
+            if self.years is not None and dt.year not in self.years:
+                dt = datetime.datetime(dt.year + 1, 1, 1)
+            elif dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(dt.timetuple())
+        return None
+
+
+class Cron(object):
+
+    def __init__(self, name, cfg):
+        if not isinstance(cfg, dict):
+            raise PipelineYmlInvalid("cron {} must be a mapping".format(name))
+        timespec = cfg.get('timespec', [])
+        if not isinstance(timespec, list):
+            timespec = [timespec]
+        if not timespec:
+            raise PipelineYmlInvalid("cron {} has no timespec".format(name))
+        self.name = name
+        self.specs = [CronSpec(spec) for spec in timespec]
+        self.branches = cfg.get('branches', [])
+        self.stages = cfg.get('stages')
+        if not isinstance(self.branches, list) or (
+                self.stages is not None and not isinstance(self.stages, list)):
+            raise PipelineYmlInvalid("branches and stages of cron {} must be lists".format(name))
+
+    def next_fire(self, after):
+        times = [t for t in (spec.next_fire(after) for spec in self.specs) if t is not None]
+        return min(times) if times else None
+
+
+def compile_crons(crons):
+    if not isinstance(crons, dict):
+        raise PipelineYmlInvalid("'crons' must be a mapping of cron names")
+    return [Cron(name, cfg) for name, cfg in crons.items()]
@@ -0,0 +1,82 @@
+"""Environment of the runner shell steps
+
+Build properties are exported as environment variables, minus the ones which are not useful
+to shell commands: structured values, big values, and the denied names. The environment is
+computed once per build, and only recomputed if the build properties change.
+"""
+from __future__ import absolute_import, division, print_function
+
+import fnmatch
+import weakref
+
+DEFAULT_DENY = ['yaml_text']
+DEFAULT_MAX_VALUE_SIZE = 4096
+DEFAULT_MAX_SIZE = 64 * 1024
+
+
+class EnvironmentFilter(object):
+
+    def __init__(self, allow=None, deny=DEFAULT_DENY, max_value_size=DEFAULT_MAX_VALUE_SIZE,
+                 max_size=DEFAULT_MAX_SIZE, structured=False):
+        """
+        @param allow: if set, only properties matching one of those glob patterns are exported
+        @param deny: properties matching one of those glob patterns are not exported
+        @param max_value_size: bigger values are not exported
+        @param max_size: maximum total size of the exported variables
+        @param structured: whether dict and list properties are exported
+        """
+        self.allow = allow
+        self.deny = deny or []
+        self.max_value_size = max_value_size
+        self.max_size = max_size
+        self.structured = structured
+        self._builds = weakref.WeakKeyDictionary()
+
+    def _matches(self, name, patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def accepts(self, name, value):
+        if self.allow is not None and not self._matches(name, self.allow):
+            return False
+        if self._matches(name, self.deny):
+            return False
+        if not self.structured and isinstance(value, (dict, list, tuple)):
+            return False
+        return True
+
+    def compute(self, properties):
+        """compute the environment from a dict of name -> (value, source)"""
+        env = {}
+        size = 0
+        for name in sorted(properties):
+            value = properties[name][0]
+            if not self.accepts(name, value):
+                continue
+            value = str(value)
+            if self.max_value_size is not None and len(value) > self.max_value_size:
+                continue
+            entry_size = len(name) + len(value) + 2
+            if self.max_size is not None and size + entry_size > self.max_size:
+                continue
+            size += entry_size
+            env[str(name)] = value
+        return env
+
+    def getEnvironment(self, build):
+        properties = build.getProperties().properties
+        cached = self._builds.get(build)
+        if cached is not None:
+            snapshot, env = cached
+            # setProperty always stores a new tuple, so identity tells if a property changed
+            if len(snapshot) == len(properties) and all(
+                    properties.get(k) is v for k, v in snapshot.items()):
+                return env
+        env = self.compute(properties)
+        self._builds[build] = (dict(properties), env)
+        return env
+
+
+default_environment_filter = EnvironmentFilter()
@@ -0,0 +1,5 @@
+from __future__ import absolute_import, division, print_function
+
+
+class PipelineYmlInvalid(Exception):
+    pass
@@ -0,0 +1,140 @@
+"""Master side bare mirrors of the pipeline repositories
+
+Lets the spawner read the pipeline file with 'git cat-file', at the revision of the change,
+without needing any worker checkout. Mirrors are fetched incrementally, and file contents
+are cached by (repository, commit, filename).
+
+Git commands are blocking, so everything runs on the pipeline thread pool. Several builds
+can ask for the same repository at the same time, so mirror updates are serialized per
+repository.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import hashlib
+import os
+import re
+import subprocess
+import threading
+
+from buildbot_pipelines.threads import deferToPipelineThread
+
+SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+SCHEME_RE = re.compile(r'^([A-Za-z][A-Za-z0-9+.-]*)://')
+# 'ext::' and the other remote helpers can run arbitrary commands
+ALLOWED_SCHEMES = ('http', 'https', 'ssh', 'git', 'file')
+
+
+class GitMirrorError(Exception):
+    pass
+
+
+def checkRepoUrl(repourl):
+    """reject the urls git could take for options, or run commands for
+
+    repourl comes from the changes, so from whoever can send webhooks"""
+    m = SCHEME_RE.match(repourl)
+    if repourl.startswith('-') or (m is None and '::' in repourl) or (
+            m is not None and m.group(1).lower() not in ALLOWED_SCHEMES):
+        raise GitMirrorError("unsupported repository url: {!r}".format(repourl))
+
+
+class GitMirror(object):
+
+    def __init__(self, basedir, max_cached_files=1000):
+        self.basedir = basedir
+        self.max_cached_files = max_cached_files
+        self._files = collections.OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def mirrorPath(self, repourl):
+        return os.path.join(self.basedir, hashlib.sha1(repourl.encode('utf-8')).hexdigest() + ".git")
+
+    def _repoLock(self, repourl):
+        with self._lock:
+            return self._locks.setdefault(repourl, threading.Lock())
+
+    def _git(self, args, cwd=None):
+        p = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        return p.returncode, stdout, stderr
+
+    def _checkGit(self, args, cwd=None):
+        rc, stdout, stderr = self._git(args, cwd)
+        if rc != 0:
+            raise GitMirrorError("git {} failed: {}".format(" ".join(args), stderr.decode('utf-8', 'replace')))
+        return stdout
+
+    def _resolve(self, path, revision):
+        rc, stdout, _ = self._git(['rev-parse', '--verify', '--quiet', revision + '^{commit}'], cwd=path)
+        if rc != 0:
+            return None
+        return stdout.decode('ascii').strip()
+
+    def updateMirror(self, repourl, revision):
+        """make sure revision is in the mirror, and return its commit sha (blocking)"""
+        checkRepoUrl(repourl)
+        if revision.startswith('-'):
+            raise GitMirrorError("invalid revision: {!r}".format(revision))
+        path = self.mirrorPath(repourl)
+        with self._repoLock(repourl):
+            if not os.path.exists(path):
+                if not os.path.isdir(self.basedir):
+                    os.makedirs(self.basedir)
+                self._checkGit(['clone', '--mirror', '--quiet', '--', repourl, path])
+            elif SHA1_RE.match(revision):
+                # commits are immutable: no need to fetch if we already have it
+                sha = self._resolve(path, revision)
+                if sha is not None:
+                    return sha
+                self._checkGit(['fetch', '--prune', '--quiet', 'origin'], cwd=path)
+            else:
+                # branch names and symbolic refs may have moved
+                self._checkGit(['fetch', '--prune', '--quiet', 'origin'], cwd=path)
+            sha = self._resolve(path, revision)
+            if sha is None and SHA1_RE.match(revision):
+                # commit not reachable from any ref, try to fetch it directly
+                self._git(['fetch', '--quiet', 'origin', revision], cwd=path)
+                sha = self._resolve(path, revision)
+            if sha is None:
+                raise GitMirrorError("revision {} not found in {}".format(revision, repourl))
+            return sha
+
+    def readFile(self, repourl, sha, filename):
+        """return the content of filename at commit sha, or None (blocking)"""
+        key = (repourl, sha, filename)
+        with self._lock:
+            if key in self._files:
+                content = self._files.pop(key)
+                self._files[key] = content
+                return content
+        rc, stdout, _ = self._git(['cat-file', '-p', '{}:{}'.format(sha, filename)],
+                                  cwd=self.mirrorPath(repourl))
+        content = stdout.decode('utf-8') if rc == 0 else None
+        with self._lock:
+            self._files[key] = content
+            while len(self._files) > self.max_cached_files:
+                self._files.popitem(last=False)
+        return content
+
+    def getFirstFile(self, repourl, revision, filenames):
+        """return (filename, content) of the first existing file of filenames (blocking)"""
+        sha = self.updateMirror(repourl, revision)
+        for filename in filenames:
+            content = self.readFile(repourl, sha, filename)
+            if content is not None:
+                return filename, content
+        return None, None
+
+    def getFileContent(self, repourl, revision, filenames):
+        return deferToPipelineThread(self.getFirstFile, repourl, revision, filenames)
+
+    def getTree(self, repourl, revision):
+        """return the hash of the source tree of revision (blocking)"""
+        sha = self.updateMirror(repourl, revision)
+        return self._checkGit(['rev-parse', sha + '^{tree}'],
+                              cwd=self.mirrorPath(repourl)).decode('ascii').strip()
+
+    def getTreeHash(self, repourl, revision):
+        return deferToPipelineThread(self.getTree, repourl, revision)
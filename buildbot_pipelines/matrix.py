@@ -0,0 +1,117 @@
+"""Matrix expansion engine
+
+Cells are represented as tuples of (key, value) pairs, in the order of the matrix keys.
+Includes and excludes are indexed by hashable projections of the cells, so that the
+expansion is linear in the number of cells, and can be streamed.
+
+Ordering follows the historical implementation: the cartesian product of the matrix (first
+key varying the slowest), then the include items, minus the excluded cells.
+"""
+from __future__ import absolute_import, division, print_function
+
+import itertools
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+DEFAULT_MAX_CELLS = 10000
+
+
+class MatrixTooLarge(PipelineYmlInvalid):
+    pass
+
+
+def freeze(value):
+    """return a hashable version of a yaml value"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def cell_identity(cell):
+    return frozenset((k, freeze(v)) for k, v in cell)
+
+
+class Matrix(object):
+
+    def __init__(self, matrix=None, include=None, exclude=None, max_cells=DEFAULT_MAX_CELLS):
+        self.matrix = [(k, vs if isinstance(vs, (list, tuple)) else [vs])
+                       for k, vs in (matrix or {}).items()]
+        self.max_cells = max_cells
+        self.include = []
+        self._include_index = set()
+        for item in include or []:
+            cell = tuple(item.items())
+            identity = cell_identity(cell)
+            if identity not in self._include_index:
+                self._include_index.add(identity)
+                self.include.append(cell)
+        # keys of the exclude item -> set of excluded values for those keys
+        self._exclude_index = {}
+        for item in exclude or []:
+            keys = tuple(sorted(item.keys()))
+            self._exclude_index.setdefault(keys, set()).add(
+                tuple(freeze(item[k]) for k in keys))
+
+    def is_excluded(self, cell):
+        if not self._exclude_index:
+            return False
+        # exclude works if all of exclude items keys are inside the cell.
+        # all cell keys do not need to be in the exclude item
+        values = dict((k, freeze(v)) for k, v in cell)
+        for keys, excluded in self._exclude_index.items():
+            try:
+                projection = tuple(values[k] for k in keys)
+            except KeyError:
+                continue
+            if projection in excluded:
+                return True
+        return False
+
+    def iter_cells(self):
+        if not self.matrix and not self.include:
+            # if matrix is not used, we run this stage within one build without particular property
+            yield ()
+            return
+        if self.matrix:
+            keys = [k for k, _ in self.matrix]
+            for values in itertools.product(*[vs for _, vs in self.matrix]):
+                cell = tuple(zip(keys, values))
+                # included cells are yielded at the end
+                if self._include_index and cell_identity(cell) in self._include_index:
+                    continue
+                if not self.is_excluded(cell):
+                    yield cell
+        for cell in self.include:
+            if not self.is_excluded(cell):
+                yield cell
+
+    def __iter__(self):
+        for cell in self.iter_cells():
+            yield dict(cell)
+
+    def upper_bound(self):
+        size = 1 if self.matrix else 0
+        for _, vs in self.matrix:
+            size *= len(vs)
+        return max(size + len(self.include), 1)
+
+    def count(self, limit=None):
+        """count the cells without materializing them, stopping after limit + 1"""
+        n = 0
+        for _ in self.iter_cells():
+            n += 1
+            if limit is not None and n > limit:
+                break
+        return n
+
+    def check_size(self):
+        if self.max_cells is None or self.upper_bound() <= self.max_cells:
+            return
+        if self.count(self.max_cells) > self.max_cells:
+            raise MatrixTooLarge("matrix has more than {} cells".format(self.max_cells))
+
+    def expand(self):
+        self.check_size()
+        return list(self)
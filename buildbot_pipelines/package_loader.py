@@ -2,9 +2,295 @@
 Intended to be run from out-of-mainloop threads.
 
 Need to be threadsafe, as there is a strong possibility to have several builds starting at the same time
+
+Packages are resolved on an index: either a local directory of wheels, or a PEP 503 "simple"
+index url (file:// urls work too). Wheels are unpacked in an on-disk cache,
+in a directory named after the sha256 of the wheel, so a given wheel is downloaded and
+unpacked only once, whichever process asks for it first. The step plugins of a package are
+the 'buildbot.steps' entry points of its wheel.
+
+Only pure python wheels are supported, and the dependencies of the packages are not
+installed: they must already be available on the master. The packages are imported in the
+master process, so only one version of a package can be imported: asking for another one
+is an error.
+
+Trust model: importing a package runs its code in the master process, while the pipeline is
+parsed. Anyone who can push a pipeline can name any package of the index, so the index must
+only hold packages trusted as much as the master configuration. There is no default index:
+until one is configured, '!Imports' of a package is an error.
 """
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import importlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+
+from pkg_resources import parse_version
+
+from .errors import PipelineYmlInvalid
+
+try:
+    import configparser
+    from urllib.parse import urljoin, urlparse
+    from urllib.request import urlopen
+    from urllib.request import url2pathname
+except ImportError:  # python2
+    import ConfigParser as configparser
+    from urllib import url2pathname
+    from urllib2 import urlopen
+    from urlparse import urljoin, urlparse
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "buildbot_pipelines", "packages")
+# bumped when the layout of the cache changes
+CACHE_VERSION = "v1"
+ENTRY_POINT_GROUP = "buildbot.steps"
+
+WHEEL_RE = re.compile(
+    r"^(?P<name>[^-]+)-(?P<version>[^-]+)(-\d[^-]*)?-(?P<python>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$")
+LINK_RE = re.compile(r"""<a\s[^>]*href=["']([^"']+)["'][^>]*>""", re.IGNORECASE)
+
+
+class PackageImportError(PipelineYmlInvalid):
+    pass
+
+
+def normalize_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parse_requirement(package):
+    """'name' or 'name==version' -> (normalized name, version or None)"""
+    name, _, version = package.partition("==")
+    name = name.strip()
+    if not name or re.search(r"[^A-Za-z0-9._-]", name):
+        raise PackageImportError("unsupported package requirement: {}".format(package))
+    return normalize_name(name), version.strip() or None
+
+
+def compatible_wheel(filename):
+    """return (normalized name, version) if filename is a pure python wheel for this python"""
+    m = WHEEL_RE.match(filename)
+    if m is None or m.group('abi') != 'none' or m.group('platform') != 'any':
+        return None
+    pythons = m.group('python').split('.')
+    if not any(p in ('py{}'.format(sys.version_info[0]),
+                     'py{}{}'.format(*sys.version_info[:2])) for p in pythons):
+        return None
+    return normalize_name(m.group('name')), m.group('version')
+
+
+def best_wheel(candidates, version):
+    """candidates: list of (version, filename, location, sha256 or None)"""
+    if version is not None:
+        candidates = [c for c in candidates if c[0] == version]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: parse_version(c[0]))
+
+
+class DirectoryIndex(object):
+    """an index made of a local directory of wheels"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def find(self, name, version=None):
+        candidates = []
+        for filename in os.listdir(self.path):
+            wheel = compatible_wheel(filename)
+            if wheel is not None and wheel[0] == name:
+                candidates.append((wheel[1], filename, os.path.join(self.path, filename), None))
+        return best_wheel(candidates, version)
+
+    def open(self, location):
+        return open(location, 'rb')
+
+
+class SimpleIndex(object):
+    """a PEP 503 index, e.g. https://pypi.org/simple/ or a file:// tree for testing"""
+
+    def __init__(self, url):
+        if not url.endswith("/"):
+            url += "/"
+        self.url = url
+
+    def find(self, name, version=None):
+        page_url = urljoin(self.url, name + "/")
+        try:
+            page = self.open(page_url).read().decode('utf-8')
+        except (IOError, OSError) as e:
+            raise PackageImportError("cannot read {}: {}".format(page_url, e))
+        candidates = []
+        for href in LINK_RE.findall(page):
+            url, _, fragment = urljoin(page_url, href).partition("#")
+            wheel = compatible_wheel(url.rsplit("/", 1)[-1])
+            if wheel is None or wheel[0] != name:
+                continue
+            sha256 = fragment[len("sha256="):] if fragment.startswith("sha256=") else None
+            candidates.append((wheel[1], url.rsplit("/", 1)[-1], url, sha256))
+        return best_wheel(candidates, version)
+
+    def open(self, location):
+        if location.startswith("file:"):
+            path = url2pathname(urlparse(location).path)
+            if os.path.isdir(path):
+                path = os.path.join(path, "index.html")
+            return open(path, 'rb')
+        return urlopen(location)
+
+
+def makeIndex(index):
+    if index is None:
+        return None
+    if os.path.isdir(index):
+        return DirectoryIndex(index)
+    return SimpleIndex(index)
+
+
+class PackageLoader(object):
+
+    def __init__(self, index=None, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        @param index: directory of wheels, or url of a PEP 503 simple index, None to refuse
+                      all the imports
+        @param cache_dir: where the wheels are unpacked
+        """
+        self.index = makeIndex(index)
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), CACHE_VERSION)
+        # requirement -> tag -> step class
+        self._packages = {}
+        # normalized name -> version of the imported packages
+        self._versions = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _packageLock(self, name):
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def download(self, filename, location, sha256):
+        """download the wheel, and return (path of the temporary file, sha256)"""
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created concurrently by another process
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        fd, path = tempfile.mkstemp(suffix=".whl", dir=self.cache_dir)
+        h = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                src = self.index.open(location)
+                try:
+                    for chunk in iter(lambda: src.read(64 * 1024), b""):
+                        h.update(chunk)
+                        out.write(chunk)
+                finally:
+                    src.close()
+        except (IOError, OSError) as e:
+            os.unlink(path)
+            raise PackageImportError("cannot download {}: {}".format(location, e))
+        except Exception:
+            os.unlink(path)
+            raise
+        if sha256 is not None and h.hexdigest() != sha256:
+            os.unlink(path)
+            raise PackageImportError("sha256 mismatch for {}".format(filename))
+        return path, h.hexdigest()
+
+    def install(self, filename, location, sha256):
+        """return the directory where the wheel is unpacked, unpacking it if needed"""
+        if sha256 is not None:
+            target = os.path.join(self.cache_dir, sha256)
+            if os.path.isdir(target):
+                return target
+        wheel, sha256 = self.download(filename, location, sha256)
+        target = os.path.join(self.cache_dir, sha256)
+        try:
+            if os.path.isdir(target):
+                return target
+            tmp = tempfile.mkdtemp(prefix=sha256 + ".", dir=self.cache_dir)
+            with zipfile.ZipFile(wheel) as z:
+                z.extractall(tmp)
+            try:
+                os.rename(tmp, target)
+            except OSError:
+                # unpacked concurrently by another process
+                shutil.rmtree(tmp)
+                if not os.path.isdir(target):
+                    raise
+            return target
+        finally:
+            os.unlink(wheel)
+
+    def loadPlugins(self, path):
+        """return the tag -> step class map of the buildbot.steps entry points in path"""
+        entry_points = [os.path.join(path, d, "entry_points.txt") for d in os.listdir(path)
+                        if d.endswith(".dist-info")]
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        parser.read([f for f in entry_points if os.path.exists(f)])
+        if not parser.has_section(ENTRY_POINT_GROUP):
+            return {}
+        for _, target in parser.items(ENTRY_POINT_GROUP):
+            module = target.partition(":")[0].strip()
+            loaded = sys.modules.get(module.split(".")[0])
+            if loaded is not None and not os.path.abspath(
+                    getattr(loaded, '__file__', None) or '').startswith(os.path.abspath(path) + os.sep):
+                raise PackageImportError("cannot load {} from {}: another {} is already imported".format(
+                    module, path, loaded.__name__))
+        if path not in sys.path:
+            sys.path.append(path)
+        plugins = {}
+        for tag, target in parser.items(ENTRY_POINT_GROUP):
+            module, _, attr = target.partition(":")
+            try:
+                obj = importlib.import_module(module.strip())
+                for part in attr.strip().split("."):
+                    obj = getattr(obj, part)
+            except (ImportError, AttributeError) as e:
+                raise PackageImportError("cannot load step {} from {}: {}".format(tag, path, e))
+            plugins["!" + tag] = obj
+        return plugins
+
+    def importPackage(self, package):
+        """return the tag -> step class map of the package (blocking)"""
+        if package in self._packages:
+            return self._packages[package]
+        if self.index is None:
+            raise PackageImportError(
+                "cannot import {}: no package index is configured".format(package))
+        name, version = parse_requirement(package)
+        with self._packageLock(name):
+            if package not in self._packages:
+                found = self.index.find(name, version)
+                if found is None:
+                    raise PackageImportError("package {} not found".format(package))
+                found_version, filename, location, sha256 = found
+                imported = self._versions.get(name)
+                if imported is not None and imported != found_version:
+                    raise PackageImportError("cannot import {}: version {} is already imported".format(
+                        package, imported))
+                path = self.install(filename, location, sha256)
+                self._packages[package] = self.loadPlugins(path)
+                self._versions[name] = found_version
+        return self._packages[package]
+
+
+package_loader = PackageLoader()
+
+
+def configure(index=None, cache_dir=DEFAULT_CACHE_DIR):
+    global package_loader
+    package_loader = PackageLoader(index, cache_dir)
 
 
 def import_package(package):
-    #  @TODO
-    return {}
+    return package_loader.importPackage(package)
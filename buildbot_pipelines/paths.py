@@ -0,0 +1,90 @@
+"""Path filters of the stages
+
+A stage with 'paths:' only runs when one of the changed files matches one of the globs, a
+stage with 'paths_ignore:' only runs when one of the changed files does not match any of
+them. Both can be combined. When the changes carry no file list, the stages always run.
+
+Globs match the whole path: '*' and '?' do not match '/', '**' matches any number of
+directories. All the globs of a filter are compiled once, in a single regular expression, so
+a changed file is checked with one match whatever the number of globs.
+"""
+from __future__ import absolute_import, division, print_function
+
+import re
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+
+def glob_to_regex(glob):
+    res = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        if glob.startswith('**/', i):
+            res.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            res.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            # like fnmatch, a ']' right after '[' or '[!' is part of the class
+            j = i + 1
+            if glob.startswith('!', j):
+                j += 1
+            if glob.startswith(']', j):
+                j += 1
+            end = glob.find(']', j)
+            if end < 0:
+                raise PipelineYmlInvalid("unterminated character class in path glob {!r}".format(glob))
+            chars = glob[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith(('^', '[')):
+                chars = '\\' + chars
+            res.append('[' + chars + ']')
+            i = end
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+
+def compile_globs(globs, what):
+    if not isinstance(globs, list) or any(isinstance(g, (list, dict)) for g in globs):
+        raise PipelineYmlInvalid("{} must be a list of globs".format(what))
+    if not globs:
+        return None
+    try:
+        return re.compile('(?:{})\\Z'.format('|'.join(glob_to_regex(str(g)) for g in globs)))
+    except re.error as e:
+        raise PipelineYmlInvalid("invalid glob in {}: {}".format(what, e))
+
+
+class PathFilter(object):
+
+    def __init__(self, paths=None, paths_ignore=None, stage=None):
+        self.paths = None
+        self.paths_ignore = None
+        if paths is not None:
+            self.paths = compile_globs(paths, "paths of stage {}".format(stage))
+        if paths_ignore is not None:
+            self.paths_ignore = compile_globs(paths_ignore, "paths_ignore of stage {}".format(stage))
+
+    def relevant(self, path):
+        if self.paths is not None and not self.paths.match(path):
+            return False
+        if self.paths_ignore is not None and self.paths_ignore.match(path):
+            return False
+        return True
+
+    def matches(self, files):
+        """is one of the files relevant, None meaning unknown files"""
+        if files is None:
+            return True
+        return any(self.relevant(f) for f in files)
@@ -0,0 +1,127 @@
+"""Master-wide cache of parsed pipelines
+
+The spawner and every runner of a pipeline work on the very same yaml text, so
+parsed PipelineYml objects are kept in a LRU cache keyed by the digest of that text.
+
+The cache is bounded by the total size of the cached yaml texts, which is a good
+enough proxy of the memory used by the parsed objects.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import threading
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from buildbot_pipelines.threads import deferToPipelineThread
+from buildbot_pipelines.yaml_loader import PipelineYml, pipeline_digest
+
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+
+class PipelineCache(object):
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # digest -> list of deferreds waiting for a parse in progress
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, digest):
+        return digest in self._entries
+
+    def get(self, digest):
+        """return the cached pipeline for this digest, or None"""
+        with self._lock:
+            pipeline = self._entries.pop(digest, None)
+            if pipeline is None:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[digest] = pipeline
+            self.hits += 1
+            return pipeline
+
+    def put(self, pipeline):
+        weight = len(pipeline.yaml_text)
+        if weight > self.max_size:
+            # would evict everything else for a single entry
+            return
+        with self._lock:
+            old = self._entries.pop(pipeline.digest, None)
+            if old is not None:
+                self.size -= len(old.yaml_text)
+            self._entries[pipeline.digest] = pipeline
+            self.size += weight
+            self._evict()
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            _, pipeline = self._entries.popitem(last=False)
+            self.size -= len(pipeline.yaml_text)
+            self.evictions += 1
+
+    def getPipeline(self, yaml_text):
+        """return the parsed pipeline for this yaml text, parsing it only on cache miss"""
+        pipeline = self.get(pipeline_digest(yaml_text))
+        if pipeline is None:
+            pipeline = PipelineYml(yaml_text)
+            self.put(pipeline)
+        return pipeline
+
+    def loadPipeline(self, yaml_text):
+        """same as getPipeline, but parses on the pipeline thread pool
+
+        concurrent loads of the same text share a single parse
+        """
+        digest = pipeline_digest(yaml_text)
+        pipeline = self.get(digest)
+        if pipeline is not None:
+            return defer.succeed(pipeline)
+        return self.parsePipeline(yaml_text)
+
+    def parsePipeline(self, yaml_text):
+        """parse the yaml text on the pipeline thread pool, and cache the result"""
+        digest = pipeline_digest(yaml_text)
+        if digest in self._loading:
+            d = defer.Deferred()
+            self._loading[digest].append(d)
+            return d
+        waiters = self._loading[digest] = []
+
+        def loaded(result):
+            del self._loading[digest]
+            if not isinstance(result, failure.Failure):
+                self.put(result)
+            for d in waiters:
+                d.callback(result)
+            return result
+        d = deferToPipelineThread(PipelineYml, yaml_text)
+        d.addBoth(loaded)
+        return d
+
+    def getStats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self._entries), size=self.size, max_size=self.max_size)
+
+
+pipeline_cache = PipelineCache()
@@ -0,0 +1,70 @@
+"""Content addressed storage of pipeline texts
+
+Each distinct pipeline text is stored only once in the master's state table, keyed by its
+digest. Buildrequests only carry the digest in their 'yaml_digest' property, and runners
+resolve it through the parsed pipeline cache.
+"""
+from __future__ import absolute_import, division, print_function
+
+import weakref
+
+from twisted.internet import defer
+
+from buildbot_pipelines.pipeline_cache import pipeline_cache
+from buildbot_pipelines.yaml_loader import PipelineYmlInvalid
+
+# number of digests remembered as already stored before hitting the db again
+MAX_KNOWN_DIGESTS = 10000
+
+
+class PipelineStore(object):
+
+    def __init__(self, master):
+        self.master = master
+        self._objectid = None
+        self._stored = set()
+
+    @defer.inlineCallbacks
+    def getObjectId(self):
+        if self._objectid is None:
+            self._objectid = yield self.master.db.state.getObjectId(
+                'buildbot_pipelines', 'PipelineStore')
+        defer.returnValue(self._objectid)
+
+    @defer.inlineCallbacks
+    def putPipeline(self, pipeline):
+        """store the pipeline text, if not already stored. return its digest"""
+        if pipeline.digest not in self._stored:
+            objectid = yield self.getObjectId()
+            known = yield self.master.db.state.getState(objectid, pipeline.digest, None)
+            if known is None:
+                yield self.master.db.state.setState(objectid, pipeline.digest, pipeline.yaml_text)
+            if len(self._stored) >= MAX_KNOWN_DIGESTS:
+                self._stored.clear()
+            self._stored.add(pipeline.digest)
+        defer.returnValue(pipeline.digest)
+
+    @defer.inlineCallbacks
+    def getPipelineText(self, digest):
+        objectid = yield self.getObjectId()
+        yaml_text = yield self.master.db.state.getState(objectid, digest, None)
+        if yaml_text is None:
+            raise PipelineYmlInvalid("unknown pipeline digest: {}".format(digest))
+        defer.returnValue(yaml_text)
+
+    @defer.inlineCallbacks
+    def loadPipeline(self, digest):
+        pipeline = pipeline_cache.get(digest)
+        if pipeline is None:
+            yaml_text = yield self.getPipelineText(digest)
+            pipeline = yield pipeline_cache.parsePipeline(yaml_text)
+        defer.returnValue(pipeline)
+
+
+_stores = weakref.WeakKeyDictionary()
+
+
+def getPipelineStore(master):
+    if master not in _stores:
+        _stores[master] = PipelineStore(master)
+    return _stores[master]
@@ -0,0 +1,113 @@
+"""Master side tracking of the pipelines spawned in detached mode
+
+In detached mode, the spawner build only computes the stages and hands them over to the
+tracker, so it finishes, and releases its worker, right away. The tracker follows the
+completion of the buildsets of each stage, triggers the next stages, and reports the
+aggregate result of the pipeline once all stages are done.
+
+The spawner build succeeds whatever the stages do: once the pipeline is done, its aggregate
+result is set as the 'pipeline_results' property and in the state string of the spawner
+build, but the reporters which only look at the build results do not see it.
+
+Tracking is in memory: the stages of a pipeline in progress are not resumed after a master
+restart.
+"""
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.process.results import SKIPPED, SUCCESS, statusToString, worst_status
+from buildbot.util import service
+
+from buildbot_pipelines.stages import StageTriggerer
+
+PIPELINE_TRACKER = "__pipeline_tracker"
+
+
+def getPipelineTracker(master):
+    """return the tracker service of this master, or None if detached mode is not configured"""
+    return master.service_manager.namedServices.get(PIPELINE_TRACKER)
+
+
+def aggregateResults(graph, results):
+    overall = SUCCESS
+    for stage in graph.stages:
+        if results.get(stage) != SKIPPED:
+            overall = worst_status(overall, results.get(stage, SUCCESS))
+    return overall
+
+
+class PipelineTracker(service.BuildbotService):
+
+    name = PIPELINE_TRACKER
+
+    def __init__(self, **kwargs):
+        # spawner buildid -> StageTriggerer, kept across reconfigs
+        self.pipelines = {}
+        self.consumer = None
+        service.BuildbotService.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        if self.consumer is None:
+            # pipelines superseded by the spawner builds of any master
+            self.consumer = yield self.master.mq.startConsuming(
+                self.cancelRequested, ("pipelines", None, "cancel"))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self.consumer is not None:
+            self.consumer.stopConsuming()
+            self.consumer = None
+        yield service.BuildbotService.stopService(self)
+
+    def cancelRequested(self, routing_key, message):
+        self.cancelPipeline(int(routing_key[1]), message['reason'])
+
+    def makeTriggerer(self, buildid, sourcestamps):
+        return StageTriggerer(self.master, sourcestamps, parent_buildid=buildid,
+                              addLog=lambda message: log.msg(
+                                  "pipeline of build {}: {}".format(buildid, message)))
+
+    def trackPipeline(self, buildid, sourcestamps, triggers, graph):
+        """run the stages of the pipeline spawned by build buildid
+
+        returns a deferred firing with the aggregate result, once all stages are done"""
+        triggerer = self.pipelines[buildid] = self.makeTriggerer(buildid, sourcestamps)
+        d = triggerer.runStages(triggers, graph)
+
+        @d.addBoth
+        def untrack(res):
+            del self.pipelines[buildid]
+            return res
+        d.addCallback(lambda results: self.pipelineFinished(buildid, graph, results))
+
+        @d.addErrback
+        def failed(f):
+            # nobody waits for the pipeline: the error stops here
+            log.err(f, "while running the pipeline of build {}".format(buildid))
+            return None
+        return d
+
+    @defer.inlineCallbacks
+    def pipelineFinished(self, buildid, graph, results):
+        overall = aggregateResults(graph, results)
+        log.msg("pipeline of build {} finished: {}".format(buildid, statusToString(overall)))
+        # make the result visible on the spawner build, which finished long ago
+        yield self.master.data.updates.setBuildProperty(
+            buildid, 'pipeline_results', overall, 'PipelineTracker')
+        yield self.master.data.updates.setBuildStateString(
+            buildid, u"pipeline {}".format(statusToString(overall)))
+        self.master.mq.produce(("pipelines", str(buildid), "finished"), {
+            'buildid': buildid,
+            'results': overall,
+            'stages': dict(results)})
+        defer.returnValue(overall)
+
+    def cancelPipeline(self, buildid, reason):
+        """cancel the buildrequests of a tracked pipeline, and do not start its other stages"""
+        triggerer = self.pipelines.get(buildid)
+        if triggerer is not None:
+            triggerer.cancel(reason)
@@ -0,0 +1,66 @@
+"""Branch routing table of a pipeline
+
+The 'branches' section maps branch regular expressions (matched from the start of the
+branch name) to stages, the first matching pattern wins. Patterns are compiled once per
+parsed pipeline, and exact branch names which are also literal patterns are resolved at
+compile time, so that the most common lookups are a single dict access.
+"""
+from __future__ import absolute_import, division, print_function
+
+import re
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+def is_literal(pattern):
+    return not REGEX_SPECIAL_CHARS.intersection(pattern)
+
+
+class BranchRouter(object):
+
+    def __init__(self, branches):
+        if not isinstance(branches, dict):
+            raise PipelineYmlInvalid("'branches' must be a mapping of branch patterns")
+        self.routes = []
+        for pattern, stages in branches.items():
+            pattern = str(pattern)
+            if not isinstance(stages, (list, dict)):
+                raise PipelineYmlInvalid(
+                    "stages of branch {!r} must be a list or a mapping of events".format(pattern))
+            if is_literal(pattern):
+                match = self._literal_matcher(pattern)
+            else:
+                try:
+                    match = re.compile(pattern).match
+                except re.error as e:
+                    raise PipelineYmlInvalid(
+                        "invalid branch pattern {!r}: {}".format(pattern, e))
+            self.routes.append((pattern, match, stages))
+
+        # exact branch names, with the stages of the first route that matches them
+        self.literals = {}
+        for pattern, _, _ in self.routes:
+            if is_literal(pattern) and pattern not in self.literals:
+                self.literals[pattern] = self._scan(pattern)
+
+    @staticmethod
+    def _literal_matcher(pattern):
+        def match(branch):
+            return branch.startswith(pattern)
+        return match
+
+    def _scan(self, branch):
+        for _, match, stages in self.routes:
+            if match(branch):
+                return stages
+        return []
+
+    def match(self, branch):
+        if branch is None:
+            branch = ""
+        try:
+            return self.literals[branch]
+        except KeyError:
+            return self._scan(branch)
@@ -1,7 +1,10 @@
+import collections
+
 from twisted.internet import defer
 from twisted.python import log
 
 from buildbot.changes import changes
+from buildbot.process.metrics import MetricCountEvent
 from buildbot.process.properties import Properties
 from buildbot.schedulers.basic import AnyBranchScheduler
 
@@ -13,6 +16,58 @@ from buildbot.schedulers.basic import AnyBranchScheduler
 
 class AnyCodeBaseScheduler(AnyBranchScheduler):
 
+    compare_attrs = AnyBranchScheduler.compare_attrs + ('debounce',)
+
+    # number of changes fetched concurrently from the db
+    CHANGE_FETCH_CHUNK = 50
+    # number of change dicts loaded by _changeCallback remembered for addBuildsetForChanges
+    RECENT_CHANGES = 1000
+
+    def __init__(self, name, debounce=None, **kwargs):
+        """
+        @param debounce: if set, changes for the same (codebase, branch, category) received
+                         within this number of seconds are merged, and only the newest one
+                         creates a buildset. The files of the older ones are given to the
+                         build in the 'merged_files' property, None if one of them does not
+                         list its files.
+        """
+        AnyBranchScheduler.__init__(self, name, **kwargs)
+        self.debounce = debounce
+        self._recent_chdicts = collections.OrderedDict()
+        # (codebase, branch, category) -> pending changes
+        self._pending_changes = {}
+        # changeid of a newest change -> files of the changes merged into it
+        self._merged_files = collections.OrderedDict()
+        self._debounce_timers = {}
+        self.merged_changes = 0
+
+    def rememberChange(self, chdict):
+        self._recent_chdicts[chdict['changeid']] = chdict
+        while len(self._recent_chdicts) > self.RECENT_CHANGES:
+            self._recent_chdicts.popitem(last=False)
+
+    @defer.inlineCallbacks
+    def getChanges(self, changeids):
+        """return the change dicts for changeids, in order
+
+        recently seen changes are not fetched again, and the other ones are fetched
+        concurrently, by chunks"""
+        chdicts = {}
+        missing = []
+        for changeid in changeids:
+            if changeid in self._recent_chdicts:
+                chdicts[changeid] = self._recent_chdicts[changeid]
+            elif changeid not in missing:
+                missing.append(changeid)
+        for i in range(0, len(missing), self.CHANGE_FETCH_CHUNK):
+            chunk = missing[i:i + self.CHANGE_FETCH_CHUNK]
+            results = yield defer.gatherResults(
+                [self.master.db.changes.getChange(changeid) for changeid in chunk],
+                consumeErrors=True)
+            chdicts.update(zip(chunk, results))
+        defer.returnValue([chdicts[changeid] for changeid in changeids
+                           if chdicts[changeid] is not None])
+
     @defer.inlineCallbacks
     def _changeCallback(self, key, msg, fileIsImportant, change_filter,
                         onlyImportant):
@@ -30,13 +85,59 @@ class AnyCodeBaseScheduler(AnyBranchScheduler):
             return
         if change.codebase not in self.codebases:
             self.codebases[change.codebase] = {}
+        self.rememberChange(chdict)
+
+        if self.debounce:
+            self.debounceChange(change)
+        else:
+            self.processChange(change)
 
+    def processChange(self, change):
         # use change_consumption_lock to ensure the service does not stop
         # while this change is being processed
         d = self._change_consumption_lock.run(
             self.gotChange, change, True)
         d.addErrback(log.err, 'while processing change')
 
+    def debounceChange(self, change):
+        key = (change.codebase, change.branch, change.category)
+        pending = self._pending_changes.get(key)
+        if pending is None:
+            self._pending_changes[key] = [change]
+            self._debounce_timers[key] = self._reactor.callLater(
+                self.debounce, self.flushChanges, key)
+            return
+        pending.append(change)
+        self.merged_changes += 1
+        MetricCountEvent.log('AnyCodeBaseScheduler.merged_changes', 1)
+
+    def flushChanges(self, key):
+        timer = self._debounce_timers.pop(key)
+        if timer.active():
+            timer.cancel()
+        pending = self._pending_changes.pop(key)
+        newest = max(pending, key=lambda change: change.number)
+        if len(pending) > 1:
+            files = set()
+            for change in pending:
+                if change is newest:
+                    continue
+                if not change.files:
+                    files = None
+                    break
+                files.update(change.files)
+            self._merged_files[newest.number] = sorted(files) if files is not None else None
+            while len(self._merged_files) > self.RECENT_CHANGES:
+                self._merged_files.popitem(last=False)
+        self.processChange(newest)
+
+    @defer.inlineCallbacks
+    def deactivate(self):
+        # do not lose the changes waiting for their debounce window
+        for key in list(self._debounce_timers):
+            self.flushChanges(key)
+        yield AnyBranchScheduler.deactivate(self)
+
     @defer.inlineCallbacks
     def addBuildsetForChanges(self, waited_for=False, reason='',
                               external_idstring=None, changeids=None, builderNames=None,
@@ -50,8 +151,8 @@ class AnyCodeBaseScheduler(AnyBranchScheduler):
             return max(changesByCodebase[codebase], key=lambda change: change["changeid"])
 
         # Changes are retrieved from database and grouped by their codebase
-        for changeid in changeids:
-            chdict = yield self.master.db.changes.getChange(changeid)
+        chdicts = yield self.getChanges(changeids)
+        for chdict in chdicts:
             changesByCodebase.setdefault(chdict["codebase"], []).append(chdict)
 
         sourcestamps = []
@@ -70,6 +171,11 @@ class AnyCodeBaseScheduler(AnyBranchScheduler):
             properties = Properties()
         properties.setProperty("virtual_builder_name", lastChange['codebase'] + '-' + lastChange['category'], 'scheduler')
         properties.setProperty("virtual_builder_tags", [lastChange['codebase'], lastChange['category']], 'scheduler')
+        merged = [self._merged_files.pop(changeid) for changeid in changeids
+                  if changeid in self._merged_files]
+        if merged:
+            files = None if None in merged else sorted(set().union(*merged))
+            properties.setProperty("merged_files", files, 'scheduler')
         # add one buildset, using the calculated sourcestamps
         bsid, brids = yield self.addBuildsetForSourceStamps(
             waited_for, sourcestamps=sourcestamps, reason=reason,
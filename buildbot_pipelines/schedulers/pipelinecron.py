@@ -0,0 +1,286 @@
+"""Runs the 'crons:' entries of the pipelines
+
+The spawner builds tell the service about the pipeline of each (repository, codebase, branch)
+they see. A cron entry declared in the pipeline of a branch builds that branch, when the
+branch is listed in the 'branches' of the entry. Its stages are triggered directly on the
+runner scheduler, at the head of the branch, without any spawner build.
+
+The next fire times of all entries are kept in a single heap, so that one timer serves any
+number of entries. Crons are compiled once per pipeline digest, and the known pipelines are
+kept in the state table, one row per branch, so that they survive master restarts.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import heapq
+import itertools
+import json
+
+import sqlalchemy as sa
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from buildbot.process.results import statusToString
+from buildbot.util import service
+
+from buildbot_pipelines.pipeline_store import getPipelineStore
+from buildbot_pipelines.stages import StageTriggerer
+from buildbot_pipelines.yaml_loader import PipelineYmlInvalid
+
+PIPELINE_CRON = "__pipeline_cron"
+SOURCE_PREFIX = "source-"
+
+
+def getPipelineCron(master):
+    """return the cron service of this master, or None if crons are not configured"""
+    return master.service_manager.namedServices.get(PIPELINE_CRON)
+
+
+class CronEntry(object):
+
+    def __init__(self, source, pipeline, cron):
+        """
+        @param source: dict with the repository, codebase, project and branch of the pipeline
+        """
+        self.source = source
+        self.pipeline = pipeline
+        self.cron = cron
+
+    @property
+    def key(self):
+        return (self.source['repository'], self.source['codebase'], self.source['branch'],
+                self.cron.name)
+
+
+class PipelineCronService(service.ClusteredBuildbotService):
+    """runs on all masters, but only the one which claims it fires the crons
+
+    Every master keeps the sources up to date, as the spawner builds of any master can
+    see a new pipeline: the changes are stored in the state table, and announced on the
+    ('pipeline_crons', <state name>, 'changed') mq topic.
+    """
+
+    name = PIPELINE_CRON
+    _reactor = reactor
+
+    def __init__(self, **kwargs):
+        # (repository, codebase, branch) -> source dict, with the pipeline digest
+        self.sources = {}
+        # entry key -> CronEntry, on the active master only
+        self.entries = {}
+        # (fire time, sequence, entry key, entry)
+        self.heap = []
+        self.sequence = itertools.count()
+        self.timer = None
+        # entry keys of the crons being run
+        self.running = set()
+        self.consumer = None
+        service.ClusteredBuildbotService.__init__(self, **kwargs)
+
+    # like the schedulers, the service is claimed through the schedulers table
+    def _getServiceId(self):
+        return self.master.data.updates.findSchedulerId(self.name)
+
+    def _claimService(self):
+        return self.master.data.updates.trySetSchedulerMaster(self.serviceid, self.master.masterid)
+
+    def _unclaimService(self):
+        return self.master.data.updates.trySetSchedulerMaster(self.serviceid, None)
+
+    @defer.inlineCallbacks
+    def getObjectId(self):
+        objectid = yield self.master.db.state.getObjectId('buildbot_pipelines', 'PipelineCron')
+        defer.returnValue(objectid)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        if self.consumer is None:
+            self.consumer = yield self.master.mq.startConsuming(
+                self.sourceChanged, ('pipeline_crons', None, 'changed'))
+            yield self.loadSources()
+        yield service.ClusteredBuildbotService.startService(self)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield service.ClusteredBuildbotService.stopService(self)
+        if self.consumer is not None:
+            self.consumer.stopConsuming()
+            self.consumer = None
+
+    @defer.inlineCallbacks
+    def activate(self):
+        for source in list(self.sources.values()):
+            yield self.scheduleSource(source)
+
+    def deactivate(self):
+        self.entries = {}
+        self.heap = []
+        self.reschedule()
+        return defer.succeed(None)
+
+    @staticmethod
+    def stateName(key):
+        """name of the state row of a (repository, codebase, branch)"""
+        return SOURCE_PREFIX + hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+    @defer.inlineCallbacks
+    def getSavedSources(self):
+        objectid = yield self.getObjectId()
+        object_state = self.master.db.model.object_state
+
+        def thd(conn):
+            q = sa.select([object_state.c.value_json],
+                          whereclause=(object_state.c.objectid == objectid) &
+                          object_state.c.name.startswith(SOURCE_PREFIX))
+            return [json.loads(row.value_json) for row in conn.execute(q)]
+        sources = yield self.master.db.pool.do(thd)
+        defer.returnValue(sources)
+
+    @defer.inlineCallbacks
+    def saveSource(self, key, source):
+        """store the source of a branch, or forget it if source is None"""
+        objectid = yield self.getObjectId()
+        name = self.stateName(key)
+        if source is not None:
+            yield self.master.db.state.setState(objectid, name, source)
+            return
+        object_state = self.master.db.model.object_state
+
+        def thd(conn):
+            conn.execute(object_state.delete().where(
+                (object_state.c.objectid == objectid) & (object_state.c.name == name)))
+        yield self.master.db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def loadSources(self):
+        sources = yield self.getSavedSources()
+        for source in sources:
+            yield self.setSource(source)
+
+    @defer.inlineCallbacks
+    def pipelineSeen(self, repository, codebase, project, branch, pipeline):
+        """called by the spawner builds, with the current pipeline of a branch"""
+        key = (repository, codebase, branch)
+        if key in self.sources and self.sources[key]['digest'] == pipeline.digest:
+            return
+        if key not in self.sources and not pipeline.crons:
+            return
+        # the digest is None when the branch has no crons anymore
+        source = dict(repository=repository, codebase=codebase, project=project, branch=branch,
+                      digest=pipeline.digest if pipeline.crons else None)
+        if pipeline.crons:
+            yield getPipelineStore(self.master).putPipeline(pipeline)
+        yield self.saveSource(key, source if pipeline.crons else None)
+        self.setPipeline(source, pipeline)
+        self.master.mq.produce(('pipeline_crons', self.stateName(key), 'changed'), source)
+
+    @defer.inlineCallbacks
+    def sourceChanged(self, routing_key, source):
+        key = (source['repository'], source['codebase'], source['branch'])
+        if self.sources.get(key, {}).get('digest') != source['digest']:
+            yield self.setSource(source)
+
+    @defer.inlineCallbacks
+    def setSource(self, source):
+        key = (source['repository'], source['codebase'], source['branch'])
+        if source['digest'] is None:
+            self.sources.pop(key, None)
+            self.setPipeline(source, None)
+            return
+        self.sources[key] = source
+        if self.active:
+            yield self.scheduleSource(source)
+
+    @defer.inlineCallbacks
+    def scheduleSource(self, source):
+        try:
+            pipeline = yield getPipelineStore(self.master).loadPipeline(source['digest'])
+        except PipelineYmlInvalid as e:
+            log.msg("ignoring the crons of {}: {}".format(source['repository'], e))
+            return
+        # the source may have changed while the pipeline was loading
+        key = (source['repository'], source['codebase'], source['branch'])
+        if self.sources.get(key) is source:
+            self.setPipeline(source, pipeline)
+
+    def setPipeline(self, source, pipeline):
+        """update the entries of a source, pipeline is None if it has no crons anymore"""
+        key = (source['repository'], source['codebase'], source['branch'])
+        for entry_key in [k for k in self.entries if k[:3] == key]:
+            del self.entries[entry_key]
+        crons = pipeline.crons if pipeline is not None else []
+        if crons:
+            self.sources[key] = source
+        else:
+            self.sources.pop(key, None)
+        if self.active:
+            now = self._reactor.seconds()
+            for cron in crons:
+                if source['branch'] in cron.branches:
+                    entry = CronEntry(source, pipeline, cron)
+                    self.entries[entry.key] = entry
+                    self.push(entry, now)
+        self.reschedule()
+
+    def push(self, entry, after):
+        when = entry.cron.next_fire(after)
+        if when is not None:
+            heapq.heappush(self.heap, (when, next(self.sequence), entry.key, entry))
+
+    def isStale(self, item):
+        # entries replaced by a newer pipeline are left in the heap, and dropped here
+        return self.entries.get(item[2]) is not item[3]
+
+    def reschedule(self):
+        while self.heap and self.isStale(self.heap[0]):
+            heapq.heappop(self.heap)
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if self.heap:
+            delay = max(0, self.heap[0][0] - self._reactor.seconds())
+            self.timer = self._reactor.callLater(delay, self.fire)
+
+    def fire(self):
+        self.timer = None
+        now = self._reactor.seconds()
+        while self.heap and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            if self.isStale(item):
+                continue
+            entry = item[3]
+            self.runEntry(entry)
+            self.push(entry, now)
+        self.reschedule()
+
+    def runEntry(self, entry):
+        if entry.key in self.running:
+            log.msg("cron {} of {} {} is still running, skipped".format(
+                entry.cron.name, entry.source['repository'], entry.source['branch']))
+            return None
+        source = entry.source
+        try:
+            triggers = entry.pipeline.generate_triggers(
+                source['codebase'], source['branch'], "cron", stages=entry.cron.stages)
+            graph = entry.pipeline.stage_graph(triggers)
+        except PipelineYmlInvalid as e:
+            log.msg("cron {} of {} is invalid: {}".format(entry.cron.name, source['repository'], e))
+            return None
+        sourcestamps = [dict(codebase=source['codebase'], repository=source['repository'],
+                             project=source['project'], branch=source['branch'],
+                             revision=None)]
+        description = "cron {} of {} {}".format(entry.cron.name, source['repository'], source['branch'])
+        triggerer = StageTriggerer(self.master, sourcestamps, addLog=lambda message: log.msg(
+            "{}: {}".format(description, message)))
+        self.running.add(entry.key)
+        d = triggerer.runStages(triggers, graph)
+
+        @d.addBoth
+        def done(results):
+            self.running.discard(entry.key)
+            if isinstance(results, dict):
+                log.msg("{} finished: {}".format(description, ", ".join(
+                    "{} {}".format(stage, statusToString(res)) for stage, res in sorted(results.items()))))
+            else:
+                log.err(results, description)
+        return d
@@ -0,0 +1,263 @@
+"""Schema of the pipeline documents
+
+The schema is a tree of small validator objects, compiled once at import. Each validator
+checks a value, and reports errors with the path of the value in the document and its
+location in the yaml text, recorded by the loader. Keys which are not described are
+allowed, so that pipelines can hold extra data, like the '!Imports' of 'modules:'.
+
+The validation of a document only depends on its text, so verdicts are cached per pipeline
+digest: a pipeline parsed again, e.g. after being evicted from the pipeline cache, is not
+validated twice.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import threading
+
+from buildbot.interfaces import IRenderable
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+from buildbot_pipelines.matrix import Matrix, MatrixTooLarge
+
+DEFAULT_MAX_STEPS = 500
+MAX_CACHED_VERDICTS = 10000
+
+SCALARS = (str, type(u''), int, float, bool, type(None))
+
+
+class SchemaInvalid(PipelineYmlInvalid):
+
+    def __init__(self, message, path=(), line=None, column=None):
+        self.reason = message
+        self.path = path
+        self.line, self.column = line, column
+        location = ".".join(str(p) for p in path) or "document"
+        if line is not None:
+            location += " (line {}, column {})".format(line, column)
+        PipelineYmlInvalid.__init__(self, "{}: {}".format(location, message))
+
+
+class Context(object):
+    """what the validators need to know about the document being validated"""
+
+    def __init__(self, marks, max_matrix_cells, max_steps):
+        self.marks = marks or {}
+        self.max_matrix_cells = max_matrix_cells
+        self.max_steps = max_steps
+
+    def fail(self, message, path, parent, key):
+        mark = self.marks.get((id(parent), key))
+        if mark is None:
+            raise SchemaInvalid(message, path)
+        raise SchemaInvalid(message, path, mark.line + 1, mark.column + 1)
+
+
+def type_name(value):
+    if isinstance(value, dict):
+        return "mapping"
+    if isinstance(value, list):
+        return "list"
+    return type(value).__name__
+
+
+class Validator(object):
+    description = plural = "anything"
+
+    def check(self, ctx, value, path, parent, key):
+        pass
+
+    def __call__(self, ctx, value, path=(), parent=None, key=None):
+        self.check(ctx, value, path, parent, key)
+
+
+class OfType(Validator):
+
+    def __init__(self, types, description, plural):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.description = description
+        self.plural = plural
+
+    def check(self, ctx, value, path, parent, key):
+        if not isinstance(value, self.types) or (
+                isinstance(value, bool) and bool not in self.types and int in self.types):
+            ctx.fail("expected {}, got {}".format(self.description, type_name(value)),
+                     path, parent, key)
+
+
+class Scalar(Validator):
+    """a plain value, or a renderable like !Interpolate"""
+    description = "a scalar"
+    plural = "scalars"
+
+    def check(self, ctx, value, path, parent, key):
+        if not isinstance(value, SCALARS) and not IRenderable.providedBy(value):
+            ctx.fail("expected a scalar, got {}".format(type_name(value)), path, parent, key)
+
+
+class PositiveInt(OfType):
+
+    def __init__(self):
+        OfType.__init__(self, int, "a positive integer", "positive integers")
+
+    def check(self, ctx, value, path, parent, key):
+        OfType.check(self, ctx, value, path, parent, key)
+        if value < 1:
+            ctx.fail("expected a positive integer, got {}".format(value), path, parent, key)
+
+
+class ListOf(Validator):
+
+    def __init__(self, item, max_length=None, non_empty=False):
+        self.item = item
+        self.max_length = max_length
+        self.non_empty = non_empty
+        self.description = "a list of {}".format(item.plural)
+        self.plural = "lists of {}".format(item.plural)
+
+    def check(self, ctx, value, path, parent, key):
+        if not isinstance(value, list):
+            ctx.fail("expected {}, got {}".format(self.description, type_name(value)),
+                     path, parent, key)
+        if self.non_empty and not value:
+            ctx.fail("must not be empty", path, parent, key)
+        max_length = self.max_length(ctx) if callable(self.max_length) else self.max_length
+        if max_length is not None and len(value) > max_length:
+            ctx.fail("has {} items, more than the maximum of {}".format(len(value), max_length),
+                     path, parent, key)
+        for i, item in enumerate(value):
+            self.item(ctx, item, path + (i,), value, i)
+
+
+class MappingOf(Validator):
+    """a mapping with free keys, all values validated by the same validator"""
+
+    def __init__(self, value):
+        self.value = value
+        self.description = "a mapping of {}".format(value.plural)
+        self.plural = "mappings of {}".format(value.plural)
+
+    def check(self, ctx, value, path, parent, key):
+        if not isinstance(value, dict):
+            ctx.fail("expected {}, got {}".format(self.description, type_name(value)),
+                     path, parent, key)
+        for k, v in value.items():
+            self.value(ctx, v, path + (k,), value, k)
+
+
+class Mapping(Validator):
+    """a mapping with known keys, each one with its own validator"""
+    description = "a mapping"
+    plural = "mappings"
+
+    def __init__(self, fields, check=None):
+        self.fields = fields
+        self.extra_check = check
+
+    def check(self, ctx, value, path, parent, key):
+        if not isinstance(value, dict):
+            ctx.fail("expected a mapping, got {}".format(type_name(value)), path, parent, key)
+        for k, validator in self.fields.items():
+            if k in value:
+                validator(ctx, value[k], path + (k,), value, k)
+        if self.extra_check is not None:
+            self.extra_check(ctx, value, path, parent, key)
+
+
+class OneOf(Validator):
+
+    def __init__(self, *validators):
+        self.validators = validators
+        self.description = " or ".join(v.description for v in validators)
+        self.plural = " or ".join(v.plural for v in validators)
+
+    def check(self, ctx, value, path, parent, key):
+        # picked on the type of the value, so that errors come from the nested validator
+        for validator in self.validators:
+            if isinstance(validator, ListOf) and isinstance(value, list) or \
+                    isinstance(validator, (Mapping, MappingOf)) and isinstance(value, dict) or \
+                    isinstance(validator, OfType) and isinstance(value, validator.types):
+                return validator(ctx, value, path, parent, key)
+        ctx.fail("expected {}, got {}".format(self.description, type_name(value)),
+                 path, parent, key)
+
+
+def check_matrix_size(ctx, stage, path, parent, key):
+    matrix = Matrix(stage.get('matrix', {}), stage.get('matrix_include', []),
+                    stage.get('matrix_exclude', []), ctx.max_matrix_cells)
+    try:
+        matrix.check_size()
+    except MatrixTooLarge as e:
+        ctx.fail(str(e), path + ('matrix',), stage, 'matrix')
+
+
+String = OfType((str, type(u'')), "a string", "strings")
+Bool = OfType(bool, "a boolean", "booleans")
+StageNames = ListOf(String)
+Globs = ListOf(String)
+Env = MappingOf(Scalar())
+MatrixCell = MappingOf(Scalar())
+
+STAGE = Mapping({
+    'steps': ListOf(Validator(), max_length=lambda ctx: ctx.max_steps),
+    'matrix': MappingOf(ListOf(Scalar(), non_empty=True)),
+    'matrix_include': ListOf(MatrixCell),
+    'matrix_exclude': ListOf(MatrixCell),
+    'env': Env,
+    'worker': Mapping({'type': String, 'image': Scalar()}),
+    'needs': StageNames,
+    'max_parallel': PositiveInt(),
+    'fail_fast': Bool,
+    'paths': Globs,
+    'paths_ignore': Globs,
+    'build_avoidance': Bool,
+    'fuse_steps': Bool,
+    'source_checkout': Bool,
+    'extends': String,
+}, check=check_matrix_size)
+
+PIPELINE = Mapping({
+    'env': Env,
+    'auto_cancel': Bool,
+    'branches': MappingOf(OneOf(StageNames, MappingOf(StageNames))),
+    'crons': MappingOf(Mapping({
+        'timespec': OneOf(ListOf(String), String),
+        'branches': ListOf(String),
+        'stages': StageNames,
+    })),
+    'stages': MappingOf(STAGE),
+})
+
+
+class SchemaValidator(object):
+
+    def __init__(self, schema=PIPELINE, max_cached_verdicts=MAX_CACHED_VERDICTS):
+        self.schema = schema
+        self.max_cached_verdicts = max_cached_verdicts
+        # (digest, limits) -> None if valid, else the arguments of the SchemaInvalid error,
+        # as a raised exception would keep the frames of the validation alive
+        self._verdicts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def validate(self, digest, cfg, marks, max_matrix_cells, max_steps):
+        """raise SchemaInvalid if cfg is not a valid pipeline"""
+        key = (digest, max_matrix_cells, max_steps)
+        with self._lock:
+            if key in self._verdicts:
+                error = self._verdicts[key]
+                if error is not None:
+                    raise SchemaInvalid(*error)
+                return
+        error = None
+        try:
+            self.schema(Context(marks, max_matrix_cells, max_steps), cfg)
+        except SchemaInvalid as e:
+            error = (e.reason, e.path, e.line, e.column)
+        with self._lock:
+            self._verdicts[key] = error
+            while len(self._verdicts) > self.max_cached_verdicts:
+                self._verdicts.popitem(last=False)
+        if error is not None:
+            raise SchemaInvalid(*error)
+
+
+schema_validator = SchemaValidator()
@@ -0,0 +1,236 @@
+"""bbpipeline: run a pipeline locally, without any master or worker
+
+'bbpipeline run' selects the stages of a branch and event like the spawner does, then runs
+them in dependency order. The matrix cells of a stage run in parallel in a process pool, each
+one with the environment it would get on a runner, and their output is prefixed with the
+stage and matrix values.
+
+Only shell commands can run locally: buildbot steps of the pipeline are skipped.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from buildbot.process.buildstep import BuildStep
+from buildbot.process.results import (FAILURE, SKIPPED, SUCCESS, WARNINGS, statusToString,
+                                      worst_status)
+
+from buildbot_pipelines.conditions import evaluate_condition
+from buildbot_pipelines.environment import default_environment_filter
+from buildbot_pipelines.steps.runner import RunnerStep
+from buildbot_pipelines.steps.spawner import PIPELINE_FILENAMES
+from buildbot_pipelines.yaml_loader import PipelineYml, PipelineYmlInvalid
+
+_output_lock = None
+
+
+def init_worker(lock):
+    global _output_lock
+    _output_lock = lock
+
+
+def emit(prefix, line):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    with _output_lock:
+        out.write(prefix + line)
+        if not line.endswith(b"\n"):
+            out.write(b"\n")
+        out.flush()
+
+
+def run_cell(job):
+    """run the commands of a matrix cell, stopping at the first failure (in a pool process)"""
+    label, commands, env, workdir = job
+    prefix = "[{}] ".format(label).encode('utf-8')
+    for name, command in commands:
+        emit(prefix, "$ {}".format(name).encode('utf-8'))
+        p = subprocess.Popen(command, cwd=workdir, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(p.stdout.readline, b""):
+            emit(prefix, line)
+        p.stdout.close()
+        if p.wait() != 0:
+            emit(prefix, "{!r} failed with exit code {}".format(name, p.returncode).encode('utf-8'))
+            return FAILURE
+    return SUCCESS
+
+
+def find_pipeline(path):
+    if path is not None:
+        return path
+    for filename in PIPELINE_FILENAMES:
+        if os.path.exists(filename):
+            return filename
+    raise SystemExit("no {} found in the current directory".format(" or ".join(PIPELINE_FILENAMES)))
+
+
+def git_output(args, default):
+    try:
+        out = subprocess.check_output(['git'] + args, stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return default
+    return out.decode('utf-8').strip()
+
+
+def current_branch():
+    return git_output(['rev-parse', '--abbrev-ref', 'HEAD'], "master")
+
+
+def build_properties(options, branch):
+    """the build properties a runner build would have, for the conditions"""
+    return dict(branch=branch, codebase=options.codebase,
+                repository=git_output(['config', '--get', 'remote.origin.url'], ""),
+                revision=git_output(['rev-parse', 'HEAD'], None))
+
+
+def stage_order(graph):
+    """stages of the graph, in an order compatible with their dependencies"""
+    order, done = [], set()
+    while len(order) < len(graph.stages):
+        for stage in graph.stages:
+            if stage not in done and graph.dependencies(stage) <= done:
+                order.append(stage)
+                done.add(stage)
+                break
+    return order
+
+
+def cell_label(stage, props):
+    matrix = sorted(props.getPropertiesForSource('yml_matrix').items())
+    return " ".join([stage] + ["{}:{}".format(k, v) for k, v in matrix])
+
+
+def cell_commands(pipeline, stage, props, log):
+    """the (name, argv) of the shell commands of a cell, like RunnerStep.addBBPipelineStep"""
+    commands = []
+    for step in pipeline.generate_step_list(stage):
+        shell, name, condition, command = "bash", None, None, step
+        if isinstance(step, dict):
+            name = step.get("title")
+            shell = step.get("shell", shell)
+            condition = step.get("condition")
+            command = step.get("step") or step.get("cmd")
+        if condition is not None:
+            try:
+                if not evaluate_condition(condition, props):
+                    continue
+            except Exception as e:
+                log("[{}] skipping {}: problem parsing condition {!r}: {}".format(
+                    cell_label(stage, props), name or command, condition, e))
+                continue
+        if isinstance(command, BuildStep) or command is None:
+            log("[{}] skipping {}: only shell commands run locally".format(
+                cell_label(stage, props), name or type(command).__name__))
+            continue
+        if name is None:
+            name = command if isinstance(command, str) else " ".join(command)
+            name = RunnerStep.truncateName(name)
+        if not isinstance(command, list):
+            command = [shell, '-c', command]
+        commands.append((name.strip(), command))
+    return commands
+
+
+def cell_environment(props):
+    env = dict(os.environ)
+    env.update(default_environment_filter.compute(props.properties))
+    return env
+
+
+class Workdirs(object):
+    """a shared clone of the repository per cell, when cells must not share the checkout
+
+    The clones are made from the committed HEAD: uncommitted changes are not included.
+    """
+
+    def __init__(self, isolate):
+        self.isolate = isolate
+        self.dirs = []
+
+    def get(self):
+        if not self.isolate:
+            return None
+        path = tempfile.mkdtemp(prefix="bbpipeline-")
+        subprocess.check_call(['git', 'clone', '--quiet', '--shared', os.getcwd(), path])
+        self.dirs.append(path)
+        return path
+
+    def cleanup(self):
+        for path in self.dirs:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run_pipeline(options, log=print):
+    with open(find_pipeline(options.file)) as f:
+        pipeline = PipelineYml(f.read())
+    branch = options.branch or current_branch()
+    triggers = pipeline.generate_triggers(options.codebase, branch, options.event,
+                                          stages=options.stages or None)
+    graph = pipeline.stage_graph(triggers)
+    triggers = dict((trigger['stage'], trigger) for trigger in triggers)
+    properties = build_properties(options, branch)
+    for trigger in triggers.values():
+        for props in trigger['buildrequests']:
+            for name, value in properties.items():
+                props.setProperty(name, value, "bbpipeline")
+    results = {}
+    workdirs = Workdirs(options.isolate)
+    pool = multiprocessing.Pool(options.jobs, initializer=init_worker,
+                                initargs=(multiprocessing.Lock(),))
+    try:
+        for stage in stage_order(graph):
+            if any(results[dep] not in (SUCCESS, WARNINGS) for dep in graph.needs[stage]):
+                log("stage {} skipped".format(stage))
+                results[stage] = SKIPPED
+                continue
+            log("stage {}: {} cells".format(stage, len(triggers[stage]['buildrequests'])))
+            jobs = [(cell_label(stage, props), cell_commands(pipeline, stage, props, log),
+                     cell_environment(props), workdirs.get())
+                    for props in triggers[stage]['buildrequests']]
+            results[stage] = SUCCESS
+            for res in pool.imap_unordered(run_cell, jobs):
+                results[stage] = worst_status(results[stage], res)
+            log("stage {}: {}".format(stage, statusToString(results[stage])))
+    finally:
+        pool.close()
+        pool.join()
+        workdirs.cleanup()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="bbpipeline", description="run buildbot pipelines locally")
+    subparsers = parser.add_subparsers(dest="command")
+    run = subparsers.add_parser("run", help="run the stages of the pipeline for a branch")
+    run.add_argument("-f", "--file", help="pipeline file, .pipeline.yml or pipeline.yml by default")
+    run.add_argument("-b", "--branch", help="branch, the current git branch by default")
+    run.add_argument("-e", "--event", default="push", help="event category, e.g. push or pr")
+    run.add_argument("-s", "--stage", dest="stages", action="append",
+                     help="run this stage instead of the ones of the branch, can be repeated")
+    run.add_argument("-c", "--codebase", default="", help="codebase of the virtual builders")
+    run.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                     help="number of matrix cells run in parallel")
+    run.add_argument("--isolate", action="store_true",
+                     help="run each cell in its own shared clone of the committed HEAD; "
+                          "uncommitted changes are not included")
+    options = parser.parse_args(argv)
+    if options.command != "run":
+        parser.print_help()
+        return 2
+    try:
+        results = run_pipeline(options)
+    except PipelineYmlInvalid as e:
+        print("invalid pipeline: {}".format(e), file=sys.stderr)
+        return 2
+    failed = [stage for stage, res in results.items() if res not in (SUCCESS, SKIPPED)]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
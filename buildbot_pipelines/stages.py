@@ -0,0 +1,243 @@
+"""Scheduling of the stages of a pipeline
+
+A stage can declare the stages it needs with 'needs:'. It then starts as soon as all of them
+succeeded, and is skipped if one of them did not. A stage without 'needs:' keeps the
+historical behaviour: it starts after the previous stage of the pipeline finished, whatever
+its result.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+
+from twisted.internet import defer
+from twisted.python import failure, log
+
+from buildbot.process.properties import Properties
+from buildbot.process.results import (CANCELLED, EXCEPTION, SKIPPED, SUCCESS, WARNINGS,
+                                      worst_status)
+
+from buildbot_pipelines.build_avoidance import getBuildAvoidance
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+RUNNER_SCHEDULER = '__runner'
+
+
+class StageGraph(object):
+    """dependencies between the stages selected for a pipeline run
+
+    needs[stage] are the stages which must succeed before stage starts,
+    after[stage] the stages which must only be finished
+    """
+
+    def __init__(self, stages, needs):
+        """
+        @param stages: ordered stage names
+        @param needs: dict stage -> list of needed stages, or None if the stage does not use needs
+        """
+        self.stages = list(stages)
+        self.needs = collections.OrderedDict()
+        self.after = collections.OrderedDict()
+        previous = None
+        for stage in self.stages:
+            stage_needs = needs.get(stage)
+            if stage_needs is None:
+                self.needs[stage] = set()
+                self.after[stage] = set([previous]) if previous is not None else set()
+            else:
+                # needed stages which are not part of this run are ignored
+                self.needs[stage] = set(n for n in stage_needs if n in self.stages)
+                self.after[stage] = set()
+            previous = stage
+        check_acyclic(dict((s, self.needs[s] | self.after[s]) for s in self.stages))
+
+    @property
+    def is_sequential(self):
+        return not any(self.needs.values())
+
+    def dependencies(self, stage):
+        return self.needs[stage] | self.after[stage]
+
+
+def check_acyclic(deps):
+    """raise PipelineYmlInvalid if the dict stage -> dependencies has a cycle"""
+    visiting, visited = set(), set()
+
+    def visit(stage, path):
+        if stage in visited:
+            return
+        if stage in visiting:
+            cycle = path[path.index(stage):] + [stage]
+            raise PipelineYmlInvalid("stage dependency cycle: {}".format(" -> ".join(cycle)))
+        visiting.add(stage)
+        for dep in sorted(deps.get(stage, ())):
+            visit(dep, path + [dep])
+        visiting.discard(stage)
+        visited.add(stage)
+
+    for stage in deps:
+        visit(stage, [stage])
+
+
+class StageTriggerer(object):
+    """triggers the buildrequests of stages on the runner scheduler, and waits for their results"""
+
+    def __init__(self, master, sourcestamps, parent_buildid=None,
+                 parent_relationship="Triggered from", addURL=None, addLog=None):
+        self.master = master
+        self.sourcestamps = sourcestamps
+        self.parent_buildid = parent_buildid
+        self.parent_relationship = parent_relationship
+        self.addURL = addURL
+        self.addLog = addLog
+        self.brids = []
+        self.results = {}
+        # set once the whole pipeline is cancelled: nothing new gets triggered
+        self.cancelled = False
+
+    def getScheduler(self):
+        return self.master.scheduler_manager.namedServices[RUNNER_SCHEDULER]
+
+    def log(self, message):
+        if self.addLog is not None:
+            self.addLog(message)
+
+    @defer.inlineCallbacks
+    def reuseBuildrequest(self, scheduler, key):
+        """return the results of a previous build with the same avoidance key, or None"""
+        previous = yield getBuildAvoidance(self.master).lookup(key)
+        if previous is None:
+            defer.returnValue(None)
+        res, brid = previous
+        self.log("reusing the results of buildrequest {}".format(brid))
+        if self.addURL is not None:
+            url = self.master.status.getURLForBuildrequest(brid)
+            yield self.addURL("{} #{} (reused)".format(scheduler.name, brid), url)
+        defer.returnValue(res)
+
+    @defer.inlineCallbacks
+    def triggerBuildrequest(self, scheduler, props, running_brids):
+        """trigger one buildset, and wait for its result"""
+        key = props.getProperty('avoidance_key') if isinstance(props, Properties) else None
+        if key is not None:
+            res = yield self.reuseBuildrequest(scheduler, key)
+            if res is not None:
+                defer.returnValue(res)
+        idsDeferred, resultsDeferred = scheduler.trigger(
+            waited_for=True, sourcestamps=self.sourcestamps, set_props=props,
+            parent_buildid=self.parent_buildid,
+            parent_relationship=self.parent_relationship)
+        bsid, brids = yield idsDeferred
+        brids = list(brids.values())
+        self.brids.extend(brids)
+        running_brids.update(brids)
+        if self.addURL is not None:
+            for brid in brids:
+                url = self.master.status.getURLForBuildrequest(brid)
+                yield self.addURL("{} #{}".format(scheduler.name, brid), url)
+        try:
+            res = yield resultsDeferred
+        finally:
+            running_brids.difference_update(brids)
+        if isinstance(res, tuple):
+            res = res[0]
+        if key is not None and brids:
+            yield getBuildAvoidance(self.master).record(key, res, brids[0])
+        defer.returnValue(res)
+
+    def triggerStage(self, trigger):
+        """trigger the buildrequests of a stage, and return a deferred of its worst result
+
+        at most trigger['max_parallel'] buildrequests are released at a time, and if
+        trigger['fail_fast'] is set, the first failure cancels the other buildrequests"""
+        scheduler = self.getScheduler()
+        pending = collections.deque(trigger['buildrequests'])
+        max_parallel = trigger.get('max_parallel') or len(pending)
+        fail_fast = trigger.get('fail_fast', False)
+        running_brids = set()
+        state = {'results': SUCCESS, 'running': 0, 'failed': False}
+        finished = defer.Deferred()
+
+        def buildrequestDone(res):
+            if isinstance(res, failure.Failure):
+                log.err(res, "while waiting for stage {} results".format(trigger['stage']))
+                res = EXCEPTION
+            state['running'] -= 1
+            if not (state['failed'] and res == CANCELLED):
+                state['results'] = worst_status(state['results'], res)
+            if fail_fast and res not in (SUCCESS, WARNINGS) and not state['failed']:
+                state['failed'] = True
+                self.log("stage {} failed, cancelling {} pending and {} running buildrequests".format(
+                    trigger['stage'], len(pending), len(running_brids)))
+                pending.clear()
+                self.cancel("a sibling build of stage {} failed".format(trigger['stage']),
+                            list(running_brids))
+            release()
+
+        def release():
+            if self.cancelled:
+                pending.clear()
+            while pending and state['running'] < max_parallel:
+                state['running'] += 1
+                d = self.triggerBuildrequest(scheduler, pending.popleft(), running_brids)
+                d.addBoth(buildrequestDone)
+            if not state['running'] and not finished.called:
+                finished.callback(state['results'])
+
+        release()
+        return finished
+
+    def runStages(self, triggers, graph):
+        """run the stages as soon as their dependencies allow it
+
+        returns a deferred firing with the dict stage -> result"""
+        triggers = dict((trigger['stage'], trigger) for trigger in triggers)
+        started = set()
+        finished = defer.Deferred()
+
+        def stageDone(res, stage):
+            if isinstance(res, failure.Failure):
+                log.err(res, "while running stage {}".format(stage))
+                res = EXCEPTION
+            self.results[stage] = res
+            self.log("stage {} finished".format(stage))
+            schedule()
+
+        def schedule():
+            changed = True
+            while changed:
+                changed = False
+                for stage in graph.stages:
+                    if stage in started:
+                        continue
+                    deps = graph.dependencies(stage)
+                    if not all(dep in self.results for dep in deps):
+                        continue
+                    started.add(stage)
+                    changed = True
+                    if self.cancelled:
+                        self.results[stage] = CANCELLED
+                        continue
+                    if any(self.results[dep] not in (SUCCESS, WARNINGS) for dep in graph.needs[stage]):
+                        self.log("stage {} skipped".format(stage))
+                        self.results[stage] = SKIPPED
+                        continue
+                    if triggers[stage].get('skipped'):
+                        self.log("stage {} skipped, no changed file matches its paths".format(stage))
+                        self.results[stage] = SKIPPED
+                        continue
+                    self.log("stage {} started".format(stage))
+                    d = self.triggerStage(triggers[stage])
+                    d.addBoth(stageDone, stage)
+            if len(self.results) == len(graph.stages) and not finished.called:
+                finished.callback(self.results)
+
+        schedule()
+        return finished
+
+    def cancel(self, reason, brids=None):
+        """cancel the given buildrequests, or the whole pipeline if brids is None"""
+        if brids is None:
+            self.cancelled = True
+            brids = self.brids
+        for brid in brids:
+            self.master.data.control("cancel", {'reason': reason}, ("buildrequests", brid))
@@ -0,0 +1,103 @@
+"""Source checkout of the runner builds, through a per worker reference repository cache
+
+Every matrix cell of a stage clones the same repository, often on the same host. Each worker
+keeps one bare mirror per repository url in a cache directory, and builds clone from it with
+'git clone --reference --dissociate', so only the new objects go over the network, and the
+checkout does not depend on the cache once done.
+
+Concurrent builds on one worker are serialized with flock: mirror updates take the mirror lock
+exclusively, clones take it shared, and eviction of the least recently used mirrors skips the
+ones which are locked.
+"""
+from __future__ import absolute_import, division, print_function
+
+from buildbot.process.properties import Property
+from buildbot.steps import shell
+
+DEFAULT_CACHE_DIR = "~/.cache/buildbot_pipelines/git"
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+# arguments: repourl revision branch cache_dir max_size_kb
+CHECKOUT_SCRIPT = r"""
+set -e
+repourl="$1"
+revision="$2"
+branch="$3"
+cache_dir="${4/#\~/$HOME}"
+max_kb="$5"
+
+# the arguments come from the changes: none of them may be taken for an option
+for arg in "$repourl" "$revision" "$branch"; do
+    case "$arg" in
+        -*) echo "invalid argument: $arg" >&2; exit 1;;
+    esac
+done
+
+mkdir -p "$cache_dir"
+ref="$cache_dir/$(printf '%s' "$repourl" | git hash-object --stdin).git"
+
+(
+    flock 9
+    if [ -d "$ref" ]; then
+        git -C "$ref" fetch --prune --quiet origin
+    else
+        rm -rf "$ref.tmp"
+        git clone --mirror --quiet -- "$repourl" "$ref.tmp"
+        mv "$ref.tmp" "$ref"
+    fi
+    touch "$ref"
+) 9>"$ref.lock"
+
+find . -mindepth 1 -delete
+(
+    flock -s 9
+    git clone --quiet --reference "$ref" --dissociate -- "$repourl" .
+) 9>"$ref.lock"
+
+# the clone only has the branch heads: other refs, like refs/pull/N/merge, are fetched
+if [ -n "$branch" ] && ! git cat-file -e "${revision:-origin/$branch}^{commit}" 2>/dev/null; then
+    git fetch --quiet origin "$branch"
+    revision="${revision:-FETCH_HEAD}"
+fi
+if [ -n "$revision" ] && ! git cat-file -e "$revision^{commit}" 2>/dev/null; then
+    (
+        flock -s 9
+        git fetch --quiet "$ref" "$revision"
+    ) 9>"$ref.lock"
+fi
+
+if [ -n "$revision" ]; then
+    git checkout --quiet --force "$revision"
+elif [ -n "$branch" ]; then
+    git checkout --quiet --force "$branch"
+fi
+
+(
+    flock 8
+    total=$(du -sk "$cache_dir" | cut -f1)
+    for repo in $(ls -dtr "$cache_dir"/*.git); do
+        [ "$total" -le "$max_kb" ] && break
+        [ "$repo" = "$ref" ] && continue
+        size=$(du -sk "$repo" | cut -f1)
+        # the lock file is kept: removing it would let a process waiting on it and a
+        # process creating a new one both hold the lock
+        if ( flock -n 9 && rm -rf "$repo" ) 9>"$repo.lock"; then
+            total=$((total - size))
+        fi
+    done
+) 8>"$cache_dir/.evict.lock"
+"""
+
+
+class ReferenceGitCheckout(shell.ShellCommand):
+
+    name = "checkout"
+    haltOnFailure = True
+    flunkOnFailure = True
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE, **kwargs):
+        command = ['bash', '-c', CHECKOUT_SCRIPT, 'checkout',
+                   Property('repository'), Property('revision', default=''),
+                   Property('branch', default=''), cache_dir, str(cache_size // 1024)]
+        kwargs.setdefault('description', 'checkout')
+        shell.ShellCommand.__init__(self, command=command, **kwargs)
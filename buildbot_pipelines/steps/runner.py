@@ -2,11 +2,53 @@ from __future__ import absolute_import, division, print_function
 
 import traceback
 
+try:
+    from shlex import quote
+except ImportError:  # python2
+    from pipes import quote
+
 from twisted.internet import defer
 
 from buildbot.process.buildstep import SUCCESS, BuildStep
 from buildbot.steps import shell
-from buildbot_pipelines.yaml_loader import PipelineYml
+from buildbot_pipelines.conditions import evaluate_condition
+from buildbot_pipelines.environment import default_environment_filter
+from buildbot_pipelines.pipeline_cache import pipeline_cache
+from buildbot_pipelines.pipeline_store import getPipelineStore
+from buildbot_pipelines.steps.checkout import (DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE,
+                                               ReferenceGitCheckout)
+
+
+def fuse_commands(steps, max_name_length):
+    """merge the consecutive (name, command) shell commands of steps in a single script
+
+    the script logs a header before each command, and stops at the first failing one, with
+    its exit code, like the separate haltOnFailure steps would do"""
+    fused = []
+    group = []
+
+    def flush():
+        if len(group) == 1:
+            fused.append(group[0])
+        elif group:
+            lines = []
+            for i, (name, command) in enumerate(group, 1):
+                lines.append("echo {}".format(quote("### [{}/{}] {}".format(i, len(group), name))))
+                lines.append("{} || exit $?".format(" ".join(quote(arg) for arg in command)))
+            suffix = " (+{})".format(len(group) - 1)
+            name = group[0][0]
+            if len(name) + len(suffix) > max_name_length:
+                name = name[:max_name_length - len(suffix) - 3] + "..."
+            fused.append((name + suffix, ['bash', '-c', "\n".join(lines)]))
+        del group[:]
+    for step in steps:
+        if isinstance(step, tuple):
+            group.append(step)
+        else:
+            flush()
+            fused.append(step)
+    flush()
+    return fused
 
 
 class ShellCommand(shell.ShellCommand):
@@ -15,12 +57,14 @@ class ShellCommand(shell.ShellCommand):
     haltOnFailure = True
     warnOnWarnings = True
 
+    def __init__(self, env_filter=None, **kwargs):
+        self.env_filter = env_filter or default_environment_filter
+        shell.ShellCommand.__init__(self, **kwargs)
+
     def setupEnvironment(self, cmd):
-        """ Turn all build properties into environment variables """
+        """ Turn build properties into environment variables """
         shell.ShellCommand.setupEnvironment(self, cmd)
-        env = {}
-        for k, v in self.build.getProperties().properties.items():
-            env[str(k)] = str(v[0])
+        env = self.env_filter.getEnvironment(self.build)
         if cmd.args['env'] is None:
             cmd.args['env'] = {}
         cmd.args['env'].update(env)
@@ -30,10 +74,19 @@ class RunnerStep(BuildStep):
     MAX_NAME_LENGTH = 47
     disable = False
 
-    def __init__(self, **kwargs):
+    def __init__(self, checkout_cache_dir=DEFAULT_CACHE_DIR, checkout_cache_size=DEFAULT_CACHE_SIZE,
+                 env_filter=None, worker_picker=None, **kwargs):
+        """
+        @param worker_picker: the L{ImageAffinityWorkerPicker} of the builder, told about the
+                              image of the build once it runs on its worker
+        """
         if "name" not in kwargs:
             kwargs['name'] = 'runner'
         self.config = None
+        self.env_filter = env_filter
+        self.worker_picker = worker_picker
+        self.checkout_cache_dir = checkout_cache_dir
+        self.checkout_cache_size = checkout_cache_size
         BuildStep.__init__(
             self,
             haltOnFailure=True,
@@ -41,12 +94,15 @@ class RunnerStep(BuildStep):
             **kwargs)
 
     def getStepConfig(self):
-        pipeline_yml = self.getProperty("yaml_text")
-        # @TODO load on thread
-        config = PipelineYml(pipeline_yml)
-        return config
-
-    def addBBPipelineStep(self, command):
+        digest = self.getProperty("yaml_digest")
+        if digest is None:
+            # buildrequest created before pipelines were stored by digest
+            return pipeline_cache.loadPipeline(self.getProperty("yaml_text"))
+        return getPipelineStore(self.master).loadPipeline(digest)
+
+    def getBBPipelineCommand(self, command):
+        """return the BuildStep of a yaml step, or its (name, command) if it is a shell
+        command, or None if it is skipped"""
         name = None
         condition = None
         shell = "bash"
@@ -68,45 +124,70 @@ class RunnerStep(BuildStep):
         if condition is not None:
             try:
                 if not self.testCondition(condition):
-                    return
+                    return None
             except Exception:
                 self.descriptionDone = u"Problem parsing condition"
                 self.addCompleteLog("condition error", traceback.format_exc())
-                return
-
-        if step is None:
-            if command is None:
-                self.addCompleteLog("bbtravis.yml error",
-                                    "Neither step nor cmd is defined: %r" %
-                                    (original_command, ))
-                return
+                return None
+
+        if step is not None:
+            return step
+        if command is None:
+            self.addCompleteLog("bbtravis.yml error",
+                                "Neither step nor cmd is defined: %r" %
+                                (original_command, ))
+            return None
+
+        if not isinstance(command, list):
+            command = [shell, '-c', command]
+        return name, command
+
+    def makeShellStep(self, name, command):
+        return ShellCommand(
+            name=name, description=command, command=command, doStepIf=not self.disable,
+            env_filter=self.env_filter)
+
+    def makeBBPipelineStep(self, command):
+        step = self.getBBPipelineCommand(command)
+        if isinstance(step, tuple):
+            step = self.makeShellStep(*step)
+        return step
 
-            if not isinstance(command, list):
-                command = [shell, '-c', command]
-            step = ShellCommand(
-                name=name, description=command, command=command, doStepIf=not self.disable)
-        self.build.addStepsAfterLastStep([step])
+    def addBBPipelineStep(self, command):
+        step = self.makeBBPipelineStep(command)
+        if step is not None:
+            self.build.addStepsAfterLastStep([step])
 
     def testCondition(self, condition):
-        l = dict(
-            (k, v)
-            for k, (v, s) in self.build.getProperties().properties.items())
-        return eval(condition, l)
+        return evaluate_condition(condition, self.build.getProperties())
 
-    def truncateName(self, name):
+    @classmethod
+    def truncateName(cls, name):
         name = name.lstrip("#")
         name = name.lstrip(" ")
         name = name.split("\n")[0]
-        if len(name) > self.MAX_NAME_LENGTH:
-            name = name[:self.MAX_NAME_LENGTH - 3] + "..."
+        if len(name) > cls.MAX_NAME_LENGTH:
+            name = name[:cls.MAX_NAME_LENGTH - 3] + "..."
         return name
 
     @defer.inlineCallbacks
     def run(self):
+        if self.worker_picker is not None:
+            self.worker_picker.recordImage(self.getProperty("workername"),
+                                           self.getProperty("worker_image"))
         self.config = yield self.getStepConfig()
         stage = self.getProperty("stage_name")
-        steps = self.config.generate_step_list(stage)
-        for step in steps:
-            self.addBBPipelineStep(step)
+        steps = []
+        if self.config.needs_source_checkout(stage):
+            steps.append(ReferenceGitCheckout(
+                cache_dir=self.checkout_cache_dir, cache_size=self.checkout_cache_size))
+        commands = [self.getBBPipelineCommand(step) for step in self.config.generate_step_list(stage)]
+        commands = [command for command in commands if command is not None]
+        if self.config.fuse_steps(stage):
+            commands = fuse_commands(commands, self.MAX_NAME_LENGTH)
+        steps.extend(self.makeShellStep(*command) if isinstance(command, tuple) else command
+                     for command in commands)
+        # a single batch: the build only updates its step list once
+        self.build.addStepsAfterLastStep(steps)
 
         defer.returnValue(SUCCESS)
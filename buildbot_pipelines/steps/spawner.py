@@ -1,11 +1,21 @@
 from __future__ import absolute_import, division, print_function
 
 from twisted.internet import defer
+from twisted.python import log
 
-from buildbot.process.buildstep import SUCCESS, BuildStep, BuildStepFailed
+from buildbot.process import remotecommand
+from buildbot.process.buildstep import CANCELLED, SUCCESS, BuildStep, BuildStepFailed
+from buildbot.process.results import SKIPPED, statusToString, worst_status
 from buildbot.steps.trigger import Trigger
 from buildbot.steps.worker import CompositeStepMixin
-from buildbot_pipelines.yaml_loader import PipelineYml, PipelineYmlInvalid
+from buildbot_pipelines.gitmirror import GitMirrorError
+from buildbot_pipelines.pipeline_cache import pipeline_cache
+from buildbot_pipelines.pipeline_store import getPipelineStore
+from buildbot_pipelines.pipeline_tracker import getPipelineTracker
+from buildbot_pipelines.schedulers.pipelinecron import getPipelineCron
+from buildbot_pipelines.stages import StageTriggerer
+from buildbot_pipelines.supersede import DeactivatePipeline, getActivePipelines
+from buildbot_pipelines.yaml_loader import PipelineYmlInvalid
 
 
 HOW_TO_DEBUG = """
@@ -17,13 +27,70 @@ pip install buildbot_pipelines
 bbpipeline run
 """
 
+PIPELINE_FILENAMES = [".pipeline.yml", "pipeline.yml"]
+
+
+def getChangedFiles(changes, merged_files=()):
+    """the files modified by the changes, or None if one of them does not list its files
+
+    @param merged_files: files of the changes merged by the scheduler, None if unknown
+    """
+    if merged_files is None:
+        return None
+    files = set(merged_files)
+    for change in changes:
+        if not change.files:
+            return None
+        files.update(change.files)
+    return files
+
 
 class MultiplePropertyTrigger(Trigger):
 
-    def __init__(self, schedulers_and_properties, **kwargs):
+    def __init__(self, schedulers_and_properties, max_parallel=None, fail_fast=False, **kwargs):
+        """
+        @param max_parallel: maximum number of buildrequests released at a time
+        @param fail_fast: cancel the other buildrequests as soon as one fails
+        """
         self.schedulers_and_properties = schedulers_and_properties
+        self.max_parallel = max_parallel
+        self.fail_fast = fail_fast
+        self.triggerer = None
         Trigger.__init__(self, schedulerNames=["dummy"], updateSourceStamp=False, waitForFinish=True, **kwargs)
 
+    def usesBuildAvoidance(self):
+        return any(s['props_to_set'].getProperty('avoidance_key')
+                   for s in self.schedulers_and_properties)
+
+    @defer.inlineCallbacks
+    def run(self):
+        if not self.max_parallel and not self.fail_fast and not self.usesBuildAvoidance():
+            res = yield Trigger.run(self)
+            defer.returnValue(res)
+        self.running = True
+        self.triggeredNames = ['__runner']
+        log = yield self.addLog("stage")
+        self.triggerer = StageTriggerer(
+            self.master, self.prepareSourcestampListForTrigger(), parent_buildid=self.build.buildid,
+            parent_relationship=self.parent_relationship, addURL=self.addURL,
+            addLog=lambda message: log.addStdout(message + "\n"))
+        res = yield self.triggerer.triggerStage({
+            'stage': self.name,
+            'buildrequests': [s['props_to_set'] for s in self.schedulers_and_properties],
+            'max_parallel': self.max_parallel,
+            'fail_fast': self.fail_fast})
+        yield log.finish()
+        if self.ended:
+            defer.returnValue(CANCELLED)
+        defer.returnValue(res)
+
+    def interrupt(self, reason):
+        if self.triggerer is not None:
+            # also stops the release of the pending buildrequests
+            self.triggerer.cancel('parent build was interrupted')
+            self.brids = []
+        return Trigger.interrupt(self, reason)
+
     def getResultSummary(self):
         return {u'step': "stage " + self.name + " done"}
 
@@ -37,11 +104,71 @@ class MultiplePropertyTrigger(Trigger):
         return properties
 
 
+class StageGraphTrigger(BuildStep):
+    """runs all the stages of a pipeline, each one as soon as its dependencies allow it"""
+
+    flunkOnFailure = True
+
+    def __init__(self, triggers, graph, **kwargs):
+        self.triggers = triggers
+        self.graph = graph
+        self.triggerer = None
+        self.ended = False
+        kwargs.setdefault('name', 'stages')
+        BuildStep.__init__(self, **kwargs)
+
+    def getSourceStamps(self):
+        sourcestamps = dict((ss.codebase, ss.asDict()) for ss in self.build.getAllSourceStamps())
+        return [sourcestamps[k] for k in sorted(sourcestamps)]
+
+    def getCurrentSummary(self):
+        if self.triggerer is None:
+            return {u'step': u"running stages"}
+        return {u'step': u"{} of {} stages done".format(
+            len(self.triggerer.results), len(self.graph.stages))}
+
+    def getResultSummary(self):
+        if self.ended:
+            return {u'step': u"interrupted"}
+        return {u'step': u"stages done"}
+
+    @defer.inlineCallbacks
+    def run(self):
+        log = yield self.addLog("stages")
+        self.triggerer = StageTriggerer(
+            self.master, self.getSourceStamps(), parent_buildid=self.build.buildid,
+            addURL=self.addURL, addLog=lambda message: log.addStdout(message + "\n"))
+        results = yield self.triggerer.runStages(self.triggers, self.graph)
+        if self.ended:
+            defer.returnValue(CANCELLED)
+        overall = SUCCESS
+        for stage in self.graph.stages:
+            log.addStdout(u"{}: {}\n".format(stage, statusToString(results[stage])))
+            if results[stage] != SKIPPED:
+                overall = worst_status(overall, results[stage])
+        yield log.finish()
+        defer.returnValue(overall)
+
+    def interrupt(self, reason):
+        if self.triggerer is not None and not self.ended:
+            self.ended = True
+            self.triggerer.cancel('parent build was interrupted')
+        return BuildStep.interrupt(self, reason)
+
+
 class SpawnerStep(BuildStep, CompositeStepMixin):
-    def __init__(self, **kwargs):
+    def __init__(self, mirror=None, detach_stages=False, **kwargs):
+        """
+        @param mirror: a L{GitMirror}, to read the pipeline file on the master instead of
+                       from a checkout on the worker
+        @param detach_stages: hand the stages over to the L{PipelineTracker} service, and
+                              finish without waiting for them
+        """
         if "name" not in kwargs:
             kwargs['name'] = 'trigger'
         self.config = None
+        self.mirror = mirror
+        self.detach_stages = detach_stages
         BuildStep.__init__(
             self,
             haltOnFailure=True,
@@ -52,14 +179,35 @@ class SpawnerStep(BuildStep, CompositeStepMixin):
         self.addCompleteLog("help.txt", HOW_TO_DEBUG)
 
     @defer.inlineCallbacks
-    def getStepConfig(self):
-        pipeline_yml = None
-        for filename in [".pipeline.yml", "pipeline.yml"]:
+    def getPipelineFileFromWorker(self):
+        for filename in PIPELINE_FILENAMES:
             try:
                 pipeline_yml = yield self.getFileContentFromWorker(filename, abandonOnFailure=True)
-                break
-            except BuildStepFailed as e:
+                defer.returnValue((filename, pipeline_yml))
+            except BuildStepFailed:
                 continue
+        defer.returnValue((None, None))
+
+    def getMirrorRevision(self):
+        return self.getProperty("revision") or self.getProperty("branch") or "HEAD"
+
+    @defer.inlineCallbacks
+    def getPipelineFileFromMirror(self):
+        repository = self.getProperty("repository")
+        revision = self.getMirrorRevision()
+        try:
+            res = yield self.mirror.getFileContent(repository, revision, PIPELINE_FILENAMES)
+        except GitMirrorError as e:
+            self.addCompleteLog("mirror error", str(e))
+            res = (None, None)
+        defer.returnValue(res)
+
+    @defer.inlineCallbacks
+    def getStepConfig(self):
+        if self.mirror is not None:
+            filename, pipeline_yml = yield self.getPipelineFileFromMirror()
+        else:
+            filename, pipeline_yml = yield self.getPipelineFileFromWorker()
 
         if pipeline_yml is None:
             self.descriptionDone = u"unable to fetch .pipeline.yml"
@@ -67,38 +215,125 @@ class SpawnerStep(BuildStep, CompositeStepMixin):
                 "error",
                 "Please put a file named .pipeline.yml at the root of your repository:\n")
             self.addHelpLog()
-            raise
+            raise BuildStepFailed("No pipeline file")
 
         self.addCompleteLog(filename, pipeline_yml)
 
-        # @TODO load on thread
         try:
-            config = PipelineYml(pipeline_yml)
+            config = yield pipeline_cache.loadPipeline(pipeline_yml)
         except PipelineYmlInvalid as e:
-            self.descriptionDone = u"bad .pipeline.yml"
-            self.addCompleteLog(
-                "error",
-                ".pipeline.yml is invalid:\n{0}".format(e))
-            self.addHelpLog()
-            raise BuildStepFailed("Bad pipeline file")
+            self.reportInvalidPipeline(e)
         defer.returnValue(config)
 
+    @defer.inlineCallbacks
+    def getTreeHashFromWorker(self):
+        cmd = remotecommand.RemoteShellCommand(
+            self.workdir, ['git', 'rev-parse', 'HEAD^{tree}'],
+            collectStdout=True, logEnviron=False)
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            defer.returnValue(None)
+        defer.returnValue(cmd.stdout.strip() or None)
+
+    @defer.inlineCallbacks
+    def getTreeHash(self):
+        """hash of the source tree, for the build avoidance keys"""
+        if self.mirror is None:
+            tree_hash = yield self.getTreeHashFromWorker()
+            defer.returnValue(tree_hash)
+        try:
+            tree_hash = yield self.mirror.getTreeHash(
+                self.getProperty("repository"), self.getMirrorRevision())
+        except GitMirrorError as e:
+            self.addCompleteLog("mirror error", str(e))
+            tree_hash = None
+        defer.returnValue(tree_hash)
+
+    def reportInvalidPipeline(self, e):
+        self.descriptionDone = u"bad .pipeline.yml"
+        self.addCompleteLog(
+            "error",
+            ".pipeline.yml is invalid:\n{0}".format(e))
+        self.addHelpLog()
+        raise BuildStepFailed("Bad pipeline file")
+
+    def getSourceStamps(self):
+        sourcestamps = dict((ss.codebase, ss.asDict()) for ss in self.build.getAllSourceStamps())
+        return [sourcestamps[k] for k in sorted(sourcestamps)]
+
+    def addStageSteps(self, triggers, graph):
+        if graph.is_sequential:
+            self.build.addStepsAfterLastStep([
+                MultiplePropertyTrigger(
+                    [{'sched_name': '__runner', 'props_to_set': props, 'unimportant': False}
+                        for props in trigger['buildrequests']],
+                    max_parallel=trigger['max_parallel'],
+                    fail_fast=trigger['fail_fast'],
+                    doStepIf=not trigger['skipped'],
+                    name=trigger['stage']
+                )
+                for trigger in triggers])
+        else:
+            self.build.addStepsAfterLastStep([StageGraphTrigger(triggers, graph)])
+
+    @defer.inlineCallbacks
+    def supersedePreviousPipeline(self, codebase, branch, changeid, tracked):
+        """
+        @param tracked: deferred of the pipeline result if it is run by the tracker, else None
+        """
+        active = getActivePipelines(self.master)
+        buildid = self.build.buildid
+        superseded = yield active.activate(codebase, branch, changeid, buildid)
+        if tracked is not None:
+            @tracked.addBoth
+            def deactivate(res):
+                d = active.deactivate(codebase, branch, buildid)
+                d.addErrback(log.err, "while deactivating the pipeline of build {}".format(buildid))
+                return res
+        else:
+            self.build.addStepsAfterLastStep([DeactivatePipeline(codebase, branch)])
+        if superseded is not None:
+            yield active.supersede(
+                superseded, "superseded by a newer pipeline for {} {}".format(codebase, branch))
+
     @defer.inlineCallbacks
     def run(self):
         self.config = yield self.getStepConfig()
         changes = list(self.build.allChanges())
         if changes:
-            # @TODO handle the cron case
+            # crons are run by the PipelineCronService, without spawner builds
             change = changes[-1]
             branch = change.branch
             codebase = change.codebase
             category = change.category
-            triggers = self.config.generate_triggers(codebase, branch, category)
-            self.build.addStepsAfterLastStep([
-                MultiplePropertyTrigger(
-                    [{'sched_name': '__runner', 'props_to_set': props, 'unimportant': False}
-                        for props in trigger['buildrequests']],
-                    name=trigger['stage']
-                )
-                for trigger in triggers])
+            files = getChangedFiles(changes, self.getProperty('merged_files', ()))
+            tree_hash = None
+            if self.config.uses_build_avoidance():
+                tree_hash = yield self.getTreeHash()
+            try:
+                triggers = self.config.generate_triggers(codebase, branch, category, files, tree_hash)
+                graph = self.config.stage_graph(triggers)
+            except PipelineYmlInvalid as e:
+                self.reportInvalidPipeline(e)
+            skipped = [trigger['stage'] for trigger in triggers if trigger['skipped']]
+            if skipped:
+                self.addCompleteLog(
+                    "skipped stages",
+                    "no changed file matches the paths of stages: {}\n".format(", ".join(skipped)))
+            if triggers:
+                # runners only get the digest of the pipeline
+                yield getPipelineStore(self.master).putPipeline(self.config)
+            tracked = None
+            if self.detach_stages and triggers:
+                tracked = getPipelineTracker(self.master).trackPipeline(
+                    self.build.buildid, self.getSourceStamps(), triggers, graph)
+                self.descriptionDone = u"spawned {} stages".format(len(triggers))
+            else:
+                self.addStageSteps(triggers, graph)
+            if triggers and self.config.auto_cancel:
+                yield self.supersedePreviousPipeline(codebase, branch, change.number, tracked)
+            cron = getPipelineCron(self.master)
+            if cron is not None:
+                yield cron.pipelineSeen(self.getProperty("repository"), codebase,
+                                        self.getProperty("project"), branch, self.config)
         defer.returnValue(SUCCESS)
@@ -0,0 +1,96 @@
+"""Auto cancellation of superseded pipelines
+
+With 'auto_cancel: true' in the pipeline, a new pipeline for a (codebase, branch) stops the
+spawner build of the previous one. Interrupting the spawner build cancels the buildrequests of
+its stages, whether they are still pending or already running. Pipelines run by the tracker
+in detached mode are cancelled through the ('pipelines', <buildid>, 'cancel') mq topic.
+
+The active pipeline of each (codebase, branch) is a row of the state table, so that a newer
+pipeline handled by any master of a cluster supersedes the previous one. Two masters
+activating a pipeline of the same branch at the very same time may both miss each other.
+"""
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import json
+import weakref
+
+from twisted.internet import defer
+
+from buildbot.process.buildstep import SUCCESS, BuildStep
+
+
+class ActivePipelines(object):
+
+    def __init__(self, master):
+        self.master = master
+        self._objectid = None
+
+    @defer.inlineCallbacks
+    def getObjectId(self):
+        if self._objectid is None:
+            self._objectid = yield self.master.db.state.getObjectId(
+                'buildbot_pipelines', 'ActivePipelines')
+        defer.returnValue(self._objectid)
+
+    @staticmethod
+    def stateName(codebase, branch):
+        return "active-" + hashlib.sha1(json.dumps([codebase, branch]).encode('utf-8')).hexdigest()
+
+    @defer.inlineCallbacks
+    def activate(self, codebase, branch, changeid, buildid):
+        """register the pipeline of the spawner build buildid
+
+        returns the buildid of the pipeline it supersedes, or None"""
+        objectid = yield self.getObjectId()
+        name = self.stateName(codebase, branch)
+        # [changeid, buildid] of the active pipeline
+        previous = yield self.master.db.state.getState(objectid, name, None)
+        if previous is not None and previous[0] > changeid:
+            # a newer pipeline is already running, e.g. this is a rebuild
+            defer.returnValue(None)
+        yield self.master.db.state.setState(objectid, name, [changeid, buildid])
+        if previous is not None and previous[1] != buildid:
+            defer.returnValue(previous[1])
+        defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def deactivate(self, codebase, branch, buildid):
+        objectid = yield self.getObjectId()
+        name = self.stateName(codebase, branch)
+        active = yield self.master.db.state.getState(objectid, name, None)
+        if active is not None and active[1] == buildid:
+            yield self.master.db.state.setState(objectid, name, None)
+
+    def supersede(self, buildid, reason):
+        """stop the spawner build buildid, and its pipeline if a tracker runs it"""
+        self.master.mq.produce(("pipelines", str(buildid), "cancel"), {'reason': reason})
+        return self.master.data.control("stop", {'reason': reason}, ("builds", buildid))
+
+
+_active_pipelines = weakref.WeakKeyDictionary()
+
+
+def getActivePipelines(master):
+    if master not in _active_pipelines:
+        _active_pipelines[master] = ActivePipelines(master)
+    return _active_pipelines[master]
+
+
+class DeactivatePipeline(BuildStep):
+    """last step of the spawner builds, removing their pipeline from the active ones"""
+
+    alwaysRun = True
+    hideStepIf = True
+
+    def __init__(self, codebase, branch, **kwargs):
+        self.codebase = codebase
+        self.branch = branch
+        kwargs.setdefault('name', 'deactivate pipeline')
+        BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield getActivePipelines(self.master).deactivate(self.codebase, self.branch,
+                                                         self.build.buildid)
+        defer.returnValue(SUCCESS)
@@ -0,0 +1,134 @@
+from twisted.internet import defer, task
+
+from buildbot.changes.changes import Change
+from buildbot_pipelines.schedulers.anycodebasescheduler import AnyCodeBaseScheduler
+
+
+class FakeChanges(object):
+    def __init__(self):
+        self.fetched = []
+
+    def getChange(self, changeid):
+        self.fetched.append(changeid)
+        return defer.succeed(make_chdict(changeid))
+
+
+class FakeMaster(object):
+    def __init__(self):
+        self.master = self
+        self.db = self
+        self.changes = FakeChanges()
+
+
+def make_chdict(changeid, codebase='cb', category='push'):
+    return dict(changeid=changeid, codebase=codebase, category=category,
+                sourcestampid=changeid * 10)
+
+
+def make_scheduler():
+    sched = AnyCodeBaseScheduler(name='__spawner', builderNames=['__spawner'])
+    sched.parent = FakeMaster()
+    return sched
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
+def test_get_changes_reuses_recent():
+    sched = make_scheduler()
+    sched.rememberChange(make_chdict(2))
+    chdicts = result(sched.getChanges([1, 2, 3, 1]))
+    assert [c['changeid'] for c in chdicts] == [1, 2, 3, 1]
+    assert sched.master.changes.fetched == [1, 3]
+
+
+def test_get_changes_chunks():
+    sched = make_scheduler()
+    sched.CHANGE_FETCH_CHUNK = 2
+    chdicts = result(sched.getChanges(list(range(1, 6))))
+    assert [c['changeid'] for c in chdicts] == [1, 2, 3, 4, 5]
+
+
+def test_recent_changes_bounded():
+    sched = make_scheduler()
+    sched.RECENT_CHANGES = 2
+    for i in range(1, 4):
+        sched.rememberChange(make_chdict(i))
+    assert list(sched._recent_chdicts) == [2, 3]
+
+
+def make_change(number, branch='master', codebase='cb', category='push'):
+    change = Change(None, [], '', branch=branch, codebase=codebase, category=category)
+    change.number = number
+    return change
+
+
+def make_debounced_scheduler():
+    sched = AnyCodeBaseScheduler(name='__spawner', builderNames=['__spawner'], debounce=10)
+    sched._reactor = task.Clock()
+    sched.got = []
+
+    def gotChange(change, important):
+        sched.got.append(change.number)
+    sched.gotChange = gotChange
+    return sched
+
+
+def test_debounce_merges_same_branch():
+    sched = make_debounced_scheduler()
+    sched.debounceChange(make_change(1))
+    sched.debounceChange(make_change(3))
+    sched.debounceChange(make_change(2))
+    sched.debounceChange(make_change(4, branch='other'))
+    sched._reactor.advance(9)
+    assert sched.got == []
+    sched._reactor.advance(1)
+    assert sorted(sched.got) == [3, 4]
+    assert sched.merged_changes == 2
+
+
+def test_debounce_window_restarts():
+    sched = make_debounced_scheduler()
+    sched.debounceChange(make_change(1))
+    sched._reactor.advance(10)
+    sched.debounceChange(make_change(2))
+    sched._reactor.advance(10)
+    assert sched.got == [1, 2]
+    assert sched.merged_changes == 0
+
+
+def test_debounce_flush_cancels_timer():
+    sched = make_debounced_scheduler()
+    sched.debounceChange(make_change(1))
+    for key in list(sched._debounce_timers):
+        sched.flushChanges(key)
+    assert sched.got == [1]
+    assert sched._reactor.getDelayedCalls() == []
+
+
+def test_debounce_remembers_merged_files():
+    sched = make_debounced_scheduler()
+    src, docs, unknown = make_change(1), make_change(2), make_change(3, branch='other')
+    src.files, docs.files = ['src/a.c'], ['docs/a.rst']
+    for change in (src, docs, unknown, make_change(4, branch='other')):
+        sched.debounceChange(change)
+    sched._reactor.advance(10)
+    assert sched._merged_files == {2: ['src/a.c'], 4: None}
+
+
+def test_merged_files_property():
+    sched = make_scheduler()
+    sched._merged_files[2] = ['src/a.c']
+    added = []
+
+    def addBuildsetForSourceStamps(waited_for, properties=None, **kw):
+        added.append(properties)
+        return defer.succeed((1, {}))
+    sched.addBuildsetForSourceStamps = addBuildsetForSourceStamps
+    sched.codebases = {'cb': {}}
+    result(sched.addBuildsetForChanges(changeids=[2]))
+    assert added[0].getProperty('merged_files') == ['src/a.c']
+    assert sched._merged_files == {}
@@ -0,0 +1,78 @@
+from buildbot.process.properties import Properties
+
+from buildbot_pipelines.scripts.bbpipeline import cell_commands, main, stage_order
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+local_yml = """
+env:
+    GREETING: hello
+stages:
+    build:
+        matrix:
+            python: [ "2.7", "3.6" ]
+        steps:
+            - echo $GREETING $python
+            - title: only on 3.6
+              cmd: echo modern
+              condition: python == "3.6"
+            - title: on master
+              cmd: echo on $branch
+              condition: branch == "master" and codebase == ""
+            - title: broken
+              cmd: echo broken
+              condition: unknown_property == 1
+            - !ShellCommand
+                command: make
+    test:
+        steps: [ "exit 3" ]
+    deploy:
+        needs: [ test ]
+        steps: [ echo deploy ]
+    report:
+        steps: [ echo $stage_name ]
+"""
+
+
+def run(tmpdir, *args):
+    path = tmpdir.join("pipeline.yml")
+    path.write(local_yml)
+    return main(["run", "-f", str(path), "-b", "master", "-j", "2"] + list(args))
+
+
+def test_run_stages(tmpdir, capfd):
+    assert run(tmpdir) == 1
+    out = capfd.readouterr().out
+    assert "[build python:2.7] hello 2.7" in out
+    assert "[build python:3.6] hello 3.6" in out
+    assert "[build python:3.6] modern" in out
+    assert "[build python:2.7] modern" not in out
+    # build properties are available to the conditions
+    assert "[build python:2.7] $ on master" in out
+    assert "[build python:2.7] skipping broken: problem parsing condition" in out
+    assert "skipping ShellCommand" in out
+    assert "[test] 'exit 3' failed with exit code 3" in out
+    assert "stage deploy skipped" in out
+    # report runs after the failure, like on the master
+    assert "[report] report" in out
+
+
+def test_run_selected_stages(tmpdir, capfd):
+    assert run(tmpdir, "-s", "build") == 0
+    out = capfd.readouterr().out
+    assert "stage build: success" in out
+    assert "[test]" not in out
+
+
+def test_stage_order():
+    yml = PipelineYml("stages:\n  a:\n    needs: [ b ]\n  b:\n    needs: []\n")
+    triggers = yml.generate_triggers("", "master")
+    assert stage_order(yml.stage_graph(triggers)) == ['b', 'a']
+
+
+def test_command_names_are_truncated():
+    yml = PipelineYml(
+        "stages:\n  build:\n    steps:\n"
+        "      - \"# configure\\nmake\"\n"
+        "      - echo " + "x" * 60 + "\n")
+    commands = cell_commands(yml, "build", Properties(), print)
+    assert [name for name, command in commands] == ["configure", "echo " + "x" * 39 + "..."]
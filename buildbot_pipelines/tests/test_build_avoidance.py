@@ -0,0 +1,179 @@
+import sqlalchemy as sa
+from sqlalchemy.pool import StaticPool
+from twisted.internet import defer
+
+from buildbot.db import model
+from buildbot.db.state import StateConnectorComponent
+from buildbot.process.cache import CacheManager
+from buildbot.process.results import FAILURE, SUCCESS, WARNINGS
+
+from buildbot_pipelines.build_avoidance import BuildAvoidance, avoidance_key, canonical
+from buildbot_pipelines.stages import StageTriggerer
+from buildbot_pipelines.steps.spawner import SpawnerStep
+from buildbot_pipelines.tests.test_pipeline_store import FakeState, result
+from buildbot_pipelines.tests.test_stages import FakeMaster, finish
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+avoidance_yml = """
+env:
+    CI: true
+stages:
+    build:
+        build_avoidance: true
+        matrix:
+            python: [ "2.7", "3.6" ]
+        steps:
+            - make
+            - !ShellCommand
+                command: !i "make %(prop:python)s"
+    deploy:
+        steps: [ make deploy ]
+"""
+
+
+class FakeAvoidanceMaster(FakeMaster):
+    def __init__(self):
+        FakeMaster.__init__(self)
+        self.db = self
+        self.state = FakeState()
+        self.status = self
+
+    def getURLForBuildrequest(self, brid):
+        return "http://buildbot/buildrequests/{}".format(brid)
+
+
+def keys(yml_text, tree_hash="tree1"):
+    triggers = PipelineYml(yml_text).generate_triggers("codebase", "master", tree_hash=tree_hash)
+    return dict((t['stage'], [p.getProperty('avoidance_key') for p in t['buildrequests']])
+                for t in triggers)
+
+
+def test_canonical_steps():
+    yml = PipelineYml(avoidance_yml)
+    assert yml.stage_definition('build') == PipelineYml(avoidance_yml).stage_definition('build')
+    assert canonical({'b': 1, 'a': [1, 2]}) == [['a', [1, 2]], ['b', 1]]
+
+
+def test_keys():
+    k = keys(avoidance_yml)
+    assert k['deploy'] == [None]
+    assert len(set(k['build'])) == 2
+    # same inputs, same keys
+    assert keys(avoidance_yml) == k
+    assert keys(avoidance_yml, "tree2")['build'] != k['build']
+    assert keys(avoidance_yml.replace("make %", "make -j %"))['build'] != k['build']
+    assert keys(avoidance_yml.replace("CI: true", "CI: false"))['build'] != k['build']
+    # a change in another stage does not matter
+    assert keys(avoidance_yml.replace("make deploy", "make upload"))['build'] == k['build']
+    # no tree hash, no build avoidance
+    assert keys(avoidance_yml, None)['build'] == [None, None]
+
+
+def test_key_is_stable():
+    assert avoidance_key("tree", ["def"], {'a': 1, 'b': 2}) == avoidance_key("tree", ["def"], {'b': 2, 'a': 1})
+
+
+class SyncPool(object):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def do(self, callable):
+        with self.engine.connect() as conn:
+            return defer.succeed(callable(conn))
+
+
+class SqliteMaster(object):
+    """a master with a real state table, in an in-memory sqlite database"""
+
+    def __init__(self):
+        engine = sa.create_engine('sqlite://', poolclass=StaticPool)
+        model.Model.metadata.create_all(
+            engine, tables=[model.Model.objects, model.Model.object_state])
+        self.master = self.db = self
+        self.caches = CacheManager()
+        self.model = model.Model
+        self.pool = SyncPool(engine)
+        self.state = StateConnectorComponent(self)
+
+
+def state_names(master):
+    q = sa.select([model.Model.object_state.c.name])
+    return sorted(row.name for row in master.pool.engine.execute(q))
+
+
+def test_entries_ttl_and_eviction():
+    master = SqliteMaster()
+    avoidance = BuildAvoidance(master)
+    avoidance.max_entries = 2
+    avoidance.evict_every = 3
+    result(avoidance.record("k1", SUCCESS, 1, now=100))
+    result(avoidance.record("failed", FAILURE, 2, now=100))
+    assert result(avoidance.lookup("k1", now=200)) == (SUCCESS, 1)
+    assert result(avoidance.lookup("failed", now=200)) is None
+    assert result(avoidance.lookup("k1", now=100 + avoidance.ttl + 1)) is None
+    result(avoidance.record("k2", WARNINGS, 3, now=101))
+    # one row per key
+    assert state_names(master) == ["k1", "k2"]
+    result(avoidance.record("k3", SUCCESS, 4, now=102))
+    assert result(avoidance.lookup("k1", now=200)) is None
+    assert state_names(master) == ["k2", "k3"]
+    # expired entries are evicted too
+    assert result(avoidance.evict(102 + avoidance.ttl)) == 1
+    assert state_names(master) == ["k3"]
+
+
+def test_entries_shared_by_masters():
+    master = SqliteMaster()
+    result(BuildAvoidance(master).lookup("k1", now=100))
+    result(BuildAvoidance(master).record("k1", SUCCESS, 1, now=100))
+    assert result(BuildAvoidance(master).lookup("k1", now=100)) == (SUCCESS, 1)
+
+
+def test_reuse_results():
+    master = FakeAvoidanceMaster()
+    triggers = PipelineYml(avoidance_yml).generate_triggers("codebase", "master", tree_hash="tree1")
+    urls = []
+
+    def addURL(name, url):
+        urls.append(name)
+    results = []
+    StageTriggerer(master, [], addURL=addURL).triggerStage(triggers[0]).addCallback(results.append)
+    triggered = master.namedServices['__runner'].triggered
+    finish(triggered, 0)
+    finish(triggered, 1, FAILURE)
+    assert results == [FAILURE]
+
+    results = []
+    StageTriggerer(master, [], addURL=addURL).triggerStage(triggers[0]).addCallback(results.append)
+    # only the failed cell is built again
+    assert len(triggered) == 3
+    assert "__runner #1 (reused)" in urls
+    finish(triggered, 2)
+    assert results == [SUCCESS]
+
+
+def make_spawner(rc=0, stdout="abc123\n"):
+    step = SpawnerStep()
+    step.workdir = "build"
+    step.commands = []
+
+    def runCommand(cmd):
+        step.commands.append(cmd)
+        cmd.rc = rc
+        cmd.stdout = stdout
+        return defer.succeed(None)
+    step.runCommand = runCommand
+    return step
+
+
+def test_tree_hash_from_worker():
+    step = make_spawner()
+    assert result(step.getTreeHash()) == "abc123"
+    cmd, = step.commands
+    assert cmd.command == ['git', 'rev-parse', 'HEAD^{tree}']
+    assert cmd.args['workdir'] == "build"
+
+
+def test_tree_hash_from_worker_failed():
+    step = make_spawner(rc=128, stdout="")
+    assert result(step.getTreeHash()) is None
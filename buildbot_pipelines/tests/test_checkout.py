@@ -0,0 +1,107 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from buildbot_pipelines.steps.checkout import CHECKOUT_SCRIPT
+
+
+def git(cwd, *args):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=me', '-c', 'user.email=me@foo.com'] + list(args),
+        cwd=cwd).decode('ascii').strip()
+
+
+def make_repo(tmp, name):
+    repo = os.path.join(tmp, name)
+    os.mkdir(repo)
+    git(repo, 'init', '-q')
+    with open(os.path.join(repo, 'pipeline.yml'), 'w') as f:
+        f.write(name)
+    git(repo, 'add', '.')
+    git(repo, 'commit', '-q', '-m', 'c')
+    return 'file://' + repo, git(repo, 'rev-parse', 'HEAD')
+
+
+def checkout(tmp, workdir, repourl, revision, max_size_kb=1024 * 1024, branch=''):
+    workdir = os.path.join(tmp, workdir)
+    if not os.path.isdir(workdir):
+        os.mkdir(workdir)
+    subprocess.check_call(['bash', '-c', CHECKOUT_SCRIPT, 'checkout', repourl, revision, branch,
+                           os.path.join(tmp, 'cache'), str(max_size_kb)], cwd=workdir)
+    with open(os.path.join(workdir, 'pipeline.yml')) as f:
+        return f.read()
+
+
+def cached_repos(tmp):
+    return sorted(f for f in os.listdir(os.path.join(tmp, 'cache')) if f.endswith('.git'))
+
+
+@pytest.fixture
+def tmp():
+    tmp = tempfile.mkdtemp(prefix="bbpipeline_checkout")
+    yield tmp
+    shutil.rmtree(tmp)
+
+
+def test_checkout_uses_cache(tmp):
+    repourl, sha = make_repo(tmp, 'repo')
+    assert checkout(tmp, 'build1', repourl, sha) == 'repo'
+    assert checkout(tmp, 'build2', repourl, sha) == 'repo'
+    assert len(cached_repos(tmp)) == 1
+    # checkouts do not depend on the cache
+    assert not os.path.exists(os.path.join(tmp, 'build1', '.git', 'objects', 'info', 'alternates'))
+
+
+def test_checkout_evicts_lru(tmp):
+    repourl1, sha1 = make_repo(tmp, 'repo1')
+    repourl2, sha2 = make_repo(tmp, 'repo2')
+    checkout(tmp, 'build1', repourl1, sha1)
+    checkout(tmp, 'build2', repourl2, sha2, max_size_kb=1)
+    # only the mirror in use is kept
+    assert len(cached_repos(tmp)) == 1
+
+
+def make_pull_request(tmp, name):
+    """a commit only reachable through refs/pull/1/merge"""
+    repourl, _ = make_repo(tmp, name)
+    repo = repourl[len('file://'):]
+    git(repo, 'checkout', '-q', '-b', 'pr')
+    with open(os.path.join(repo, 'pipeline.yml'), 'w') as f:
+        f.write('pr')
+    git(repo, 'commit', '-q', '-a', '-m', 'pr')
+    sha = git(repo, 'rev-parse', 'HEAD')
+    git(repo, 'update-ref', 'refs/pull/1/merge', sha)
+    git(repo, 'checkout', '-q', '-')
+    git(repo, 'branch', '-q', '-D', 'pr')
+    return repourl, sha
+
+
+def test_checkout_pull_request(tmp):
+    repourl, sha = make_pull_request(tmp, 'repo')
+    assert checkout(tmp, 'build1', repourl, sha, branch='refs/pull/1/merge') == 'pr'
+    assert checkout(tmp, 'build2', repourl, '', branch='refs/pull/1/merge') == 'pr'
+    # without the branch, the revision is found in the mirror
+    assert checkout(tmp, 'build3', repourl, sha) == 'pr'
+
+
+def test_checkout_rejects_options(tmp):
+    workdir = os.path.join(tmp, 'build')
+    os.mkdir(workdir)
+    pwned = os.path.join(tmp, 'pwned')
+    rc = subprocess.call(['bash', '-c', CHECKOUT_SCRIPT, 'checkout',
+                          '--upload-pack=touch ' + pwned, '', '', os.path.join(tmp, 'cache'),
+                          '1024'], cwd=workdir)
+    assert rc != 0
+    assert not os.path.exists(pwned)
+
+
+def test_checkout_keeps_lock_files(tmp):
+    repourl1, sha1 = make_repo(tmp, 'repo1')
+    repourl2, sha2 = make_repo(tmp, 'repo2')
+    checkout(tmp, 'build1', repourl1, sha1)
+    checkout(tmp, 'build2', repourl2, sha2, max_size_kb=1)
+    locks = [f for f in os.listdir(os.path.join(tmp, 'cache')) if f.endswith('.git.lock')]
+    assert len(locks) == 2
@@ -0,0 +1,53 @@
+import pytest
+
+from buildbot.process.properties import Properties
+
+from buildbot_pipelines.conditions import ConditionInvalid, compile_condition, evaluate_condition
+from buildbot_pipelines.errors import PipelineYmlInvalid
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+
+def make_properties(**props):
+    properties = Properties()
+    for k, v in props.items():
+        properties.setProperty(k, v, 'test')
+    return properties
+
+
+def test_condition_evaluate():
+    props = make_properties(TARGET='target1', VARIANT='eng', CI=True)
+    assert evaluate_condition("TARGET == 'target1'", props)
+    assert evaluate_condition("VARIANT in ('eng', 'user') and CI", props)
+    assert not evaluate_condition("not CI or TARGET != 'target1'", props)
+
+
+def test_condition_unknown_property():
+    with pytest.raises(NameError):
+        evaluate_condition("FOO == 1", make_properties())
+
+
+def test_condition_cached():
+    assert compile_condition("A == 1") is compile_condition("A == 1")
+
+
+@pytest.mark.parametrize("condition", [
+    "__import__('os').system('ls')",
+    "A.__class__",
+    "[x for x in A]",
+    "A + 1 == 2",
+    "A ==",
+])
+def test_condition_invalid(condition):
+    with pytest.raises(ConditionInvalid):
+        compile_condition(condition)
+
+
+def test_condition_validated_on_load():
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("""
+stages:
+    build:
+        steps:
+            - cmd: echo ok
+              condition: open('/etc/passwd')
+""")
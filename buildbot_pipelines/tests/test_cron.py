@@ -0,0 +1,52 @@
+import datetime
+import time
+
+import pytest
+
+from buildbot_pipelines.cron import CronSpec
+from buildbot_pipelines.errors import PipelineYmlInvalid
+
+
+def ts(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+def next_fire(spec, *after):
+    t = CronSpec(spec).next_fire(ts(*after))
+    return datetime.datetime.fromtimestamp(t) if t is not None else None
+
+
+def test_daily():
+    assert next_fire("0 12 * * *", 2018, 3, 1, 11, 59) == datetime.datetime(2018, 3, 1, 12, 0)
+    # strictly after
+    assert next_fire("0 12 * * *", 2018, 3, 1, 12, 0) == datetime.datetime(2018, 3, 2, 12, 0)
+
+
+def test_year_field():
+    assert next_fire("0 12 * * * *", 2018, 12, 31, 13) == datetime.datetime(2019, 1, 1, 12, 0)
+    assert next_fire("0 0 1 1 * 2020", 2018, 5, 5) == datetime.datetime(2020, 1, 1)
+    assert next_fire("0 0 1 1 * 2017", 2018, 5, 5) is None
+
+
+def test_steps_ranges_and_lists():
+    assert next_fire("*/15 * * * *", 2018, 3, 1, 10, 16) == datetime.datetime(2018, 3, 1, 10, 30)
+    assert next_fire("5/20 * * * *", 2018, 3, 1, 10, 26) == datetime.datetime(2018, 3, 1, 10, 45)
+    assert next_fire("0 8-10,14 * * *", 2018, 3, 1, 10, 30) == datetime.datetime(2018, 3, 1, 14, 0)
+    assert next_fire("0 0 * 2-3 *", 2018, 3, 31, 1) == datetime.datetime(2019, 2, 1)
+
+
+def test_days():
+    # 2018-03-01 is a thursday
+    assert next_fire("0 0 * * 0", 2018, 3, 1) == datetime.datetime(2018, 3, 4)
+    assert next_fire("0 0 * * 7", 2018, 3, 1) == datetime.datetime(2018, 3, 4)
+    # restricted day of month and day of week: either
+    assert next_fire("0 0 15 * 5", 2018, 3, 1) == datetime.datetime(2018, 3, 2)
+    assert next_fire("0 0 31 * *", 2018, 4, 1) == datetime.datetime(2018, 5, 31)
+    assert next_fire("0 0 30 2 *", 2018, 1, 1) is None
+
+
+@pytest.mark.parametrize("spec", ["* * * *", "60 * * * *", "* * 0 * *", "a * * * *", "*/0 * * * *",
+                                  "5-1 * * * *"])
+def test_invalid(spec):
+    with pytest.raises(PipelineYmlInvalid):
+        CronSpec(spec)
@@ -0,0 +1,42 @@
+from buildbot.process.properties import Properties
+
+from buildbot_pipelines.environment import EnvironmentFilter
+
+
+class FakeBuild(object):
+    def __init__(self, **props):
+        self.properties = Properties()
+        for k, v in props.items():
+            self.properties.setProperty(k, v, 'test')
+
+    def getProperties(self):
+        return self.properties
+
+
+def test_env_default_filter():
+    build = FakeBuild(TARGET='target1', CI=True, yaml_text='stages: {}',
+                      worker={'type': 'docker'}, virtual_builder_tags=['a', 'b'], big='x' * 5000)
+    assert EnvironmentFilter().getEnvironment(build) == {'TARGET': 'target1', 'CI': 'True'}
+
+
+def test_env_allow_deny():
+    build = FakeBuild(TARGET='target1', TEST='stability', buildnumber=1)
+    env = EnvironmentFilter(allow=['T*'], deny=['TEST']).getEnvironment(build)
+    assert env == {'TARGET': 'target1'}
+
+
+def test_env_max_size():
+    build = FakeBuild(A='1' * 10, B='2' * 10, C='3')
+    env = EnvironmentFilter(max_size=20).getEnvironment(build)
+    assert env == {'A': '1' * 10, 'C': '3'}
+
+
+def test_env_cached_per_build():
+    env_filter = EnvironmentFilter()
+    build = FakeBuild(A='1')
+    env = env_filter.getEnvironment(build)
+    assert env_filter.getEnvironment(build) is env
+    build.properties.setProperty('B', '2', 'test')
+    assert env_filter.getEnvironment(build) == {'A': '1', 'B': '2'}
+    build.properties.setProperty('A', '3', 'test')
+    assert env_filter.getEnvironment(build) == {'A': '3', 'B': '2'}
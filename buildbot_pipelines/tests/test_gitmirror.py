@@ -0,0 +1,77 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from buildbot_pipelines.gitmirror import GitMirror, GitMirrorError, checkRepoUrl
+
+
+def git(cwd, *args):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=me', '-c', 'user.email=me@foo.com'] + list(args),
+        cwd=cwd).decode('ascii').strip()
+
+
+def commit(repo, filename, content):
+    with open(os.path.join(repo, filename), 'w') as f:
+        f.write(content)
+    git(repo, 'add', '.')
+    git(repo, 'commit', '-q', '-m', 'c')
+    return git(repo, 'rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def repo():
+    tmp = tempfile.mkdtemp(prefix="bbpipeline_mirror")
+    repo = os.path.join(tmp, "repo")
+    os.mkdir(repo)
+    git(repo, 'init', '-q')
+    yield tmp, repo
+    shutil.rmtree(tmp)
+
+
+def test_mirror_read_file(repo):
+    tmp, path = repo
+    sha = commit(path, 'pipeline.yml', 'v1')
+    mirror = GitMirror(os.path.join(tmp, 'mirrors'))
+    url = 'file://' + path
+    assert mirror.getFirstFile(url, sha, ['.pipeline.yml', 'pipeline.yml']) == ('pipeline.yml', 'v1')
+    assert mirror.getFirstFile(url, 'HEAD', ['other.yml']) == (None, None)
+
+
+def test_mirror_incremental_fetch(repo):
+    tmp, path = repo
+    sha1 = commit(path, 'pipeline.yml', 'v1')
+    mirror = GitMirror(os.path.join(tmp, 'mirrors'))
+    url = 'file://' + path
+    assert mirror.getFirstFile(url, 'HEAD', ['pipeline.yml']) == ('pipeline.yml', 'v1')
+    sha2 = commit(path, 'pipeline.yml', 'v2')
+    assert mirror.getFirstFile(url, sha2, ['pipeline.yml']) == ('pipeline.yml', 'v2')
+    assert mirror.getFirstFile(url, sha1, ['pipeline.yml']) == ('pipeline.yml', 'v1')
+    assert mirror.getFirstFile(url, 'HEAD', ['pipeline.yml']) == ('pipeline.yml', 'v2')
+
+
+def test_mirror_unknown_revision(repo):
+    tmp, path = repo
+    commit(path, 'pipeline.yml', 'v1')
+    mirror = GitMirror(os.path.join(tmp, 'mirrors'))
+    with pytest.raises(GitMirrorError):
+        mirror.getFirstFile('file://' + path, '0' * 40, ['pipeline.yml'])
+
+
+@pytest.mark.parametrize("repourl", [
+    "--upload-pack=touch pwned", "ext::sh -c touch% pwned", "fd::17", "ext://foo"])
+def test_mirror_rejects_unsafe_urls(repo, repourl):
+    tmp, path = repo
+    mirror = GitMirror(os.path.join(tmp, 'mirrors'))
+    with pytest.raises(GitMirrorError):
+        mirror.updateMirror(repourl, 'master')
+    assert not os.path.exists(os.path.join(tmp, 'mirrors'))
+
+
+def test_check_repo_url():
+    for repourl in ["https://github.com/buildbot/buildbot.git", "git@github.com:buildbot/buildbot.git",
+                    "ssh://git@host/repo.git", "/srv/git/repo.git"]:
+        checkRepoUrl(repourl)
@@ -0,0 +1,149 @@
+import os
+import sys
+import threading
+import zipfile
+
+import pytest
+
+from buildbot_pipelines.package_loader import (PackageImportError, PackageLoader,
+                                               compatible_wheel, parse_requirement)
+from buildbot_pipelines.yaml_loader import PipelineYml, PipelineYmlInvalid
+
+STEP_MODULE = """
+class {cls}(object):
+    version = {version!r}
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+"""
+
+
+def make_wheel(directory, name, version, module, cls):
+    path = os.path.join(str(directory), "{}-{}-py2.py3-none-any.whl".format(name, version))
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr(module + ".py", STEP_MODULE.format(cls=cls, version=version))
+        z.writestr("{}-{}.dist-info/entry_points.txt".format(name, version),
+                   "[buildbot.steps]\n{cls} = {module}:{cls}\n".format(cls=cls, module=module))
+    return path
+
+
+@pytest.fixture
+def wheels(tmpdir):
+    index = tmpdir.mkdir("index")
+    make_wheel(index, "buildbot_foo", "1.0", "bbp_test_foo_1", "FooStep")
+    make_wheel(index, "buildbot_foo", "1.10", "bbp_test_foo_2", "FooStep")
+    make_wheel(index, "buildbot_bar", "0.1", "bbp_test_bar", "BarStep")
+    yield index
+    # each test imports from its own cache
+    for module in [m for m in sys.modules if m.startswith("bbp_test_")]:
+        del sys.modules[module]
+    sys.path[:] = [p for p in sys.path if not p.startswith(str(tmpdir))]
+
+
+def test_parse_requirement():
+    assert parse_requirement("buildbot-Foo") == ("buildbot-foo", None)
+    assert parse_requirement("buildbot_foo==1.0") == ("buildbot-foo", "1.0")
+    with pytest.raises(PackageImportError):
+        parse_requirement("buildbot_foo>=1.0")
+
+
+def test_compatible_wheel():
+    assert compatible_wheel("buildbot_foo-1.0-py2.py3-none-any.whl") == ("buildbot-foo", "1.0")
+    assert compatible_wheel("buildbot_foo-1.0-cp36-cp36m-linux_x86_64.whl") is None
+    assert compatible_wheel("buildbot_foo-1.0.tar.gz") is None
+
+
+def test_directory_index(wheels, tmpdir):
+    loader = PackageLoader(str(wheels), str(tmpdir.join("cache")))
+    plugins = loader.importPackage("buildbot-foo")
+    # highest version wins
+    assert plugins["!FooStep"].version == "1.10"
+    assert loader.importPackage("buildbot_foo==1.10") == plugins
+    # a package is imported in one version only
+    with pytest.raises(PackageImportError):
+        loader.importPackage("buildbot_foo==1.0")
+    assert PackageLoader(str(wheels), str(tmpdir.join("cache2"))).importPackage(
+        "buildbot_foo==1.0")["!FooStep"].version == "1.0"
+    with pytest.raises(PackageImportError):
+        loader.importPackage("buildbot-unknown")
+
+
+def test_no_index_by_default(tmpdir):
+    loader = PackageLoader(cache_dir=str(tmpdir.join("cache")))
+    with pytest.raises(PackageImportError) as e:
+        loader.importPackage("buildbot-foo")
+    assert "no package index is configured" in str(e.value)
+    assert not tmpdir.join("cache").exists()
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("modules: !Imports [ buildbot-foo ]\n")
+
+
+def test_module_conflicts(wheels, tmpdir):
+    make_wheel(wheels, "buildbot_baz", "1.0", "bbp_test_bar", "BazStep")
+    loader = PackageLoader(str(wheels), str(tmpdir.join("cache")))
+    loader.importPackage("buildbot-bar")
+    with pytest.raises(PackageImportError) as e:
+        loader.importPackage("buildbot-baz")
+    assert "another bbp_test_bar is already imported" in str(e.value)
+
+
+def test_simple_index(wheels, tmpdir):
+    simple = tmpdir.mkdir("simple").mkdir("buildbot-bar")
+    simple.join("index.html").write(
+        '<html><body><a href="../../index/buildbot_bar-0.1-py2.py3-none-any.whl">bar</a></body></html>')
+    loader = PackageLoader("file://" + str(tmpdir.join("simple")), str(tmpdir.join("cache")))
+    assert "!BarStep" in loader.importPackage("buildbot-bar")
+
+
+def test_download_errors(wheels, tmpdir):
+    simple = tmpdir.mkdir("simple").mkdir("buildbot-bar")
+    simple.join("index.html").write(
+        '<html><body><a href="../../missing/buildbot_bar-0.1-py2.py3-none-any.whl">bar</a></body></html>')
+    loader = PackageLoader("file://" + str(tmpdir.join("simple")), str(tmpdir.join("cache")))
+    with pytest.raises(PackageImportError) as e:
+        loader.importPackage("buildbot-bar")
+    assert "cannot download" in str(e.value)
+    # the temporary file is removed
+    assert os.listdir(str(tmpdir.join("cache", "v1"))) == []
+
+
+def test_cache_is_content_addressed(wheels, tmpdir):
+    cache = tmpdir.join("cache")
+    PackageLoader(str(wheels), str(cache)).importPackage("buildbot-bar")
+    entries = os.listdir(str(cache.join("v1")))
+    assert len(entries) == 1 and len(entries[0]) == 64
+    # another process finds the unpacked wheel
+    PackageLoader(str(wheels), str(cache)).importPackage("buildbot-bar")
+    assert os.listdir(str(cache.join("v1"))) == entries
+
+
+def test_concurrent_imports_download_once(wheels, tmpdir):
+    loader = PackageLoader(str(wheels), str(tmpdir.join("cache")))
+    downloads = []
+    download = loader.download
+
+    def counting_download(*args):
+        downloads.append(args)
+        return download(*args)
+    loader.download = counting_download
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(loader.importPackage("buildbot-foo")))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(downloads) == 1
+    assert all(r is results[0] for r in results)
+
+
+def test_imports_in_pipeline(wheels, tmpdir, monkeypatch):
+    from buildbot_pipelines import package_loader
+    monkeypatch.setattr(package_loader, 'package_loader',
+                        PackageLoader(str(wheels), str(tmpdir.join("cache"))))
+    yml = PipelineYml("modules: !Imports [ buildbot-foo ]\nstages:\n  build:\n    steps:\n"
+                      "      - !FooStep\n          arg: 1\n")
+    step = yml.cfg['stages']['build']['steps'][0]
+    assert step.kwargs == {'arg': 1}
+    assert 'bbp_test_foo_2' in sys.modules
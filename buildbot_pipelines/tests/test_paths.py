@@ -0,0 +1,116 @@
+import pytest
+
+from buildbot.process.results import SKIPPED, SUCCESS
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+from buildbot_pipelines.paths import PathFilter
+from buildbot_pipelines.steps.spawner import getChangedFiles
+from buildbot_pipelines.tests.test_stages import FakeTriggerer
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+paths_yml = """
+stages:
+    build:
+        paths_ignore: [ "docs/**", "*.md" ]
+        steps: [ make ]
+    docs:
+        paths: [ "docs/**", "**/*.rst" ]
+        steps: [ make docs ]
+    deploy:
+        needs: [ docs ]
+        steps: [ make deploy ]
+"""
+
+
+def test_globs():
+    f = PathFilter(["src/*.c", "docs/**", "**/Makefile", "tests/test_?.py", "[ab].txt"])
+    assert f.relevant("src/main.c")
+    assert not f.relevant("src/sub/main.c")
+    assert f.relevant("docs/index.rst")
+    assert f.relevant("docs/api/index.rst")
+    assert f.relevant("Makefile")
+    assert f.relevant("lib/sub/Makefile")
+    assert f.relevant("tests/test_a.py")
+    assert not f.relevant("tests/test_ab.py")
+    assert f.relevant("a.txt")
+    assert not f.relevant("c.txt")
+    # globs are not regular expressions
+    assert not PathFilter(["a.c"]).relevant("abc")
+
+
+def test_glob_classes_like_fnmatch():
+    f = PathFilter(["[]a].txt"])
+    assert f.relevant("].txt")
+    assert f.relevant("a.txt")
+    assert not f.relevant("b.txt")
+    f = PathFilter(["[!]b]"])
+    assert f.relevant("x")
+    assert not f.relevant("]")
+    assert not f.relevant("b")
+    f = PathFilter(["[^c]"])
+    assert f.relevant("^")
+    assert not f.relevant("d")
+
+
+def test_paths_and_paths_ignore():
+    f = PathFilter(["src/**"], ["src/vendor/**"])
+    assert f.matches(["README.md", "src/main.c"])
+    assert not f.matches(["README.md", "src/vendor/lib.c"])
+    assert not f.matches([])
+    # unknown files: the stage runs
+    assert f.matches(None)
+
+
+def test_invalid_paths():
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("stages:\n  a:\n    paths: docs/**\n")
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("stages:\n  a:\n    paths: [ 'docs/[a' ]\n")
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("stages:\n  a:\n    paths: [ 'docs/[z-a]' ]\n")
+
+
+def trigger(files):
+    yml = PipelineYml(paths_yml)
+    return dict((t['stage'], t) for t in yml.generate_triggers("codebase", "master", files=files))
+
+
+def test_triggers_docs_only():
+    triggers = trigger(["docs/index.rst", "README.md"])
+    assert triggers['build']['skipped']
+    assert triggers['build']['buildrequests'] == []
+    assert not triggers['docs']['skipped']
+    assert len(triggers['docs']['buildrequests']) == 1
+
+
+def test_triggers_code_only():
+    triggers = trigger(["src/main.c"])
+    assert not triggers['build']['skipped']
+    assert triggers['docs']['skipped']
+    assert not triggers['deploy']['skipped']
+
+
+def test_triggers_unknown_files():
+    assert not any(t['skipped'] for t in trigger(None).values())
+
+
+def test_skipped_stages_are_reported():
+    yml = PipelineYml(paths_yml)
+    triggers = yml.generate_triggers("codebase", "master", files=["src/main.c"])
+    triggerer = FakeTriggerer()
+    results = []
+    triggerer.runStages(triggers, yml.stage_graph(triggers)).addCallback(results.append)
+    assert sorted(triggerer.running) == ['build']
+    triggerer.running['build'].callback(SUCCESS)
+    # deploy needs docs, which did not run
+    assert results == [dict(build=SUCCESS, docs=SKIPPED, deploy=SKIPPED)]
+
+
+def test_changed_files_with_merged_changes():
+    class FakeChange(object):
+        def __init__(self, files):
+            self.files = files
+    changes = [FakeChange(['docs/a.rst'])]
+    assert getChangedFiles(changes) == {'docs/a.rst'}
+    assert getChangedFiles(changes, ['src/a.c']) == {'docs/a.rst', 'src/a.c'}
+    assert getChangedFiles(changes, None) is None
@@ -0,0 +1,72 @@
+from twisted.internet import defer
+
+from buildbot_pipelines import pipeline_cache
+from buildbot_pipelines.pipeline_cache import PipelineCache
+from buildbot_pipelines.yaml_loader import pipeline_digest
+
+basic_yml = """
+stages:
+    build:
+        steps:
+            - echo {}
+"""
+
+
+def test_cache_hit():
+    cache = PipelineCache()
+    p1 = cache.getPipeline(basic_yml.format(1))
+    p2 = cache.getPipeline(basic_yml.format(1))
+    assert p1 is p2
+    assert p1.digest == pipeline_digest(basic_yml.format(1))
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_cache_get_by_digest():
+    cache = PipelineCache()
+    p = cache.getPipeline(basic_yml.format(1))
+    assert cache.get(p.digest) is p
+    assert cache.get(pipeline_digest("unknown")) is None
+
+
+def test_cache_evict_lru():
+    size = len(basic_yml.format(1))
+    cache = PipelineCache(max_size=size * 2)
+    p1 = cache.getPipeline(basic_yml.format(1))
+    p2 = cache.getPipeline(basic_yml.format(2))
+    # touch p1, so that p2 is the least recently used
+    cache.getPipeline(basic_yml.format(1))
+    cache.getPipeline(basic_yml.format(3))
+    assert p1.digest in cache
+    assert p2.digest not in cache
+    assert cache.evictions == 1
+    assert cache.size == size * 2
+
+
+def test_cache_too_big():
+    cache = PipelineCache(max_size=10)
+    cache.getPipeline(basic_yml.format(1))
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_cache_load_shares_parse(monkeypatch):
+    parses = []
+
+    def deferToPipelineThread(f, *args):
+        parses.append(defer.Deferred())
+        parses[-1].addCallback(lambda _: f(*args))
+        return parses[-1]
+    monkeypatch.setattr(pipeline_cache, 'deferToPipelineThread', deferToPipelineThread)
+    cache = PipelineCache()
+    results = []
+    cache.loadPipeline(basic_yml.format(1)).addCallback(results.append)
+    cache.loadPipeline(basic_yml.format(1)).addCallback(results.append)
+    assert len(parses) == 1
+    assert results == []
+    parses[0].callback(None)
+    assert len(results) == 2
+    assert results[0] is results[1]
+    cache.loadPipeline(basic_yml.format(1)).addCallback(results.append)
+    assert results[2] is results[0]
+    assert len(parses) == 1
@@ -0,0 +1,66 @@
+import pytest
+from twisted.internet import defer
+
+from buildbot_pipelines.pipeline_cache import pipeline_cache
+from buildbot_pipelines.pipeline_store import PipelineStore
+from buildbot_pipelines.yaml_loader import PipelineYml, PipelineYmlInvalid
+
+basic_yml = """
+stages:
+    build:
+        steps:
+            - echo store
+"""
+
+
+class FakeState(object):
+    def __init__(self):
+        self.states = {}
+        self.writes = 0
+
+    def getObjectId(self, name, class_name):
+        return defer.succeed(1)
+
+    def getState(self, objectid, name, default):
+        return defer.succeed(self.states.get((objectid, name), default))
+
+    def setState(self, objectid, name, value):
+        self.writes += 1
+        self.states[(objectid, name)] = value
+        return defer.succeed(None)
+
+
+class FakeMaster(object):
+    def __init__(self):
+        self.db = self
+        self.state = FakeState()
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
+def test_store_once():
+    master = FakeMaster()
+    store = PipelineStore(master)
+    pipeline = PipelineYml(basic_yml)
+    assert result(store.putPipeline(pipeline)) == pipeline.digest
+    result(store.putPipeline(pipeline))
+    # a second master process does not rewrite it either
+    result(PipelineStore(master).putPipeline(pipeline))
+    assert master.state.writes == 1
+    assert result(store.getPipelineText(pipeline.digest)) == basic_yml
+
+
+def test_store_load_cached():
+    store = PipelineStore(FakeMaster())
+    pipeline = pipeline_cache.getPipeline(basic_yml)
+    assert result(store.loadPipeline(pipeline.digest)) is pipeline
+
+
+def test_store_unknown_digest():
+    store = PipelineStore(FakeMaster())
+    with pytest.raises(PipelineYmlInvalid):
+        result(store.loadPipeline("0" * 64)).raiseException()
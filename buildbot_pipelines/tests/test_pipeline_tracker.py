@@ -0,0 +1,112 @@
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.process.results import CANCELLED, FAILURE, SKIPPED, SUCCESS
+
+from buildbot_pipelines.pipeline_tracker import PipelineTracker, aggregateResults
+from buildbot_pipelines.tests.test_stages import FakeMaster, finish
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+pipeline_yml = """
+stages:
+    build:
+        matrix:
+            python: [ "2.7", "3.6" ]
+        steps: [ make ]
+    test:
+        steps: [ make test ]
+"""
+
+
+class FakeMQMaster(FakeMaster):
+    def __init__(self):
+        FakeMaster.__init__(self)
+        self.mq = self
+        self.master = self
+        self.updates = self
+        self.produced = []
+        self.properties = {}
+        self.state_strings = {}
+
+    def produce(self, routingKey, data):
+        self.produced.append((routingKey, data))
+
+    def setBuildProperty(self, buildid, name, value, source):
+        self.properties[(buildid, name)] = value
+        return defer.succeed(None)
+
+    def setBuildStateString(self, buildid, state_string):
+        self.state_strings[buildid] = state_string
+        return defer.succeed(None)
+
+
+def track():
+    master = FakeMQMaster()
+    tracker = PipelineTracker()
+    tracker.parent = master
+    yml = PipelineYml(pipeline_yml)
+    triggers = yml.generate_triggers("codebase", "master")
+    results = []
+    tracker.trackPipeline(12, [], triggers, yml.stage_graph(triggers)).addCallback(results.append)
+    return tracker, master, results
+
+
+def test_track_pipeline():
+    tracker, master, results = track()
+    triggered = master.namedServices['__runner'].triggered
+    assert len(triggered) == 2
+    assert 12 in tracker.pipelines
+    finish(triggered, 0)
+    finish(triggered, 1, FAILURE)
+    # the next stage is triggered by the tracker
+    assert len(triggered) == 3
+    finish(triggered, 2)
+    assert results == [FAILURE]
+    assert tracker.pipelines == {}
+    key, data = master.produced[0]
+    assert key == ("pipelines", "12", "finished")
+    assert data['stages'] == dict(build=FAILURE, test=SUCCESS)
+    # visible on the spawner build
+    assert master.properties[(12, 'pipeline_results')] == FAILURE
+    assert master.state_strings[12] == "pipeline failure"
+
+
+def test_errors_are_logged_once(monkeypatch):
+    tracker, master, results = track()
+    errors = []
+    monkeypatch.setattr(log, 'err', lambda f, why: errors.append(why))
+
+    def setBuildProperty(*args):
+        raise RuntimeError("db is down")
+    master.setBuildProperty = setBuildProperty
+    triggered = master.namedServices['__runner'].triggered
+    finish(triggered, 0)
+    finish(triggered, 1)
+    finish(triggered, 2)
+    assert errors == ["while running the pipeline of build 12"]
+    # the error is not passed to the deferred, nobody would handle it
+    assert results == [None]
+
+
+def test_cancel_pipeline():
+    tracker, master, results = track()
+    triggered = master.namedServices['__runner'].triggered
+    tracker.cancelPipeline(12, "superseded")
+    assert sorted(master.cancelled) == [1, 2]
+    # the next stage is never triggered
+    assert len(triggered) == 2
+    assert results == [CANCELLED]
+    tracker.cancelPipeline(12, "already done")
+
+
+def test_skipped_stages_do_not_count():
+    graph = PipelineYml(pipeline_yml).stage_graph([{'stage': 'build', 'needs': None},
+                                                   {'stage': 'test', 'needs': ['build']}])
+    assert aggregateResults(graph, dict(build=SUCCESS, test=SKIPPED)) == SUCCESS
+
+
+def test_cancel_requested_by_another_master():
+    tracker, master, results = track()
+    tracker.cancelRequested(("pipelines", "12", "cancel"), {'reason': "superseded"})
+    assert sorted(master.cancelled) == [1, 2]
+    assert results == [CANCELLED]
@@ -0,0 +1,186 @@
+import datetime
+import time
+
+from twisted.internet import defer, task
+
+from buildbot.process.results import SUCCESS
+
+from buildbot_pipelines.pipeline_cache import pipeline_cache
+from buildbot_pipelines.schedulers.pipelinecron import PipelineCronService
+from buildbot_pipelines.tests.test_build_avoidance import SqliteMaster
+from buildbot_pipelines.tests.test_pipeline_store import result
+from buildbot_pipelines.tests.test_stages import FakeMaster, finish
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+cron_yml = """
+crons:
+    nightly:
+        timespec: [ "0 2 * * *" ]
+        branches: [ master ]
+        stages: [ build ]
+    hourly:
+        timespec: [ "30 * * * *" ]
+        branches: [ master, release ]
+        stages: [ test ]
+stages:
+    build:
+        matrix:
+            python: [ "2.7", "3.6" ]
+        steps: [ make ]
+    test:
+        steps: [ make test ]
+"""
+
+
+class FakeConsumer(object):
+    def __init__(self, mq, callback):
+        self.mq = mq
+        self.callback = callback
+
+    def stopConsuming(self):
+        self.mq.consumers.remove(self)
+
+
+class FakeMQ(object):
+    """delivers the messages synchronously, as if all the masters shared it"""
+
+    def __init__(self):
+        self.consumers = []
+
+    def startConsuming(self, callback, filter):
+        consumer = FakeConsumer(self, callback)
+        self.consumers.append(consumer)
+        return defer.succeed(consumer)
+
+    def produce(self, routing_key, data):
+        for consumer in list(self.consumers):
+            consumer.callback(routing_key, data)
+
+
+class FakeCronMaster(FakeMaster, SqliteMaster):
+    def __init__(self):
+        FakeMaster.__init__(self)
+        SqliteMaster.__init__(self)
+        self.mq = FakeMQ()
+
+
+def make_service(start=datetime.datetime(2018, 3, 1, 0, 0), master=None, active=True):
+    master = master or FakeCronMaster()
+    svc = PipelineCronService()
+    svc.parent = master
+    svc.active = active
+    result(master.mq.startConsuming(svc.sourceChanged, None))
+    svc._reactor = task.Clock()
+    svc._reactor.advance(time.mktime(start.timetuple()))
+    return svc, master.namedServices['__runner'].triggered
+
+
+def seen(svc, branch, yml=cron_yml):
+    svc.pipelineSeen("git://repo", "cb", "project", branch, PipelineYml(yml))
+
+
+def test_fire_in_order():
+    svc, triggered = make_service()
+    seen(svc, "master")
+    assert len(svc.entries) == 2
+    # a single timer for all entries
+    assert len(svc._reactor.getDelayedCalls()) == 1
+    svc._reactor.advance(30 * 60)
+    assert [props.getProperty('stage_name') for props, _, _ in triggered] == ['test']
+    finish(triggered, 0)
+    svc._reactor.advance(90 * 60)
+    assert [props.getProperty('stage_name') for props, _, _ in triggered[1:]] == ['test', 'build', 'build']
+    assert triggered[1][0].getProperty('yaml_digest') == PipelineYml(cron_yml).digest
+
+
+def test_branch_declares_its_crons():
+    svc, triggered = make_service()
+    seen(svc, "release")
+    seen(svc, "feature")
+    # only hourly lists release, and nothing lists feature
+    assert sorted(k[2:] for k in svc.entries) == [("release", "hourly")]
+
+
+def test_new_pipeline_replaces_crons():
+    svc, triggered = make_service()
+    seen(svc, "master")
+    seen(svc, "master", cron_yml.replace('"30 * * * *"', '"45 * * * *"'))
+    svc._reactor.advance(40 * 60)
+    assert triggered == []
+    svc._reactor.advance(5 * 60)
+    assert len(triggered) == 1
+    # the pipeline without crons removes them
+    seen(svc, "master", "stages: {}")
+    assert svc.entries == {} and svc.sources == {}
+    assert svc._reactor.getDelayedCalls() == []
+
+
+def test_overlapping_runs_are_skipped():
+    svc, triggered = make_service()
+    seen(svc, "master")
+    svc._reactor.advance(30 * 60)
+    svc._reactor.advance(60 * 60)
+    # the 00:30 run is still running at 01:30
+    assert len(triggered) == 1
+    finish(triggered, 0, SUCCESS)
+    svc._reactor.advance(60 * 60)
+    assert len(triggered) == 4
+
+
+def test_sources_survive_restart():
+    svc, _ = make_service()
+    seen(svc, "master")
+    master = svc.master
+    svc2 = PipelineCronService()
+    svc2.parent = master
+    svc2.active = True
+    svc2._reactor = task.Clock()
+    # avoid the parse on the pipeline thread pool
+    pipeline_cache.put(PipelineYml(cron_yml))
+    svc2.loadSources()
+    assert sorted(svc2.entries) == sorted(svc.entries)
+
+
+def test_sources_saved_per_branch():
+    svc, _ = make_service()
+    # another master, sharing the database
+    other, _ = make_service(master=svc.master, active=False)
+    seen(svc, "master")
+    seen(other, "release")
+    pipeline_cache.put(PipelineYml(cron_yml))
+    svc2, _ = make_service(master=svc.master)
+    svc2.loadSources()
+    assert sorted(k[2:] for k in svc2.entries) == [
+        ("master", "hourly"), ("master", "nightly"), ("release", "hourly")]
+    # a pipeline without crons removes its row
+    seen(other, "release", "stages: {}")
+    svc3, _ = make_service(master=svc.master)
+    svc3.loadSources()
+    assert sorted(k[2] for k in svc3.entries) == ["master", "master"]
+
+
+def test_crons_fire_on_the_active_master_only():
+    svc, triggered = make_service()
+    other, _ = make_service(master=svc.master, active=False)
+    pipeline_cache.put(PipelineYml(cron_yml))
+    # the pipeline is seen by a spawner build of the other master
+    seen(other, "master")
+    assert other.entries == {} and other._reactor.getDelayedCalls() == []
+    assert len(svc.entries) == 2
+    svc._reactor.advance(30 * 60)
+    assert len(triggered) == 1
+    # both masters know about the removal of the crons
+    seen(svc, "master", "stages: {}")
+    assert svc.sources == {} and other.sources == {}
+    assert svc.entries == {}
+
+
+def test_deactivate_stops_the_crons():
+    svc, triggered = make_service()
+    seen(svc, "master")
+    result(svc.deactivate())
+    assert svc.entries == {} and svc._reactor.getDelayedCalls() == []
+    svc.active = True
+    pipeline_cache.put(PipelineYml(cron_yml))
+    result(svc.activate())
+    assert len(svc.entries) == 2
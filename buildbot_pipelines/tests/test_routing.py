@@ -0,0 +1,40 @@
+import collections
+
+import pytest
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+from buildbot_pipelines.routing import BranchRouter
+
+
+def make_router(*routes):
+    return BranchRouter(collections.OrderedDict(routes))
+
+
+def test_router_literal():
+    router = make_router(('master', ['build']), ('release/.*', ['release']))
+    assert router.match('master') == ['build']
+    assert router.match('release/1.0') == ['release']
+    assert router.match('feature') == []
+
+
+def test_router_literal_is_prefix():
+    # like re.match, patterns match from the start of the branch name
+    router = make_router(('master', ['build']))
+    assert router.match('master-next') == ['build']
+
+
+def test_router_first_match_wins():
+    router = make_router(('mast.*', ['first']), ('master', ['second']))
+    assert router.match('master') == ['first']
+    router = make_router(('ma', ['first']), ('master', ['second']))
+    assert router.match('master') == ['first']
+
+
+def test_router_invalid_pattern():
+    with pytest.raises(PipelineYmlInvalid):
+        make_router(('release/(.*', ['build']))
+
+
+def test_router_invalid_stages():
+    with pytest.raises(PipelineYmlInvalid):
+        make_router(('master', 'build'))
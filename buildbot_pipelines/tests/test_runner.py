@@ -0,0 +1,122 @@
+import subprocess
+
+from twisted.internet import defer
+
+from buildbot.process.properties import Properties
+
+from buildbot_pipelines.steps.checkout import ReferenceGitCheckout
+from buildbot_pipelines.steps.runner import RunnerStep, ShellCommand, fuse_commands
+from buildbot_pipelines.worker_selection import ImageAffinityWorkerPicker
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+runner_yml = """
+stages:
+    build:
+        fuse_steps: {fuse}
+        source_checkout: false
+        steps:
+            - echo one
+            - title: two
+              cmd: echo two
+            - title: never
+              cmd: echo never
+              condition: "False"
+            - !ShellCommand
+                command: make
+            - echo three
+            - echo four
+"""
+
+
+class FakeBuild(object):
+    def __init__(self):
+        self.batches = []
+
+    def addStepsAfterLastStep(self, steps):
+        self.batches.append(steps)
+
+    def getProperties(self):
+        return Properties()
+
+
+def run_runner(fuse, checkout=False):
+    yml = PipelineYml(runner_yml.format(fuse=fuse).replace(
+        "source_checkout: false", "source_checkout: {}".format(checkout)))
+    step = RunnerStep()
+    step.build = FakeBuild()
+    step.getStepConfig = lambda: defer.succeed(yml)
+    step.getProperty = lambda name: 'build'
+    step.run()
+    assert len(step.build.batches) == 1
+    return step.build.batches[0]
+
+
+def test_steps_added_in_one_batch():
+    steps = run_runner(False, checkout=True)
+    assert isinstance(steps[0], ReferenceGitCheckout)
+    assert [s.name for s in steps[1:]] == ['echo one', 'two', 'shell', 'echo three', 'echo four']
+
+
+def test_fuse_steps():
+    steps = run_runner(True)
+    assert [s.name for s in steps] == ['echo one (+1)', 'shell', 'echo three (+1)']
+    assert isinstance(steps[0], ShellCommand)
+
+
+def run_script(commands):
+    (name, command), = fuse_commands(commands, 47)
+    p = subprocess.Popen(command, stdout=subprocess.PIPE)
+    out = p.communicate()[0].decode('utf-8')
+    return name, p.returncode, out
+
+
+def test_fused_script():
+    name, rc, out = run_script([('first', ['bash', '-c', 'echo "a b"']),
+                                ('second', ['bash', '-c', 'cd /; pwd\nexit 4']),
+                                ('third', ['bash', '-c', 'echo not reached'])])
+    assert name == 'first (+2)'
+    assert rc == 4
+    assert out == "### [1/3] first\na b\n### [2/3] second\n/\n"
+
+
+def test_fused_name_length():
+    name, _, _ = run_script([('x' * 60, ['true']), ('y', ['true'])])
+    assert len(name) == 47 and name.endswith("... (+1)")
+
+
+def test_no_checkout_when_a_step_checks_out():
+    yml = PipelineYml("""
+stages:
+    build:
+        steps:
+            - !Git
+                repourl: !i "%(prop:repository)s"
+            - make
+    test:
+        steps:
+            - title: checkout
+              step: !Git
+                repourl: !i "%(prop:repository)s"
+    lint:
+        steps: [ make lint ]
+    forced:
+        source_checkout: true
+        steps:
+            - !Git
+                repourl: !i "%(prop:repository)s"
+""")
+    assert not yml.needs_source_checkout('build')
+    assert not yml.needs_source_checkout('test')
+    assert yml.needs_source_checkout('lint')
+    assert yml.needs_source_checkout('forced')
+
+
+def test_runner_records_worker_image():
+    picker = ImageAffinityWorkerPicker()
+    step = RunnerStep(worker_picker=picker)
+    step.build = FakeBuild()
+    step.getStepConfig = lambda: defer.succeed(PipelineYml(runner_yml.format(fuse=False)))
+    properties = dict(stage_name='build', workername='docker1', worker_image='android')
+    step.getProperty = properties.get
+    step.run()
+    assert picker.imageAge('docker1', 'android') == 0
@@ -0,0 +1,81 @@
+import pytest
+
+from buildbot_pipelines.schema import SchemaInvalid, SchemaValidator
+from buildbot_pipelines.yaml_loader import PipelineYml, PipelineYmlInvalid, load_yaml, PipeLineYamlLoader
+
+
+def invalid(yml_text):
+    with pytest.raises(SchemaInvalid) as e:
+        PipelineYml(yml_text)
+    return e.value
+
+
+def test_location():
+    e = invalid("env:\n  A: 1\nstages:\n  build:\n    matrix:\n      python: 3.6\n")
+    assert e.path == ('stages', 'build', 'matrix', 'python')
+    assert (e.line, e.column) == (6, 15)
+    assert str(e) == ("stages.build.matrix.python (line 6, column 15): "
+                      "expected a list of scalars, got float")
+
+
+def test_location_in_list():
+    e = invalid("stages:\n  build:\n    needs:\n      - lint\n      - [ unit ]\n  lint: {}\n")
+    assert e.path == ('stages', 'build', 'needs', 1)
+    assert (e.line, e.column) == (5, 9)
+
+
+def test_shapes():
+    invalid("- stages\n")
+    invalid("stages:\n  build: [ make ]\n")
+    invalid("stages:\n  build:\n    worker: docker\n")
+    invalid("stages:\n  build:\n    fail_fast: yes please\n")
+    invalid("stages:\n  build:\n    max_parallel: true\n")
+    invalid("stages:\n  build:\n    matrix:\n      python: []\n")
+    invalid("stages:\n  build:\n    env:\n      A: [ 1 ]\n")
+    invalid("branches:\n  master: build\n")
+    invalid("branches:\n  master:\n    push: build\n")
+    invalid("crons:\n  nightly:\n    timespec: 12\n")
+
+
+def test_oversized(monkeypatch):
+    monkeypatch.setattr(PipelineYml, 'max_steps', 3)
+    monkeypatch.setattr(PipelineYml, 'max_matrix_cells', 10)
+    PipelineYml("stages:\n  build:\n    steps: [ a, b, c ]\n")
+    e = invalid("stages:\n  build:\n    steps: [ a, b, c, d ]\n")
+    assert e.path == ('stages', 'build', 'steps')
+    e = invalid("stages:\n  build:\n    matrix:\n      a: [ 1, 2, 3, 4 ]\n      b: [ 1, 2, 3 ]\n")
+    assert e.path == ('stages', 'build', 'matrix')
+    assert e.line == 4
+
+
+def test_verdicts_are_cached():
+    validator = SchemaValidator()
+    calls = []
+
+    def schema(ctx, cfg):
+        calls.append(cfg)
+        if cfg.get('bad'):
+            raise SchemaInvalid("bad")
+    validator.schema = schema
+    cfg, marks = load_yaml("stages: {}\n", PipeLineYamlLoader)
+    validator.validate("digest1", cfg, marks, 10, 10)
+    validator.validate("digest1", cfg, marks, 10, 10)
+    assert len(calls) == 1
+    cfg, marks = load_yaml("bad: true\n", PipeLineYamlLoader)
+    errors = []
+    for _ in range(2):
+        with pytest.raises(PipelineYmlInvalid) as e:
+            validator.validate("digest2", cfg, marks, 10, 10)
+        errors.append(e.value)
+    assert len(calls) == 2
+    # a new exception each time, which does not keep the frames of the validation
+    assert errors[0] is not errors[1]
+    assert str(errors[0]) == str(errors[1]) == "document: bad"
+
+
+def test_messages():
+    e = invalid("stages:\n  build:\n    needs: lint\n")
+    assert e.reason == "expected a list of strings, got str"
+    e = invalid("branches:\n  master: build\n")
+    assert e.reason == ("expected a list of strings or a mapping of lists of strings, "
+                        "got str")
@@ -0,0 +1,195 @@
+import pytest
+from twisted.internet import defer
+
+from buildbot.process.results import CANCELLED, FAILURE, SKIPPED, SUCCESS, WARNINGS
+
+from buildbot_pipelines.errors import PipelineYmlInvalid
+from buildbot_pipelines.stages import StageGraph, StageTriggerer
+from buildbot_pipelines.steps.spawner import MultiplePropertyTrigger
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+dag_yml = """
+stages:
+    lint:
+        needs: []
+        steps: [ flake8 ]
+    unit:
+        needs: []
+        steps: [ pytest ]
+    docs:
+        needs: []
+        steps: [ make docs ]
+    package:
+        needs: [ lint, unit ]
+        steps: [ make dist ]
+    deploy:
+        steps: [ make deploy ]
+"""
+
+
+class FakeTriggerer(StageTriggerer):
+    """stages finish when the test fires their deferred"""
+
+    def __init__(self):
+        StageTriggerer.__init__(self, None, [])
+        self.running = {}
+
+    def triggerStage(self, trigger):
+        self.running[trigger['stage']] = d = defer.Deferred()
+        return d
+
+
+def run_dag():
+    yml = PipelineYml(dag_yml)
+    triggers = yml.generate_triggers("codebase", "master")
+    triggerer = FakeTriggerer()
+    results = []
+    triggerer.runStages(triggers, yml.stage_graph(triggers)).addCallback(results.append)
+    return triggerer, results
+
+
+def test_graph_sequential_without_needs():
+    graph = StageGraph(['a', 'b', 'c'], {})
+    assert graph.is_sequential
+    assert graph.dependencies('a') == set()
+    assert graph.dependencies('c') == set(['b'])
+
+
+def test_graph_needs_unknown_stage():
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("stages:\n  a:\n    needs: [ b ]\n")
+
+
+def test_graph_cycle():
+    with pytest.raises(PipelineYmlInvalid):
+        PipelineYml("stages:\n  a:\n    needs: [ b ]\n  b:\n    needs: [ a ]\n")
+    # implicit ordering also counts
+    with pytest.raises(PipelineYmlInvalid):
+        StageGraph(['a', 'b'], {'a': ['b']})
+
+
+def test_run_stages_concurrently():
+    triggerer, results = run_dag()
+    assert sorted(triggerer.running) == ['docs', 'lint', 'unit']
+    triggerer.running['lint'].callback(SUCCESS)
+    assert 'package' not in triggerer.running
+    triggerer.running['unit'].callback(SUCCESS)
+    assert 'package' in triggerer.running
+    triggerer.running['package'].callback(SUCCESS)
+    # deploy does not use needs, so it runs after the previous stage
+    assert 'deploy' in triggerer.running
+    triggerer.running['deploy'].callback(SUCCESS)
+    assert results == []
+    triggerer.running['docs'].callback(SUCCESS)
+    assert results[0] == dict(lint=SUCCESS, unit=SUCCESS, docs=SUCCESS, package=SUCCESS, deploy=SUCCESS)
+
+
+def test_run_stages_skip_on_failure():
+    triggerer, results = run_dag()
+    triggerer.running['lint'].callback(FAILURE)
+    triggerer.running['unit'].callback(SUCCESS)
+    assert 'package' not in triggerer.running
+    # deploy only runs after package, whatever its result
+    triggerer.running['deploy'].callback(SUCCESS)
+    triggerer.running['docs'].callback(SUCCESS)
+    assert results[0] == dict(lint=FAILURE, unit=SUCCESS, docs=SUCCESS, package=SKIPPED, deploy=SUCCESS)
+
+
+class FakeScheduler(object):
+    name = '__runner'
+
+    def __init__(self):
+        self.triggered = []
+
+    def trigger(self, waited_for, sourcestamps=None, set_props=None, parent_buildid=None,
+                parent_relationship=None):
+        brid = len(self.triggered) + 1
+        resultsDeferred = defer.Deferred()
+        self.triggered.append((set_props, brid, resultsDeferred))
+        return defer.succeed((brid, {1: brid})), resultsDeferred
+
+
+class FakeMaster(object):
+    def __init__(self):
+        self.scheduler_manager = self
+        self.namedServices = {'__runner': FakeScheduler()}
+        self.data = self
+        self.cancelled = []
+
+    def control(self, action, args, path):
+        self.cancelled.append(path[1])
+        # the buildrequest completes as cancelled
+        for _, brid, d in self.namedServices['__runner'].triggered:
+            if brid == path[1] and not d.called:
+                d.callback((CANCELLED, {1: brid}))
+
+
+def trigger_stage(**options):
+    master = FakeMaster()
+    trigger = dict(stage='build', buildrequests=list(range(5)), **options)
+    results = []
+    StageTriggerer(master, []).triggerStage(trigger).addCallback(results.append)
+    return master.namedServices['__runner'].triggered, master, results
+
+
+def finish(triggered, index, result=SUCCESS):
+    _, brid, d = triggered[index]
+    d.callback((result, {1: brid}))
+
+
+def test_stage_max_parallel():
+    triggered, _, results = trigger_stage(max_parallel=2)
+    assert len(triggered) == 2
+    finish(triggered, 0)
+    assert len(triggered) == 3
+    finish(triggered, 1)
+    finish(triggered, 2)
+    finish(triggered, 3)
+    assert len(triggered) == 5
+    assert results == []
+    finish(triggered, 4, WARNINGS)
+    assert results == [WARNINGS]
+
+
+def test_stage_all_at_once():
+    triggered, _, results = trigger_stage()
+    assert len(triggered) == 5
+
+
+def test_stage_fail_fast():
+    triggered, master, results = trigger_stage(max_parallel=3, fail_fast=True)
+    finish(triggered, 0)
+    finish(triggered, 2, FAILURE)
+    # pending buildrequests are never released, running ones are cancelled
+    assert len(triggered) == 4
+    assert sorted(master.cancelled) == [2, 4]
+    assert results == [FAILURE]
+
+
+def test_stage_no_fail_fast():
+    triggered, master, results = trigger_stage(max_parallel=3)
+    finish(triggered, 0, FAILURE)
+    assert len(triggered) == 4
+    assert master.cancelled == []
+
+
+class FakeBuild(object):
+    conn = object()
+
+
+def test_stage_interrupt_stops_release():
+    master = FakeMaster()
+    step = MultiplePropertyTrigger([], max_parallel=2)
+    step.master = master
+    step.build = FakeBuild()
+    step.running = True
+    step.triggerer = StageTriggerer(master, [])
+    results = []
+    step.triggerer.triggerStage(dict(stage='build', buildrequests=list(range(5)),
+                                     max_parallel=2)).addCallback(results.append)
+    step.interrupt('stopped')
+    triggered = master.namedServices['__runner'].triggered
+    # the cancelled buildrequests do not release the pending ones
+    assert len(triggered) == 2
+    assert sorted(master.cancelled) == [1, 2]
+    assert results == [CANCELLED]
@@ -0,0 +1,45 @@
+from buildbot_pipelines.supersede import ActivePipelines
+from buildbot_pipelines.tests.test_build_avoidance import SqliteMaster
+from buildbot_pipelines.tests.test_pipeline_store import result
+from buildbot_pipelines.yaml_loader import PipelineYml
+
+
+def activate(active, *args):
+    return result(active.activate(*args))
+
+
+def test_supersede_previous():
+    active = ActivePipelines(SqliteMaster())
+    assert activate(active, 'cb', 'master', 1, 10) is None
+    assert activate(active, 'cb', 'other', 2, 11) is None
+    assert activate(active, 'cb', 'master', 3, 12) == 10
+    assert activate(active, 'cb', 'master', 4, 13) == 12
+
+
+def test_supersede_not_by_older_change():
+    active = ActivePipelines(SqliteMaster())
+    activate(active, 'cb', 'master', 3, 10)
+    # rebuild of an older change
+    assert activate(active, 'cb', 'master', 2, 11) is None
+    assert activate(active, 'cb', 'master', 4, 12) == 10
+
+
+def test_supersede_deactivate():
+    active = ActivePipelines(SqliteMaster())
+    activate(active, 'cb', 'master', 1, 10)
+    result(active.deactivate('cb', 'master', 11))
+    assert activate(active, 'cb', 'master', 2, 12) == 10
+    result(active.deactivate('cb', 'master', 12))
+    assert activate(active, 'cb', 'master', 3, 13) is None
+
+
+def test_supersede_across_masters():
+    db = SqliteMaster()
+    # the previous pipeline was handled by another master
+    activate(ActivePipelines(db), 'cb', 'master', 1, 10)
+    assert activate(ActivePipelines(db), 'cb', 'master', 2, 11) == 10
+
+
+def test_auto_cancel_option():
+    assert not PipelineYml("stages: {}").auto_cancel
+    assert PipelineYml("auto_cancel: true\nstages: {}").auto_cancel
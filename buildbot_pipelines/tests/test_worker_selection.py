@@ -0,0 +1,64 @@
+from buildbot.process.properties import Properties
+
+from buildbot_pipelines.worker_selection import ImageAffinityWorkerPicker
+
+
+class FakeWorker(object):
+    def __init__(self, name):
+        self.worker = self
+        self.workername = name
+
+
+class FakeBuildRequest(object):
+    def __init__(self, **props):
+        self.properties = Properties()
+        for k, v in props.items():
+            self.properties.setProperty(k, v, 'test')
+
+
+workers = [FakeWorker(name) for name in ['docker1', 'docker2', 'docker3', 'farm1']]
+
+
+def pick(picker, **props):
+    return picker.nextWorker(None, workers, FakeBuildRequest(**props)).workername
+
+
+def test_pick_pool():
+    picker = ImageAffinityWorkerPicker({'testfarm': ['farm1'], 'docker': ['docker1', 'docker2', 'docker3']})
+    for _ in range(10):
+        assert pick(picker, worker_type='testfarm') == 'farm1'
+        assert pick(picker, worker_type='docker') != 'farm1'
+    assert pick(picker, worker_type='unknown') in [w.workername for w in workers]
+    assert not picker.canStartBuild(None, workers[0], FakeBuildRequest(worker_type='testfarm'))
+    assert picker.canStartBuild(None, workers[0], FakeBuildRequest())
+
+
+def test_pick_warm_image():
+    picker = ImageAffinityWorkerPicker()
+    first = pick(picker, worker_image='android')
+    # the build started on the picked worker
+    picker.recordImage(first, 'android')
+    for _ in range(10):
+        assert pick(picker, worker_image='android') == first
+
+
+def test_pick_does_not_record():
+    picker = ImageAffinityWorkerPicker()
+    pick(picker, worker_image='android')
+    # the pick can still be rejected, only started builds count
+    assert picker.images == {}
+    picker.recordImage('docker1', None)
+    assert picker.images == {}
+
+
+def test_pick_most_recent_image():
+    picker = ImageAffinityWorkerPicker()
+    picker.recordImage('docker1', 'android')
+    picker.recordImage('docker1', 'base')
+    picker.recordImage('docker2', 'android')
+    assert pick(picker, worker_image='android') == 'docker2'
+
+
+def test_pick_no_candidate():
+    picker = ImageAffinityWorkerPicker({'testfarm': ['farm2']})
+    assert picker.nextWorker(None, workers, FakeBuildRequest(worker_type='testfarm')) is None
@@ -1,9 +1,13 @@
 import os
+import subprocess
+import sys
 
 import pytest
 
 from buildbot_pipelines import package_loader
-from buildbot_pipelines.yaml_loader import PipelineYml, YmlProperties
+from buildbot_pipelines.matrix import Matrix, MatrixTooLarge
+from buildbot_pipelines.yaml_loader import (CPipeLineYamlLoader, PipelineYml,
+                                           PipeLineYamlLoader, YmlProperties)
 
 
 def load_example(*path):
@@ -70,8 +74,8 @@ def test_yml_android_trigger_pr(android_pipeline):
     assert len(triggers[0]['buildrequests']) == 5
     assert len(triggers[1]['buildrequests']) == 2
     props = triggers[1]['buildrequests'][0].asDict()
-    assert props['yaml_text'][0] == android_pipeline
-    del props['yaml_text']
+    assert props['yaml_digest'][0] == yml.digest
+    del props['yaml_digest']
     assert props == {
         'worker_type': ('testfarm', 'yml_worker'),
         'worker_image': ('workertestfarm-stability', 'yml_worker'),
@@ -90,8 +94,8 @@ def test_yml_basic_trigger(basic_pipeline):
     assert len(triggers) == 1
     print(triggers)
     props = triggers[0]['buildrequests'][0].asDict()
-    assert props['yaml_text'][0] == basic_pipeline
-    del props['yaml_text']
+    assert props['yaml_digest'][0] == yml.digest
+    del props['yaml_digest']
     assert props == {
         u'stage_name': ('tox', u'yml_stage'),
         u'virtual_builder_name': ('codebase tox', u'yml_stage'),
@@ -150,3 +154,85 @@ def test_yml_properties_from_source():
     p.setProperty('b', 2, 'B')
     assert p.getPropertiesForSource('B') == {'b': 2}
     assert p.getPropertiesForSource('A') == {'a': 1}
+
+
+@pytest.mark.skipif(CPipeLineYamlLoader is None, reason="pyyaml built without LibYAML")
+def test_yml_libyaml_loader(android_pipeline):
+    yml = PipelineYml(android_pipeline, loader=CPipeLineYamlLoader)
+    pure_yml = PipelineYml(android_pipeline, loader=PipeLineYamlLoader)
+    assert yml.cfg == pure_yml.cfg
+
+
+def test_yml_matrix_order():
+    res = PipelineYml.compute_matrix({'a': [1, 2], 'b': [3, 4]}, [{'a': 1, 'b': 4}, {'a': 5}], [{'a': 2, 'b': 3}])
+    assert res == [{'a': 1, 'b': 3}, {'a': 2, 'b': 4}, {'a': 1, 'b': 4}, {'a': 5}]
+
+
+def test_yml_matrix_include_only():
+    res = PipelineYml.compute_matrix({}, [{'a': 1}, {'a': 1}, {'a': 2}])
+    assert res == [{'a': 1}, {'a': 2}]
+
+
+def test_yml_matrix_exclude_included():
+    res = PipelineYml.compute_matrix({'a': [1]}, [{'a': 2, 'b': 3}], [{'b': 3}])
+    assert res == [{'a': 1}]
+
+
+def test_yml_matrix_unhashable_values():
+    res = PipelineYml.compute_matrix({'a': [[1, 2], {'b': 3}]}, [], [{'a': [1, 2]}])
+    assert res == [{'a': {'b': 3}}]
+
+
+def test_yml_matrix_too_large():
+    with pytest.raises(MatrixTooLarge):
+        PipelineYml.compute_matrix({'a': list(range(10)), 'b': list(range(10))}, max_cells=99)
+    # excludes are taken into account
+    res = PipelineYml.compute_matrix({'a': list(range(10)), 'b': list(range(10))}, [], [{'a': 0}], max_cells=90)
+    assert len(res) == 90
+
+
+def test_yml_matrix_stream():
+    matrix = Matrix({'a': list(range(1000)), 'b': list(range(1000))})
+    cells = iter(matrix)
+    assert next(cells) == {'a': 0, 'b': 0}
+    assert next(cells) == {'a': 0, 'b': 1}
+
+
+def test_yml_loading_does_not_mutate_loader(android_pipeline):
+    constructors = dict(PipeLineYamlLoader.yaml_constructors)
+    PipelineYml(android_pipeline, loader=PipeLineYamlLoader)
+    PipelineYml("stages:\n  build:\n    steps: [ !ShellCommand { command: make } ]\n",
+                loader=PipeLineYamlLoader)
+    assert PipeLineYamlLoader.yaml_constructors == constructors
+
+
+def test_yml_imports_are_per_document(android_pipeline):
+    PipelineYml(android_pipeline)
+    # the tags imported by the android pipeline are not known to other documents
+    with pytest.raises(AttributeError):
+        PipelineYml("stages:\n  build:\n    steps: [ !DiffManifest ]\n")
+
+
+def test_yml_unknown_tag():
+    with pytest.raises(AttributeError):
+        PipelineYml("stages:\n  build:\n    steps: [ !NoSuchStep ]\n")
+
+
+def test_yml_step_plugins_are_lazy():
+    script = (
+        "import sys\n"
+        "from buildbot_pipelines.yaml_loader import PipelineYml\n"
+        "assert 'buildbot.steps.cppcheck' not in sys.modules\n"
+        "PipelineYml('stages:\\n  a:\\n    steps: [ !Cppcheck { } ]\\n')\n"
+        "assert 'buildbot.steps.cppcheck' in sys.modules\n")
+    subprocess.check_call([sys.executable, "-c", script])
+
+
+def test_package_import_is_lazy():
+    script = (
+        "import sys\n"
+        "import buildbot_pipelines\n"
+        "assert 'buildbot_pipelines.configurator' not in sys.modules\n"
+        "from buildbot_pipelines import PipelineConfigurator\n"
+        "assert 'buildbot_pipelines.configurator' in sys.modules\n")
+    subprocess.check_call([sys.executable, "-c", script])
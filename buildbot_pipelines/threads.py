@@ -0,0 +1,31 @@
+"""Dedicated thread pool for the blocking work of buildbot_pipelines
+
+Parsing pipelines (and loading the packages they import) must never run on the
+reactor thread, as it would stall every other build and the web UI.
+"""
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet import reactor, threads
+from twisted.python import threadpool
+
+DEFAULT_POOL_SIZE = 4
+
+_pool = None
+
+
+def getThreadPool():
+    global _pool
+    if _pool is None:
+        _pool = threadpool.ThreadPool(minthreads=0, maxthreads=DEFAULT_POOL_SIZE,
+                                      name='buildbot_pipelines')
+        reactor.callWhenRunning(_pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', _pool.stop)
+    return _pool
+
+
+def setPoolSize(size):
+    getThreadPool().adjustPoolsize(minthreads=0, maxthreads=size)
+
+
+def deferToPipelineThread(f, *args, **kwargs):
+    return threads.deferToThreadPool(reactor, getThreadPool(), f, *args, **kwargs)
@@ -0,0 +1,83 @@
+"""Worker selection for the __runner builder
+
+Buildrequests carry the 'worker_type' and 'worker_image' of their stage. They are routed to
+the pool of workers of that type, and preferably to a worker which recently ran the same
+image, so that the image is still warm in its docker cache. Images are recorded when the
+runner build starts on the worker, not when the worker is picked, as a pick can still be
+rejected, or the build fail to start.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import random
+
+# number of images remembered per worker
+RECENT_IMAGES = 5
+
+
+class ImageAffinityWorkerPicker(object):
+
+    def __init__(self, pools=None, recent_images=RECENT_IMAGES):
+        """
+        @param pools: dict worker_type -> worker names. buildrequests of a type without a pool
+                      can run on any worker.
+        """
+        self.pools = dict((worker_type, set(names)) for worker_type, names in (pools or {}).items())
+        self.recent_images = recent_images
+        # workername -> deque of images, most recent last
+        self.images = {}
+
+    def getWorkerType(self, buildrequest):
+        return buildrequest.properties.getProperty('worker_type')
+
+    def getWorkerImage(self, buildrequest):
+        return buildrequest.properties.getProperty('worker_image')
+
+    def acceptsWorker(self, workername, buildrequest):
+        pool = self.pools.get(self.getWorkerType(buildrequest))
+        return pool is None or workername in pool
+
+    def canStartBuild(self, builder, workerforbuilder, buildrequest):
+        return self.acceptsWorker(workerforbuilder.worker.workername, buildrequest)
+
+    def imageAge(self, workername, image):
+        """0 if image is the last one run by the worker, 1 for the one before... None if unknown"""
+        images = self.images.get(workername, ())
+        if image not in images:
+            return None
+        return len(images) - 1 - list(images).index(image)
+
+    def recordImage(self, workername, image):
+        """called when a build of image started on the worker"""
+        if image is None:
+            return
+        images = self.images.setdefault(workername, collections.deque(maxlen=self.recent_images))
+        if image in images:
+            images.remove(image)
+        images.append(image)
+
+    def nextWorker(self, builder, workers, buildrequest):
+        candidates = [w for w in workers
+                      if self.acceptsWorker(w.worker.workername, buildrequest)]
+        if not candidates:
+            return None
+        image = self.getWorkerImage(buildrequest)
+        if image is None:
+            return random.choice(candidates)
+        warm = [(self.imageAge(w.worker.workername, image), w) for w in candidates]
+        warm = [(age, w) for age, w in warm if age is not None]
+        if warm:
+            best = min(age for age, _ in warm)
+            return random.choice([w for age, w in warm if age == best])
+        return random.choice(candidates)
+
+
+def getWorkerPools(workers):
+    """pools of workers, according to their 'worker_type' property"""
+    pools = {}
+    for worker in workers:
+        properties = getattr(worker, 'properties', None)
+        worker_type = properties.getProperty('worker_type') if properties is not None else None
+        if worker_type is not None:
+            pools.setdefault(worker_type, []).append(worker.workername)
+    return pools
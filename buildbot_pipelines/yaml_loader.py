@@ -1,41 +1,99 @@
 import collections
-import re
+import hashlib
+import threading
 
 import yaml
 
 from buildbot.plugins import util
 from buildbot.plugins.db import get_plugins
 from buildbot.process.properties import Properties
+from buildbot.steps.source.base import Source
 
 from . import package_loader
+from .build_avoidance import NotCanonical, avoidance_key, canonical
+from .conditions import compile_condition
+from .cron import compile_crons
+from .errors import PipelineYmlInvalid
+from .matrix import DEFAULT_MAX_CELLS, Matrix
+from .paths import PathFilter
+from .routing import BranchRouter
+from .schema import DEFAULT_MAX_STEPS, schema_validator
+from .stages import StageGraph, check_acyclic
 
-steps = get_plugins('steps', None, load_now=True)
+# only the entry point names are read, plugin modules are imported on first use of their tag
+steps = get_plugins('steps', None)
 
 
-class PipeLineYamlLoader(yaml.SafeLoader):
+class TagRegistry(object):
+    """tag -> step class map of the steps plugins
+
+    the set of tags is read once from the entry points, and never changes. A plugin is only
+    imported the first time its tag is looked up.
+    """
+
+    def __init__(self, plugins):
+        self._plugins = plugins
+        self._tags = None
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def tags(self):
+        if self._tags is None:
+            with self._lock:
+                if self._tags is None:
+                    self._tags = frozenset("!" + name for name in self._plugins.names)
+        return self._tags
+
+    def __contains__(self, tag):
+        return tag in self.tags()
+
+    def get(self, tag, default=None):
+        if tag not in self.tags():
+            return default
+        if tag not in self._loaded:
+            with self._lock:
+                if tag not in self._loaded:
+                    self._loaded[tag] = self._plugins.get(tag[1:])
+        return self._loaded[tag]
+
+
+step_registry = TagRegistry(steps)
+
+
+class PipeLineYamlConstructor(object):
+    """custom tags support, shared by the pure python and the LibYAML based loaders
+
+    the loader classes are never mutated: step tags are looked up in the shared
+    step_registry, and the tags of '!Imports' in a per load overlay
+    """
+
+    def __init__(self, stream):
+        super(PipeLineYamlConstructor, self).__init__(stream)
+        # tag -> step class maps of the packages imported by this document
+        self.imported_tags = []
+        # (id(mapping or list), key or index) -> yaml mark of the value, for error messages
+        self.value_marks = {}
+
+    def lookup_step(self, tag):
+        for tags in self.imported_tags:
+            if tag in tags:
+                return tags[tag]
+        if tag in step_registry:
+            return step_registry.get(tag)
+        if not tag.startswith("!"):
+            raise AttributeError("illegal yaml tag: {}".format(tag.encode('utf-8')))
+        raise AttributeError("No buildbot plugin found for name: {}".format(tag[1:]))
 
     def construct_object(self, node, deep=False):
-        if node.tag not in self.yaml_constructors:
-            if not node.tag.startswith("!"):
-                raise AttributeError("illegal yaml tag: {}".format(node.tag.encode('utf-8')))
-            k = node.tag[1:]
-            if k in steps.names:
-                v = steps.get(k)
-                self.add_constructor(node.tag, lambda loader, node: self.construct_custom_object(v, node))
-            else:
-                raise AttributeError("No buildbot plugin found for name: {}".format(k))
-        return yaml.SafeLoader.construct_object(self, node, deep)
+        if node.tag in self.yaml_constructors or node in self.constructed_objects:
+            return super(PipeLineYamlConstructor, self).construct_object(node, deep)
+        data = self.construct_custom_object(self.lookup_step(node.tag), node)
+        self.constructed_objects[node] = data
+        return data
 
     def construct_import(self, node):
-        imports = self.construct_sequence(node)
-
-        def makeConstructor(typ):
-            def constructor(loader, node):
-                return loader.construct_custom_object(typ, node)
-            return constructor
-        for i in imports:
-            for k, v in package_loader.import_package(i).items():
-                self.add_constructor(k, makeConstructor(v))
+        for package in self.construct_sequence(node):
+            self.imported_tags.append(package_loader.import_package(package))
 
     def construct_custom_object(self, loader, node):
         args = []
@@ -47,7 +105,7 @@ class PipeLineYamlLoader(yaml.SafeLoader):
             else:
                 args = [scalar]
         elif isinstance(node, yaml.nodes.SequenceNode):
-            args = yaml.constructor.BaseConstructor.construct_sequence(node, deep=True)
+            args = self.construct_sequence(node, deep=True)
         elif isinstance(node, yaml.nodes.MappingNode):
             kwargs = yaml.constructor.BaseConstructor.construct_mapping(self, node, deep=True)
         r = loader(*args, **kwargs)
@@ -58,18 +116,50 @@ class PipeLineYamlLoader(yaml.SafeLoader):
         return util.Interpolate(value)
 
     def dict_constructor(self, node):
-        return collections.OrderedDict(self.construct_pairs(node))
+        pairs = self.construct_pairs(node)
+        result = collections.OrderedDict(pairs)
+        for (key, _), (_, value_node) in zip(pairs, node.value):
+            self.value_marks[(id(result), key)] = value_node.start_mark
+        return result
 
+    def list_constructor(self, node):
+        result = self.construct_sequence(node)
+        for i, item_node in enumerate(node.value):
+            self.value_marks[(id(result), i)] = item_node.start_mark
+        return result
 
-PipeLineYamlLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, PipeLineYamlLoader.dict_constructor)
-PipeLineYamlLoader.add_constructor("!Imports", PipeLineYamlLoader.construct_import)
-PipeLineYamlLoader.add_constructor(u'!Interpolate', PipeLineYamlLoader.construct_interpolate)
-PipeLineYamlLoader.add_constructor(u'!i', PipeLineYamlLoader.construct_interpolate)
+    @classmethod
+    def add_pipeline_constructors(cls):
+        cls.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, cls.dict_constructor)
+        cls.add_constructor(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, cls.list_constructor)
+        cls.add_constructor("!Imports", cls.construct_import)
+        cls.add_constructor(u'!Interpolate', cls.construct_interpolate)
+        cls.add_constructor(u'!i', cls.construct_interpolate)
 
 
-class PipelineYmlInvalid(Exception):
+class PipeLineYamlLoader(PipeLineYamlConstructor, yaml.SafeLoader):
     pass
 
+
+PipeLineYamlLoader.add_pipeline_constructors()
+
+# LibYAML accelerated variant, when pyyaml is built with it
+CPipeLineYamlLoader = None
+if getattr(yaml, '__with_libyaml__', False):
+    class CPipeLineYamlLoader(PipeLineYamlConstructor, yaml.CSafeLoader):
+        pass
+
+    CPipeLineYamlLoader.add_pipeline_constructors()
+
+DefaultPipeLineYamlLoader = CPipeLineYamlLoader or PipeLineYamlLoader
+
+
+def pipeline_digest(yaml_text):
+    if not isinstance(yaml_text, bytes):
+        yaml_text = yaml_text.encode('utf-8')
+    return hashlib.sha256(yaml_text).hexdigest()
+
+
 class YmlProperties(Properties):
     def setProperty(self, name, value, source, runtime=False):
         value = self.render(value)
@@ -90,79 +180,144 @@ class YmlProperties(Properties):
             self.setProperty('virtual_builder_tags', matrix_props, "yml_stage")
 
 
+def load_yaml(yaml_text, loader):
+    """return the parsed document, and the marks of its values"""
+    loader = loader(yaml_text)
+    try:
+        return loader.get_single_data(), loader.value_marks
+    finally:
+        loader.dispose()
+
+
 class PipelineYml(object):
-    def __init__(self, yaml_text):
+    max_matrix_cells = DEFAULT_MAX_CELLS
+    max_steps = DEFAULT_MAX_STEPS
+
+    def __init__(self, yaml_text, loader=None):
         # warning: this may do networking + whl uncompressing to load the imports
         # need to process this on a thread when inside twisted/buildbot
+        # (see pipeline_cache.loadPipeline)
         self.yaml_text = yaml_text
-        self.cfg = yaml.load(yaml_text, Loader=PipeLineYamlLoader)
+        self.digest = pipeline_digest(yaml_text)
+        self.cfg, marks = load_yaml(yaml_text, loader or DefaultPipeLineYamlLoader)
+        # before the other checks, which do not know where the errors are
+        schema_validator.validate(self.digest, self.cfg, marks, self.max_matrix_cells, self.max_steps)
+        self.branch_router = None
+        if 'branches' in self.cfg:
+            self.branch_router = BranchRouter(self.cfg['branches'])
+        self.validate_conditions()
+        self.validate_needs()
+        self.validate_fanout()
+        self.path_filters = self.compile_path_filters()
+        self._stage_definitions = {}
+        self.crons = self.compile_crons()
+
+    def compile_crons(self):
+        crons = compile_crons(self.cfg.get('crons', {}))
+        stages = self.cfg.get('stages', {})
+        for cron in crons:
+            for stage in cron.stages or []:
+                if stage not in stages:
+                    raise PipelineYmlInvalid("cron {} runs unknown stage {}".format(cron.name, stage))
+        return crons
+
+    def compile_path_filters(self):
+        filters = {}
+        for name, stage in self.cfg.get('stages', {}).items():
+            if isinstance(stage, dict) and ('paths' in stage or 'paths_ignore' in stage):
+                filters[name] = PathFilter(stage.get('paths'), stage.get('paths_ignore'), name)
+        return filters
+
+    def validate_needs(self):
+        stages = self.cfg.get('stages', {})
+        deps = {}
+        for name, stage in stages.items():
+            needs = stage.get('needs') if isinstance(stage, dict) else None
+            if needs is None:
+                continue
+            if not isinstance(needs, list):
+                raise PipelineYmlInvalid("needs of stage {} must be a list".format(name))
+            for need in needs:
+                if need not in stages:
+                    raise PipelineYmlInvalid("stage {} needs unknown stage {}".format(name, need))
+            deps[name] = needs
+        check_acyclic(deps)
+
+    def validate_fanout(self):
+        for name, stage in self.cfg.get('stages', {}).items():
+            if not isinstance(stage, dict):
+                continue
+            max_parallel = stage.get('max_parallel')
+            if max_parallel is not None and (
+                    not isinstance(max_parallel, int) or isinstance(max_parallel, bool) or max_parallel < 1):
+                raise PipelineYmlInvalid("max_parallel of stage {} must be a positive integer".format(name))
+
+    def validate_conditions(self):
+        for stage in self.cfg.get('stages', {}):
+            for step in self.generate_step_list(stage):
+                if isinstance(step, dict) and step.get('condition') is not None:
+                    compile_condition(step['condition'])
 
     @staticmethod
-    def compute_matrix(matrix, matrix_include=None, matrix_exclude=None):
-        if not matrix and not matrix_include:
-            return [{}]  # if matrix is not used, we run this stage within on build without particular property
-        matrix_list = []
-        for k, vs in matrix.items():
-            if matrix_list:
-                next_matrix_list = []
-                for matrix_item in matrix_list:
-                    for v in vs:
-                        _matrix_item = matrix_item.copy()
-                        _matrix_item[k] = v
-                        next_matrix_list.append(_matrix_item)
-                matrix_list = next_matrix_list
-            else:
-                matrix_list = [{k: v} for v in vs]
-
-        # manage matrix include: include, but only if it is not already there
-        if matrix_include:
-            # dict is not hashable, so we cannot implement uniqueness via list(set())
-            # we first remove exact dupes, and then insert
-            for include_item in matrix_include:
-                matrix_list = [item for item in matrix_list if item != include_item]
-            matrix_list.extend(matrix_include)
-        excluded_items = []
-
-        # manage matrix exclude
-        if matrix_exclude:
-            for exclude_items in matrix_exclude:
-                for item in matrix_list:
-                    # exclude works if all of exclude items keys are inside an item remove them.
-                    # all item keys do not need to be in exclude item
-                    for k, v in exclude_items.items():
-                        if k not in item or item[k] != v:
-                            break
-                    else:
-                        excluded_items.append(item)
-        if excluded_items:
-            matrix_list = [item for item in matrix_list if item not in excluded_items]
-        return matrix_list
+    def compute_matrix(matrix, matrix_include=None, matrix_exclude=None, max_cells=DEFAULT_MAX_CELLS):
+        return Matrix(matrix, matrix_include, matrix_exclude, max_cells).expand()
 
     def find_stages_for_branch(self, branch):
-        if 'branches' not in self.cfg:
+        if self.branch_router is None:
             return list(self.cfg.get('stages', {}).keys())
-        for branch_re, stages in self.cfg.get('branches', {}).items():
-            if re.match(branch_re, branch):
-                return stages
-        return []
-
-    def generate_triggers(self, codebase, branch, event_category="push"):
-        stages = self.find_stages_for_branch(branch)
-        if isinstance(stages, dict):
-            stages = stages.get(event_category, [])
+        return self.branch_router.match(branch)
+
+    def stage_matches_files(self, stage, files):
+        path_filter = self.path_filters.get(stage)
+        return path_filter is None or path_filter.matches(files)
+
+    def uses_build_avoidance(self):
+        return any(isinstance(stage, dict) and stage.get('build_avoidance')
+                   for stage in self.cfg.get('stages', {}).values())
+
+    def stage_definition(self, stage):
+        """canonical definition of the stage, for the build avoidance keys"""
+        if stage not in self._stage_definitions:
+            try:
+                definition = canonical([self.get_stage(stage), self.cfg.get('env', {})])
+            except NotCanonical:
+                # some custom object: only reuse builds of the very same pipeline
+                definition = [stage, self.digest]
+            self._stage_definitions[stage] = definition
+        return self._stage_definitions[stage]
+
+    def generate_triggers(self, codebase, branch, event_category="push", files=None,
+                          tree_hash=None, stages=None):
+        """
+        @param files: the files modified by the changes, to select the stages with path
+                      filters. None when unknown, in which case all stages run
+        @param tree_hash: hash of the source tree, to compute the build avoidance keys
+        @param stages: the stages to run, instead of the ones of the branch, e.g. for crons
+        """
+        if stages is None:
+            stages = self.find_stages_for_branch(branch)
+            if isinstance(stages, dict):
+                stages = stages.get(event_category, [])
         ret = []
         for stage_name in stages:
             stage = self.cfg.get('stages', {}).get(stage_name, {})
-            matrix = self.compute_matrix(
-                stage.get('matrix', {}), stage.get('matrix_include', {}),
-                stage.get('matrix_exclude', {}))
+            if not self.stage_matches_files(stage_name, files):
+                # still listed, so that the stage is reported as skipped
+                ret.append({'stage': stage_name, 'buildrequests': [], 'skipped': True,
+                            'needs': stage.get('needs'), 'max_parallel': None,
+                            'fail_fast': False})
+                continue
+            matrix = Matrix(
+                stage.get('matrix', {}), stage.get('matrix_include', []),
+                stage.get('matrix_exclude', []), self.max_matrix_cells)
+            matrix.check_size()
             buildrequests_properties = []
             for props in matrix:
                 properties = YmlProperties()
                 properties.update(props, 'yml_matrix')
                 properties.update(stage.get('env', {}), 'yml_stage')
                 properties.update(self.cfg.get('env', {}), 'yml_global')
-                properties.setProperty('yaml_text', self.yaml_text, 'yml_text')
+                properties.setProperty('yaml_digest', self.digest, 'yml_text')
                 properties.setProperty('stage_name', stage_name, 'yml_stage')
                 worker = stage.get('worker', {})
                 worker_type = worker.get('type')
@@ -170,10 +325,42 @@ class PipelineYml(object):
                     properties.setProperty('worker_type', worker_type, 'yml_worker')
                     properties.setProperty('worker_image', worker.get("image"), 'yml_worker')
                     properties.setProperty('worker', worker, 'yml_worker')
+                if tree_hash is not None and stage.get('build_avoidance'):
+                    properties.setProperty('avoidance_key', avoidance_key(
+                        tree_hash, self.stage_definition(stage_name), props), 'yml_cache')
                 properties.computeVirtualBuilder(codebase)
                 buildrequests_properties.append(properties)
-            ret.append({'stage': stage_name, 'buildrequests': buildrequests_properties})
+            ret.append({'stage': stage_name, 'buildrequests': buildrequests_properties,
+                        'skipped': False, 'needs': stage.get('needs'),
+                        'max_parallel': stage.get('max_parallel'),
+                        'fail_fast': bool(stage.get('fail_fast', False))})
         return ret
 
+    def stage_graph(self, triggers):
+        return StageGraph([trigger['stage'] for trigger in triggers],
+                          dict((trigger['stage'], trigger['needs']) for trigger in triggers))
+
+    @property
+    def auto_cancel(self):
+        return bool(self.cfg.get('auto_cancel', False))
+
+    def get_stage(self, stage):
+        return self.cfg.get('stages', {}).get(stage, {})
+
     def generate_step_list(self, stage):
-        return self.cfg.get('stages', {}).get(stage, {}).get("steps", [])
+        return self.get_stage(stage).get("steps", [])
+
+    def fuse_steps(self, stage):
+        return bool(self.get_stage(stage).get("fuse_steps", False))
+
+    def needs_source_checkout(self, stage):
+        """whether the runner checks out the source, by default unless a step already does"""
+        stage = self.get_stage(stage)
+        if "source_checkout" in stage:
+            return bool(stage["source_checkout"])
+        for step in stage.get("steps", []):
+            if isinstance(step, dict):
+                step = step.get("step")
+            if isinstance(step, Source):
+                return False
+        return True
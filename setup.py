@@ -15,6 +15,11 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
+    entry_points={
+        'console_scripts': [
+            'bbpipeline = buildbot_pipelines.scripts.bbpipeline:main',
+        ],
+    },
     install_requires=[
         'setuptools',
         'buildbot>=0.9.8',  # for virtual builders features and renderable codebase